@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Dict, Optional
+
+from loguru import logger
+
+from benchmark.mockServers import MockServerConfig
+from benchmark.scenarios import benchmarkApiRefresh, benchmarkDigestRuns, benchmarkFiltering
+from benchmark.synthetic import SemesterConfig, generateSemester
+from utils.dingtalk.rateLimiter import RateLimitConfig
+from utils.metrics import registry
+from utils.tracing import tracer
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+REGRESSION_RATIO = 1.2  # 耗时超过上次的该倍数时标记为退化
+
+
+def gitRevision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    semesterConfig = SemesterConfig(courses=args.courses)
+    mockConfig = MockServerConfig(latency=args.latency, throttleQps=args.throttle_qps)
+    rateLimitConfig = RateLimitConfig(qps=args.qps, burst=args.qps, maxInFlight=args.max_in_flight)
+    semester = generateSemester(semesterConfig)
+
+    results: Dict = {"meta": {"revision": gitRevision(), "createdAt": datetime.datetime.now().isoformat(timespec="seconds"),
+                              "python": platform.python_version(), "platform": platform.platform(),
+                              "semester": semesterConfig.dict(), "mockServer": mockConfig.dict(), "rateLimit": rateLimitConfig.dict()}}
+    print("ApiHandler 刷新课程...")
+    results["apiRefresh"], handler = await benchmarkApiRefresh(semester, mockConfig)
+    print("课程筛选与渲染...")
+    results["filtering"] = benchmarkFiltering(handler, semester)
+    results["digestRuns"] = {}
+    for userCount in args.users:
+        print(f"{userCount}位用户的完整推送...")
+        results["digestRuns"][str(userCount)] = await benchmarkDigestRuns(semester, userCount, mockConfig, rateLimitConfig)
+    results["metrics"] = registry.toDict()  # 全部场景累计的接口耗时、缓存命中等指标
+    return results
+
+
+def flattenSeconds(results: Dict, prefix: str = "") -> Dict[str, float]:
+    """{"digestRuns": {"100": {"seconds": {"goodNight": 1.0}}}} -> {"digestRuns.100.goodNight": 1.0}"""
+    flattened: Dict[str, float] = {}
+    for key, value in results.items():
+        if key in ("meta", "metrics") or not isinstance(value, dict):
+            continue
+        if key == "seconds":
+            flattened.update({f"{prefix}{name}": seconds for name, seconds in value.items()})
+        else:
+            flattened.update(flattenSeconds(value, f"{prefix}{key}."))
+    return flattened
+
+
+def printResults(results: Dict, baseline: Optional[Dict] = None):
+    current = flattenSeconds(results)
+    previous = flattenSeconds(baseline) if baseline else {}
+    for name, seconds in current.items():
+        line = f"{name:<40}{seconds:>10.3f}s"
+        if name in previous and previous[name] > 0:
+            ratio = seconds / previous[name]
+            line += f"{previous[name]:>10.3f}s{ratio:>8.2f}x" + ("  退化" if ratio > REGRESSION_RATIO else "")
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="以合成的课表与模拟的钉钉、PocketBase 服务端运行基准测试")
+    parser.add_argument("--users", type=lambda s: [int(n) for n in s.split(",")], default=[10, 100, 1000, 10000], help="完整推送的用户数，以逗号分隔")
+    parser.add_argument("--courses", type=int, default=SemesterConfig().courses, help="合成学期的课程数")
+    parser.add_argument("--latency", type=float, default=MockServerConfig().latency, help="模拟服务端的平均延迟（秒）")
+    parser.add_argument("--throttle-qps", type=float, default=0, help="模拟服务端每个接口每秒最多处理的请求数，0 表示不限流")
+    parser.add_argument("--qps", type=float, default=1000, help="客户端限流器每个接口的速率")
+    parser.add_argument("--max-in-flight", type=int, default=50, help="客户端限流器每个接口的并发上限")
+    parser.add_argument("--output", help="结果文件，默认为 benchmark/results/<时间>.json")
+    parser.add_argument("--compare", help="与之前的结果文件比较")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.0, help="追踪的采样率，大于 0 时在结果文件旁导出 Chrome trace JSON")
+    parser.add_argument("--profile-job", action="append", default=[], help="用 cProfile 分析该任务（如 goodNight）的第一次运行")
+    args = parser.parse_args()
+    tracer.configure(args.trace_sample_rate, args.profile_job, profileDirectory=RESULTS_DIR)
+
+    logger.remove()  # 基准测试只输出警告与错误
+    logger.add(sys.stderr, level="WARNING")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results = asyncio.run(run(args))
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    tracer.export(f"{os.path.splitext(output)[0]}.trace.json")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+    printResults(results, baseline)
+    print(f"结果已保存至{output}")
@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Tuple
+
+import httpx
+from pydantic import BaseModel
+
+from utils.dingtalk.formSync import ENABLE_LABEL, URL_LABEL
+
+
+class MockServerConfig(BaseModel):
+    latency: float = 0.005  # 每个请求的平均延迟（秒）
+    jitter: float = 0.5  # 延迟的随机浮动比例
+    throttleQps: float = 0  # 每个接口每秒最多处理的请求数，超过时返回限流错误；为 0 时不限流
+    seed: int = 1
+
+
+class MockServer:
+    """模拟服务端的公共部分：请求延迟、按接口的限流与请求计数"""
+
+    hosts: Tuple[str, ...] = ()
+
+    def __init__(self, config: MockServerConfig = MockServerConfig()):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.requests: Counter = Counter()  # 接口 -> 请求次数
+        self.throttledRequests: Counter = Counter()
+        self.recentRequests: Dict[str, Deque[float]] = defaultdict(deque)
+
+    async def delay(self):
+        if self.config.latency > 0:
+            await asyncio.sleep(self.config.latency * self.random.uniform(1 - self.config.jitter, 1 + self.config.jitter))
+
+    def throttled(self, endpoint: str) -> bool:
+        """滑动窗口：最近一秒内该接口的请求数超过 throttleQps 时限流"""
+        self.requests[endpoint] += 1
+        if not self.config.throttleQps:
+            return False
+        now = time.monotonic()
+        recent = self.recentRequests[endpoint]
+        while recent and recent[0] <= now - 1:
+            recent.popleft()
+        if len(recent) >= self.config.throttleQps:
+            self.throttledRequests[endpoint] += 1
+            return True
+        recent.append(now)
+        return False
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        raise NotImplementedError
+
+
+class MockPocketBase(MockServer):
+    """模拟 PocketBase 的 /api/collections/course/records：分页、按 -updated 排序、updated>"..." 的筛选"""
+
+    hosts = ("sillage.siae.top",)
+    filterPattern = re.compile(r'^updated>"(.*)"$')
+
+    def __init__(self, rawCourses: List[Dict], config: MockServerConfig = MockServerConfig()):
+        super().__init__(config)
+        self.rawCourses = rawCourses
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await self.delay()
+        if request.url.path != "/api/collections/course/records":
+            return httpx.Response(404, json={"code": 404, "message": "The requested resource wasn't found."})
+        if self.throttled(request.url.path):
+            return httpx.Response(429, json={"code": 429, "message": "Too Many Requests."})
+        params = request.url.params
+        page, perPage = int(params.get("page", 1)), int(params.get("perPage", 30))
+        items = self.rawCourses
+        if params.get("filter"):
+            watermark = self.filterPattern.match(params["filter"]).group(1)
+            items = [item for item in items if item["updated"] > watermark]
+        if params.get("sort") == "-updated":
+            items = sorted(items, key=lambda item: item["updated"], reverse=True)
+        return httpx.Response(200, json={"page": page, "perPage": perPage, "totalItems": len(items),
+                                         "totalPages": -(-len(items) // perPage), "items": items[(page - 1) * perPage:page * perPage]})
+
+
+class MockDingTalk(MockServer):
+    """
+    模拟钉钉的旧版（oapi.dingtalk.com）与新版（api.dingtalk.com）接口：
+    gettoken、工作通知、用户详情、日程的增删改，以及智能填表的表单与提交记录
+    """
+
+    hosts = ("oapi.dingtalk.com", "api.dingtalk.com")
+    formCode = "PROC-BENCHMARK"
+    calendarPattern = re.compile(r"^/v1\.0/calendar/users/([^/]+)/calendars/primary/events(?:/([^/]+))?$")
+
+    def __init__(self, subscribers: List[Tuple[str, str]], config: MockServerConfig = MockServerConfig()):
+        super().__init__(config)
+        self.accessToken = "mock-access-token"
+        self.messages: List[Dict] = []  # 收到的工作通知
+        self.recipients = 0  # 工作通知的接收人次
+        self.events: Dict[str, Dict] = {}  # 日程id -> 日程
+        self.eventIds = itertools.count()
+        modifyTime = "2022-08-11T10:22Z"
+        self.formRecords = [{"forms": [{"label": ENABLE_LABEL, "key": "enable", "value": "启用"},
+                                       {"label": URL_LABEL, "key": "url", "value": url}],
+                             "createTime": modifyTime, "modifyTime": modifyTime, "formCode": self.formCode,
+                             "submitterUserId": userId, "submitterUserName": userId, "formInstanceId": f"instance-{userId}"}
+                            for userId, url in subscribers]
+
+    @staticmethod
+    def oapiResponse(**body) -> httpx.Response:
+        return httpx.Response(200, json={"errcode": 0, "errmsg": "ok", **body})
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await self.delay()
+        path = request.url.path
+        endpoint = self.calendarPattern.sub("/v1.0/calendar/events", path)
+        if request.url.host == "oapi.dingtalk.com":
+            if self.throttled(endpoint):
+                return httpx.Response(200, json={"errcode": 90018, "errmsg": "应用调用接口次数过多"})
+            if path == "/gettoken":
+                return self.oapiResponse(access_token=self.accessToken, expires_in=7200)
+            if request.url.params.get("access_token") != self.accessToken:
+                return httpx.Response(200, json={"errcode": 40014, "errmsg": "不合法的access_token"})
+            body = json.loads(request.content or b"{}")
+            if path == "/topapi/message/corpconversation/asyncsend_v2":
+                self.messages.append(body)
+                self.recipients += len(body["userid_list"].split(","))
+                return self.oapiResponse(task_id=len(self.messages))
+            if path == "/topapi/v2/user/get":
+                return self.oapiResponse(result={"userid": body["userid"], "unionid": f"union-{body['userid']}"})
+            return httpx.Response(200, json={"errcode": 404, "errmsg": f"未模拟的接口{path}"})
+
+        if self.throttled(endpoint):
+            return httpx.Response(429, json={"code": "Forbidden.AccessDenied.QpsLimitForApi", "message": "QPS限流"})
+        if request.headers.get("x-acs-dingtalk-access-token") != self.accessToken:
+            return httpx.Response(401, json={"code": "InvalidAuthentication", "message": "不合法的access_token"})
+        if (match := self.calendarPattern.match(path)) is not None:
+            return self.handleCalendar(request, match.group(2))
+        if path == "/v1.0/swform/users/forms":
+            return httpx.Response(200, json={"result": {"list": [{"formCode": self.formCode, "creator": "0", "name": "订阅钉钉推送", "memo": ""}]}})
+        if path == f"/v1.0/swform/forms/{self.formCode}/instances":
+            nextToken, maxResults = int(request.url.params.get("nextToken", 0)), int(request.url.params.get("maxResults", 100))
+            records = self.formRecords[nextToken:nextToken + maxResults]
+            hasMore = nextToken + maxResults < len(self.formRecords)
+            return httpx.Response(200, json={"result": {"hasMore": hasMore, "nextToken": str(nextToken + maxResults), "list": records}})
+        return httpx.Response(404, json={"code": "NotFound", "message": f"未模拟的接口{path}"})
+
+    def handleCalendar(self, request: httpx.Request, eventId: str) -> httpx.Response:
+        if request.method == "POST":
+            eventId = f"event{next(self.eventIds)}"
+            self.events[eventId] = json.loads(request.content)
+            return httpx.Response(200, json={"id": eventId})
+        if eventId not in self.events:
+            return httpx.Response(404, json={"code": "eventNotFound", "message": "日程不存在"})
+        if request.method == "PUT":
+            self.events[eventId] = json.loads(request.content)
+            return httpx.Response(200, json={"id": eventId})
+        del self.events[eventId]
+        return httpx.Response(200, json={})
+
+
+def mockTransport(*servers: MockServer) -> httpx.MockTransport:
+    """按主机名把请求转发给对应的模拟服务端，注入 HttpClientPool(asyncTransport=...) 使用"""
+    serverOfHost = {host: server for server in servers for host in server.hosts}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        server = serverOfHost.get(request.url.host)
+        if server is None:
+            return httpx.Response(502, text=f"没有模拟{request.url.host}")
+        return await server.handle(request)
+
+    return httpx.MockTransport(handler)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+from typing import Any, Awaitable, Dict, List, Tuple
+
+import main
+from utils.course import ApiHandler, CompiledSubscription, apiHandler
+from utils.dingtalk import DingTalkHandler, dingTalkHandler
+from utils.dingtalk.rateLimiter import RateLimitConfig, RateLimiter
+from utils.dingtalk.settingsStore import SettingsStore
+from utils.httpClient import HttpClientPool
+
+from benchmark.mockServers import MockDingTalk, MockPocketBase, MockServerConfig, mockTransport
+from benchmark.synthetic import Semester, generateSubscribers, touchCourses
+
+Result = Dict[str, Dict[str, Any]]  # {"seconds": 各阶段耗时, "counts": 计数}
+
+
+async def timed(awaitable: Awaitable) -> Tuple[float, Any]:
+    startTime = time.perf_counter()
+    result = await awaitable
+    return time.perf_counter() - startTime, result
+
+
+async def benchmarkApiRefresh(semester: Semester, mockConfig: MockServerConfig, touchedCourses: int = 50) -> Tuple[Result, ApiHandler]:
+    """ApiHandler 的全量同步与增量同步；返回结果与已获取课程的 ApiHandler，供之后的场景使用"""
+    pocketBase = MockPocketBase(semester.rawCourses, mockConfig)
+    handler = ApiHandler(HttpClientPool(asyncTransport=mockTransport(pocketBase)))
+    fullSync, _ = await timed(handler.refreshCourses())
+    fullSyncRequests = sum(pocketBase.requests.values())
+    unchangedSync, _ = await timed(handler.refreshCourses())
+    touchCourses(semester, touchedCourses)
+    incrementalSync, courseDiff = await timed(handler.refreshCourses())
+    await handler.aclose()
+    return {"seconds": {"fullSync": fullSync, "unchangedSync": unchangedSync, "incrementalSync": incrementalSync},
+            "counts": {"courses": len(handler.courses), "fullSyncRequests": fullSyncRequests,
+                       "requests": sum(pocketBase.requests.values()), "changedCourses": len(courseDiff)}}, handler
+
+
+def benchmarkFiltering(handler: ApiHandler, semester: Semester, subscriberCount: int = 1000) -> Result:
+    """逐个订阅筛选（apply + filter_of_date）与批量匹配（matchSubscriptions）的对比，以及摘要渲染有无缓存的对比"""
+    date = semester.start.isoformat()
+    subscriptions = list(dict.fromkeys(CompiledSubscription.fromUrl(url) for _, url in generateSubscribers(semester, subscriberCount)))
+
+    startTime = time.perf_counter()
+    filtered = [subscription.apply(handler.courseDecorator).filter_of_date(date) for subscription in subscriptions]
+    perSubscription = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    matched = handler.matchSubscriptions(subscriptions, date)
+    batched = time.perf_counter() - startTime
+    assert [len(c.value) for c in filtered] == [len(c.value) for c in matched], "批量匹配与逐个筛选的结果不一致"
+
+    handler.courseRenderer.clear()
+    startTime = time.perf_counter()
+    for courseDecorator in matched:
+        str(courseDecorator)
+    renderCold = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    for courseDecorator in matched:
+        str(courseDecorator)
+    renderWarm = time.perf_counter() - startTime
+
+    return {"seconds": {"perSubscriptionFilter": perSubscription, "batchMatch": batched, "renderCold": renderCold, "renderWarm": renderWarm},
+            "counts": {"subscriptions": len(subscriptions), "matchedCourses": sum(len(c.value) for c in matched)}}
+
+
+def createDingTalkHandler(directory: str, transport, rateLimitConfig: RateLimitConfig, subscribers: List[Tuple[str, str]]) -> DingTalkHandler:
+    """使用模拟服务端的 DingTalkHandler：预先写入凭证、已获取完通讯录的状态与各用户的 unionId（即常驻运行时的稳定状态）"""
+    settingFileName = os.path.join(directory, "settings.db")
+    store = SettingsStore(settingFileName)
+    for key, value in (("AGENT_ID", "0"), ("APP_KEY", "benchmark"), ("APP_SECRET", "benchmark"), ("STATUS", "DONE")):
+        store.setCredential(key, value)
+    store.upsertUsers({"userid": userId, "unionid": f"union-{userId}", "name": userId} for userId, _ in subscribers)
+    store.close()
+    return DingTalkHandler(settingFileName, HttpClientPool(asyncTransport=transport), RateLimiter(rateLimitConfig))
+
+
+async def benchmarkDigestRuns(semester: Semester, userCount: int, mockConfig: MockServerConfig, rateLimitConfig: RateLimitConfig) -> Result:
+    """
+    以 userCount 位订阅用户完整运行一次：刷新远端数据，早间推送与晚间推送（含日程同步），
+    推送分为写入发件箱与发件箱发送完毕两个阶段计时
+    """
+    subscribers = generateSubscribers(semester, userCount)
+    pocketBase = MockPocketBase(semester.rawCourses, mockConfig)
+    dingTalk = MockDingTalk(subscribers, mockConfig)
+    transport = mockTransport(pocketBase, dingTalk)
+    with tempfile.TemporaryDirectory() as directory:
+        # main 使用的是全局的 apiHandler / dingTalkHandler，替换为使用模拟服务端的实例
+        apiHandler.override(ApiHandler(HttpClientPool(asyncTransport=transport)))
+        dingTalkHandler.override(createDingTalkHandler(directory, transport, rateLimitConfig, subscribers))
+        # 常驻模式，晚间推送后不会退出
+        handler = main.SillageDingtalkHandler(os.path.join(directory, "snapshot.json"), os.path.join(directory, "outbox.db"), daemon=True)
+
+        async def drain():
+            while await handler.outboxWorker.runOnce():
+                pass
+
+        seconds: Dict[str, float] = {}
+        seconds["refresh"], _ = await timed(handler.refreshRemoteData())
+        seconds["refreshUnchanged"], _ = await timed(handler.refreshRemoteData())
+        seconds["goodMorning"], _ = await timed(handler.goodMorning())
+        seconds["goodMorningDelivery"], _ = await timed(drain())
+        seconds["goodNight"], _ = await timed(handler.goodNight())
+        seconds["goodNightDelivery"], _ = await timed(drain())
+
+        counts = {"users": len(handler.users), "messages": len(dingTalk.messages), "recipients": dingTalk.recipients,
+                  "calendarEvents": len(dingTalk.events), "requests": sum(dingTalk.requests.values()) + sum(pocketBase.requests.values()),
+                  "throttled": sum(dingTalk.throttledRequests.values()) + sum(pocketBase.throttledRequests.values()),
+                  "outbox": handler.outbox.counts()}
+        handler.outbox.close()
+        await apiHandler.aclose()
+        await dingTalkHandler.aclose()
+    return {"seconds": seconds, "counts": counts}
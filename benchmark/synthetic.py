@@ -0,0 +1,110 @@
+import datetime
+import json
+import random
+from typing import Dict, List, NamedTuple, Tuple
+from urllib.parse import quote
+
+from pydantic import BaseModel
+
+
+class SemesterConfig(BaseModel):
+    courses: int = 4000
+    grades: int = 4
+    groupsPerGrade: int = 12  # 每个年级的班级/小组数
+    teachers: int = 120
+    rooms: int = 60
+    courseNames: int = 80
+    weeks: int = 18
+    datesPerCourse: int = 16  # 每门课程的上课次数
+    seed: int = 7
+
+
+class SubscriberConfig(BaseModel):
+    # 各类订阅的占比：按年级与班级/小组、按教师、按教室、按课程名称、只按年级
+    gradeGroupShare: float = 0.7
+    teacherShare: float = 0.15
+    roomShare: float = 0.05
+    subjectShare: float = 0.05
+    seed: int = 3
+
+
+class Semester(NamedTuple):
+    rawCourses: List[Dict]  # 与 PocketBase 接口返回的记录结构相同
+    grades: List[str]
+    groupsOfGrade: Dict[str, List[str]]
+    teachers: List[str]
+    rooms: List[str]
+    courseNames: List[str]
+    start: datetime.date
+
+
+def pocketBaseTime(dateTime: datetime.datetime) -> str:
+    return dateTime.strftime("%Y-%m-%d %H:%M:%S.") + f"{dateTime.microsecond // 1000:03d}Z"
+
+
+def generateSemester(config: SemesterConfig = SemesterConfig(), start: datetime.date = None) -> Semester:
+    """生成一个学期的课程；start 默认为今天，使今天和明天都有课（与运行基准测试的日期是星期几无关）"""
+    r = random.Random(config.seed)
+    start = start or datetime.date.today()
+    grades = [f"{20 + i}级" for i in range(config.grades)]
+    groupsOfGrade = {grade: [f"{chr(ord('A') + i)}班" for i in range(config.groupsPerGrade)] for grade in grades}
+    teachers = [f"教师{i}" for i in range(config.teachers)]
+    rooms = [f"教室{i}" for i in range(config.rooms)]
+    courseNames = [f"课程{i}" for i in range(config.courseNames)]
+    createdAt = datetime.datetime.combine(start, datetime.time()) - datetime.timedelta(days=30)
+
+    rawCourses = []
+    for i in range(config.courses):
+        grade = r.choice(grades)
+        situations = [{"groups": [f"{group}" for group in r.sample(groupsOfGrade[grade], r.randint(0, 2))],
+                       "teachers": r.sample(teachers, r.randint(1, 2)),
+                       "rooms": r.sample(rooms, r.randint(0, 1))} for _ in range(r.randint(1, 3))]
+        # 同一门课程固定在每周的同一天（相对于 start 的第 0~4 天）
+        weekday = r.randrange(5)
+        weeks = sorted(r.sample(range(config.weeks), min(config.datesPerCourse, config.weeks)))
+        dates = [(start + datetime.timedelta(weeks=week, days=weekday)).isoformat() for week in weeks]
+        updated = createdAt + datetime.timedelta(seconds=r.randrange(30 * 24 * 3600))
+        rawCourses.append({"id": f"course{i:06d}", "created": pocketBaseTime(createdAt), "updated": pocketBaseTime(updated),
+                           "info": {"name": r.choice(courseNames), "code": None, "bgc": "#ffffff"},
+                           "situations": situations, "grade": grade, "dates": dates, "lessonNum": r.randint(1, 5),
+                           "note": "", "method": r.choice(["CM", "TD", "TP"])})
+    return Semester(rawCourses, grades, groupsOfGrade, teachers, rooms, courseNames, start)
+
+
+def touchCourses(semester: Semester, count: int, seed: int = 11) -> List[Dict]:
+    """修改 count 门课程（换教室、更新 updated），用于增量同步与课程变更的基准测试；返回修改后的记录"""
+    r = random.Random(seed)
+    now = pocketBaseTime(datetime.datetime.utcnow())
+    touched = []
+    for rawCourse in r.sample(semester.rawCourses, min(count, len(semester.rawCourses))):
+        rawCourse["situations"][0]["rooms"] = [r.choice(semester.rooms)]
+        rawCourse["updated"] = now
+        touched.append(rawCourse)
+    return touched
+
+
+def subscriptionUrl(**query: List[str]) -> str:
+    params = "&".join(f"{key}={quote(value)}" for key, values in query.items() for value in values)
+    return f"https://course.siae.top/#/course/?{params}"
+
+
+def generateSubscribers(semester: Semester, count: int, config: SubscriberConfig = SubscriberConfig()) -> List[Tuple[str, str]]:
+    """生成 count 位订阅用户，返回 (userId, 订阅网址)"""
+    r = random.Random(config.seed)
+    subscribers = []
+    for i in range(count):
+        kind = r.random()
+        grade = r.choice(semester.grades)
+        if kind < config.gradeGroupShare:
+            groups = r.sample(semester.groupsOfGrade[grade], r.randint(1, 2))
+            url = subscriptionUrl(grade=[grade], group=[json.dumps([grade, group], ensure_ascii=False) for group in groups])
+        elif (kind := kind - config.gradeGroupShare) < config.teacherShare:
+            url = subscriptionUrl(teacher=[r.choice(semester.teachers)])
+        elif (kind := kind - config.teacherShare) < config.roomShare:
+            url = subscriptionUrl(room=[r.choice(semester.rooms)])
+        elif kind - config.roomShare < config.subjectShare:
+            url = subscriptionUrl(grade=[grade], subject=[r.choice(semester.courseNames)])
+        else:
+            url = subscriptionUrl(grade=[grade])
+        subscribers.append((f"user{i:06d}", url))
+    return subscribers
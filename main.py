@@ -1,60 +1,143 @@
+import argparse
 import asyncio
 import datetime
-import re
-from typing import List, Tuple
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import Any, List, Tuple, Optional, Dict, Callable, Set
 from functools import partial
-from urllib.parse import urlparse, parse_qs
 
-from apscheduler.schedulers.background import BlockingScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from loguru import logger
 
 logger.add("log/file_{time}.log", rotation="04:00", retention="10 days", level="INFO")
 
-from utils.course import apiHandler, CourseDecorator, QueryParseResult
+from utils.course import apiHandler, CourseDecorator, CompiledSubscription, CompactCourse, CourseDiff, SubscriptionIndex, urlStrip
+from utils.course.courseDiff import diffCourseSets
 from utils.dingtalk import dingTalkHandler
+from utils.dingtalk.calendarSync import CalendarSync, CalendarEventPlan
+from utils.dingtalk.formSync import FormSync
+from utils.dingtalk.outbox import Outbox, OutboxWorker, PENDING, IN_FLIGHT, DONE, FAILED
+from utils.lessonReminders import LessonReminders
+from utils.metrics import MetricsServer, instrument, registry
+from utils.tracing import span, traced, tracer
+from utils.sharding import ShardCoordinator, SqliteLeaseStore
+from utils.snapshot import SnapshotStore
+
+Digest = Tuple[str, str]  # (标题, 内容)
+ADDITION = "更多信息: course.siae.top"
+MORNING, NIGHT = (6, 0), (17, 10)  # 发送今天、明天课程的时间
+
+jobSeconds = registry.histogram("sillage_job_seconds", "定时任务的耗时", ["job"])
+jobRuns = registry.counter("sillage_job_runs", "定时任务的运行次数", ["job", "status"])
+jobUsers = registry.gauge("sillage_job_users", "定时任务最近一次处理的用户数", ["job"])
+digestMessages = registry.counter("sillage_digest_messages", "写入发件箱的消息数，skipped 为幂等键已存在而跳过的", ["kind", "result"])
+digestRecipients = registry.counter("sillage_digest_recipients", "写入发件箱的消息的接收人次", ["kind"])
+cacheRequests = registry.counter("sillage_cache_requests", "缓存的查询次数", ["cache", "result"])
 
 
 class UserHandler:
-    def __init__(self, userId: str, subscribedUrl: str):
+    def __init__(self, userId: str, subscribedUrl: str, subscription: Optional[CompiledSubscription] = None, unionId: str = ""):
         self.userId = userId
         self.subscribedUrl = subscribedUrl
-        self.unionId = ""
-
-        async def getUnionId():
-            try:
-                self.unionId = await dingTalkHandler.getUnionIdOfUserId(userId)
-            except Exception as e:
-                logger.error(f"""获取id为"{userId}"的用户详细信息时出错: {e}""")
-
-        asyncio.get_event_loop().run_until_complete(getUnionId())
+        self.unionId = unionId
+        self.subscription: Optional[CompiledSubscription] = subscription
+
+        if subscription is not None:
+            return  # 从快照恢复时，订阅已经编译过了
+        try:
+            self.subscription = CompiledSubscription.fromUrl(subscribedUrl)
+        except Exception as e:
+            logger.error(f"""解析id为"{userId}"的用户订阅的网址"{subscribedUrl}"时出错: {e}""")
+
+    @classmethod
+    async def create(cls, userId: str, subscribedUrl: str) -> "UserHandler":
+        user = cls(userId, subscribedUrl)
+        if user.subscription is not None:
+            await user.fetchUnionId()
+        return user
+
+    async def fetchUnionId(self):
+        try:
+            self.unionId = await dingTalkHandler.getUnionIdOfUserId(self.userId)
+        except Exception as e:
+            logger.error(f"""获取id为"{self.userId}"的用户详细信息时出错: {e}""")
+
+    @classmethod
+    def fromSnapshot(cls, snapshot: Dict) -> "UserHandler":
+        return cls(snapshot["userId"], snapshot["subscribedUrl"], CompiledSubscription.fromDict(snapshot["subscription"]), snapshot["unionId"])
+
+    def toSnapshot(self) -> Dict:
+        return {"userId": self.userId, "subscribedUrl": self.subscribedUrl, "subscription": self.subscription.toDict(), "unionId": self.unionId}
 
     def getCourseDecorator(self) -> CourseDecorator:
-        urlParseResult = urlparse(SillageDingtalkHandler.urlStrip(self.subscribedUrl))
-        queryParseResult = QueryParseResult(**parse_qs(urlParseResult.query))
+        with span("UserHandler.getCourseDecorator", user=self.userId):
+            return self.subscription.apply(apiHandler.courseDecorator)
 
-        courseDecorator = apiHandler.courseDecorator
-        courseDecorator = courseDecorator.filter_grades(queryParseResult.grade) if queryParseResult.grade else courseDecorator
-        courseDecorator = courseDecorator.filter_of_rooms(queryParseResult.room) if queryParseResult.room else courseDecorator
-        courseDecorator = courseDecorator.filter_of_methods(queryParseResult.method) if queryParseResult.method else courseDecorator
-        courseDecorator = courseDecorator.filter_of_teachers(queryParseResult.teacher) if queryParseResult.teacher else courseDecorator
-        courseDecorator = courseDecorator.filter_of_grade_groups(queryParseResult.group) if queryParseResult.group else courseDecorator
-        courseDecorator = courseDecorator.filter_of_course_names(queryParseResult.subject) if queryParseResult.subject else courseDecorator
+    async def sendCorporationMsg(self, msg: str, title="课程提醒"):
+        await dingTalkHandler.sendCorporationMarkdownMsg([self.userId], title=title, text=msg)
 
-        return courseDecorator
-
-    def sendCorporationMsg(self, msg: str, title="课程提醒"):
-        asyncio.run(dingTalkHandler.sendCorporationMarkdownMsg([self.userId], title=title, text=msg))
-
-    def sendBulletin(self, operation_userid: str, title: str, content: str,
-                     author: str = "辣橙", is_private: bool = True, use_ding: bool = True, push_top: bool = False):
-        asyncio.run(dingTalkHandler.sendTextBulletin(operation_userid, [self.userId], title, content,
-                                                     author, is_private, use_ding, push_top))
+    async def sendBulletin(self, operation_userid: str, title: str, content: str,
+                           author: str = "辣橙", is_private: bool = True, use_ding: bool = True, push_top: bool = False):
+        await dingTalkHandler.sendTextBulletin(operation_userid, [self.userId], title, content, author, is_private, use_ding, push_top)
 
 
 class SillageDingtalkHandler:
-    def __init__(self):
-        self.users: List[UserHandler] = self.getUsers()
-        self.scheduler = BlockingScheduler()
+    def __init__(self, snapshotFileName: str = "snapshot.json", outboxFileName: str = "outbox.db", daemon: bool = False,
+                 coordinator: Optional[ShardCoordinator] = None, sharedSnapshotFileName: str = "snapshot.shared.json", metricsPort: int = 0,
+                 traceFileName: str = "trace.json"):
+        self.daemon = daemon  # 常驻运行，每天定时发送；否则发送完明天的课程后退出，由外部定时重新启动
+        self.stopping = False
+        # 分片运行时，各进程只负责一致性哈希划分给自己的用户；主进程获取课程与订阅后写入共享快照，其他进程从中读取
+        self.coordinator = coordinator
+        self.baseOutboxFileName = outboxFileName
+        if coordinator is not None:
+            snapshotFileName = self.workerFileName(snapshotFileName, coordinator.workerId)
+            outboxFileName = self.workerFileName(outboxFileName, coordinator.workerId)
+            traceFileName = self.workerFileName(traceFileName, coordinator.workerId)
+        self.traceFileName = traceFileName  # 启用追踪时，每天与退出时把 span 导出为 trace.{时间}.json
+        self.sharedSnapshotStore = SnapshotStore(sharedSnapshotFileName) if coordinator is not None else None
+        self.sharedVersion: Optional[str] = None
+        self.allUsers: List[UserHandler] = []  # 全部订阅用户
+        self.users: List[UserHandler] = []  # 本进程负责的用户
+        # 课程或用户每次刷新后加一；预先计算的消息与日程带有计算时的版本号，版本号变化后失效
+        self.generation = 0
+        self.precomputed: Dict[Tuple, Tuple[int, Any]] = {}
+        self.scheduler = AsyncIOScheduler()
+        self.stopped = asyncio.Event()
+        self.snapshotStore = SnapshotStore(snapshotFileName)
+        # 消息与日程操作先写入发件箱，由后台任务发送，失败时自动重试；已创建日程的记录也保存在发件箱的数据库中
+        self.outbox = Outbox(outboxFileName)
+        self.calendarSync = CalendarSync(dingTalkHandler, self.outbox)
+        self.outboxWorker = OutboxWorker(self.outbox, {"markdownMsg": self.sendMarkdownMsg, CalendarSync.outboxKind: self.calendarSync.runOperation})
+        self.formSync = FormSync(dingTalkHandler)
+        # 每节课前的提醒，每次刷新后重新排期
+        self.lessonReminders = LessonReminders(self.renderDigestsOfLessonNums, self.dispatchDigests, self.remindTimeOfLesson)
+        # 在本机的 metricsPort 端口提供 /metrics（Prometheus）与 /metrics.json；为 0 时不启动
+        self.metricsServer = MetricsServer(port=metricsPort) if metricsPort else None
+        self.registerGauges()
+
+    def registerGauges(self):
+        """读取指标时才计算的当前值"""
+        registry.gauge("sillage_courses", "课程数").setFunction(lambda: len(apiHandler.courses))
+        subscribers = registry.gauge("sillage_subscribers", "订阅用户数，scope 为 all（全部）或 shard（本进程负责的）", ["scope"])
+        subscribers.labels("all").setFunction(lambda: len(self.allUsers))
+        subscribers.labels("shard").setFunction(lambda: len(self.users))
+        registry.gauge("sillage_generation", "课程与用户的刷新次数").setFunction(lambda: self.generation)
+        outboxRecords = registry.gauge("sillage_outbox_records", "发件箱中各状态的记录数", ["status"])
+        for status in (PENDING, IN_FLIGHT, DONE, FAILED):
+            outboxRecords.labels(status).setFunction(partial(lambda status: self.outbox.counts().get(status, 0), status))
+        registry.gauge("sillage_lesson_reminders_scheduled", "时间轮中已排期的课前提醒时段数").setFunction(lambda: len(self.lessonReminders.wheel))
+
+    @staticmethod
+    def workerFileName(fileName: str, workerId: str) -> str:
+        """snapshot.json -> snapshot.{workerId}.json"""
+        root, ext = os.path.splitext(fileName)
+        return f"{root}.{workerId}{ext}"
 
     @staticmethod
     def fillHourMin(hour, minute, date: datetime.date = None):
@@ -74,29 +157,101 @@ class SillageDingtalkHandler:
         else:
             return self.fillHourMin(18, 30, date), self.fillHourMin(20, 5, date), 80  # 18:30 - 17:10
 
-    @staticmethod
-    def getUsers() -> List[UserHandler]:
-        userTupleList = dingTalkHandler.getSillageUserAndUrlList()
-        # 生成UserHandler的实例列表，并过滤掉unionId获取失败的实例
-        return [user for user in [UserHandler(userTuple[0].submitterUserId, userTuple[1]) for userTuple in userTupleList] if user.unionId]
-
-    def refreshUsers(self):
-        self.users: List[UserHandler] = self.getUsers()
-
-    def start(self):
-        self.scheduler.add_job(self.refreshRemoteData, 'interval', hours=1)  # 每隔一个小时，刷新一次远端数据
-        self.scheduler.add_job(self.goodMorning, "date", next_run_time=self.fillHourMin(6, 0), misfire_grace_time=600)
-        # self.scheduler.add_job(partial(self.sendCoursesOfLessonNum, 1), "date", next_run_time=self.fillHourMin(7, 30), misfire_grace_time=600)
-        # self.scheduler.add_job(partial(self.sendCoursesOfLessonNum, 2), "date", next_run_time=self.fillHourMin(9, 35), misfire_grace_time=600)
-        # self.scheduler.add_job(partial(self.sendCoursesOfLessonNum, 3), "date", next_run_time=self.fillHourMin(11, 40), misfire_grace_time=600)
-        # self.scheduler.add_job(partial(self.sendCoursesOfLessonNum, 4), 'date', next_run_time=self.fillHourMin(15, 5), misfire_grace_time=600)
-        # self.scheduler.add_job(partial(self.sendCoursesOfLessonNum, 5), 'date', next_run_time=self.fillHourMin(17, 10), misfire_grace_time=600)
-        self.scheduler.add_job(self.goodNight, "date", next_run_time=self.fillHourMin(17, 10), misfire_grace_time=600)
+    def remindTimeOfLesson(self, date: str, lessonNum: int) -> datetime.datetime:
+        startTime, _, remindMin = self.getDateTimeOfLesson(lessonNum, datetime.datetime.strptime(date, "%Y-%m-%d").date())
+        return startTime - datetime.timedelta(minutes=remindMin)
+
+    async def getUsers(self) -> List[UserHandler]:
+        await self.formSync.sync()  # 只获取新增或修改过的表单提交记录
+        userTupleList = self.formSync.getSubscribedUrls()
+        # 订阅网址未变化的用户直接复用，无需重新编译订阅
+        knownUsers: Dict[Tuple[str, str], UserHandler] = {(user.userId, user.subscribedUrl): user for user in self.allUsers}
+        users = [knownUsers.get(userTuple) or UserHandler(*userTuple) for userTuple in userTupleList]
+        users = [user for user in users if user.subscription is not None]  # 过滤掉订阅网址解析失败的实例
+        # 批量获取unionId，只查询之前未见过的用户
+        unionIds = await dingTalkHandler.getUnionIdsOfUserIds([user.userId for user in users])
+        for user in users:
+            user.unionId = unionIds.get(user.userId, "")
+        # 过滤掉unionId获取失败的实例
+        return [user for user in users if user.unionId]
+
+    async def refreshUsers(self):
+        self.allUsers = await self.getUsers()
+        self.assignShard()
+
+    def assignShard(self):
+        """从全部用户中选出本进程负责的用户"""
+        if self.coordinator is None:
+            self.users = self.allUsers
+        else:
+            self.users = [user for user in self.allUsers if self.coordinator.owns(user.userId)]
+
+    def loadSnapshot(self) -> bool:
+        """从本地快照恢复课程与用户，返回是否恢复成功"""
+        apiHandler.loadSnapshot(self.snapshotStore.get("course", {}))
+        # 通讯录、unionId 与表单同步状态已移至 SettingsStore，迁移旧版快照中的这两部分后将其丢弃
+        dingTalkHandler.loadSnapshot(self.snapshotStore.pop("dingtalk", {}))
+        self.allUsers = [UserHandler.fromSnapshot(user) for user in self.snapshotStore.get("users", [])]
+        self.assignShard()
+        self.calendarSync.merge(self.snapshotStore.pop("calendar", []))  # 日程记录已移至发件箱的数据库，迁移旧版快照中的记录
+        self.formSync.loadSnapshot(self.snapshotStore.pop("forms", {}))
+        self.generation += 1
+        return bool(len(apiHandler.courseDecorator.value) and self.allUsers)
+
+    def saveSnapshot(self):
+        self.snapshotStore.set("course", apiHandler.toSnapshot())
+        self.snapshotStore.set("users", [user.toSnapshot() for user in self.allUsers])
+        self.snapshotStore.save()
+
+    async def start(self):
+        if self.metricsServer is not None:
+            await self.metricsServer.start()
+        self.outboxWorker.start()  # 先发送上次退出时未发送完的记录
+        if self.daemon:
+            self.handleSignals()
+            # 课前提醒只在常驻运行时发送；不常驻运行时进程在晚间推送后即退出，由外部定时重新启动
+            self.lessonReminders.start()
+        restored = self.loadSnapshot()
+        if self.coordinator is not None:
+            await self.heartbeat()  # 先确定分片成员与主进程
+            self.scheduler.add_job(self.heartbeat, "interval", seconds=self.coordinator.ttl / 3)
+        if restored:
+            if self.daemon:
+                self.lessonReminders.reschedule(self.users)
+            # 已从快照恢复，立即在后台刷新远端数据，之后每隔一个小时刷新一次
+            self.scheduler.add_job(self.refreshRemoteData, 'interval', hours=1, next_run_time=datetime.datetime.now())
+        else:
+            await self.refreshRemoteData()
+            self.scheduler.add_job(self.refreshRemoteData, 'interval', hours=1)  # 每隔一个小时，刷新一次远端数据
+        # 通讯录在后台获取，失败时一小时后重试
+        self.scheduler.add_job(self.crawlAddressBook, 'interval', hours=1, next_run_time=datetime.datetime.now())
+        if self.daemon:
+            self.scheduler.add_job(self.goodMorning, "cron", hour=MORNING[0], minute=MORNING[1], misfire_grace_time=600, coalesce=True)
+            self.scheduler.add_job(self.goodNight, "cron", hour=NIGHT[0], minute=NIGHT[1], misfire_grace_time=600, coalesce=True)
+            self.scheduler.add_job(self.dailyMaintenance, "cron", hour=4, minute=0, misfire_grace_time=3600, coalesce=True)
+        else:
+            self.scheduler.add_job(self.goodMorning, "date", next_run_time=self.fillHourMin(*MORNING), misfire_grace_time=600)
+            self.scheduler.add_job(self.goodNight, "date", next_run_time=self.fillHourMin(*NIGHT), misfire_grace_time=600)
+        # 常驻运行时，每节课前的提醒由 lessonReminders 按时间轮发送
 
         self.scheduler.start()
+        await self.stopped.wait()
 
-    def test(self):
-        user: List[UserHandler] = [UserHandler("012343574120303762772", "https://course.siae.top/#/course/?grade=20%E7%BA%A7&group=["
+    def handleSignals(self):
+        """常驻运行时，收到 SIGINT / SIGTERM 后发送完发件箱中的记录再退出"""
+        loop = asyncio.get_running_loop()
+        for signalNum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signalNum, lambda: asyncio.create_task(self.shutdown()))
+            except NotImplementedError:
+                pass  # Windows 的事件循环不支持
+
+    async def test(self):
+        self.outboxWorker.start()
+        await dingTalkHandler.refreshAccessToken()
+        if not self.loadSnapshot():
+            await apiHandler.refreshCourses()
+        user: List[UserHandler] = [await UserHandler.create("012343574120303762772", "https://course.siae.top/#/course/?grade=20%E7%BA%A7&group=["
                                                                         "%2220%E7%BA%A7%22,%22A%E7%8F%AD%22]&group=[%2220%E7%BA%A7%22,%22PC%22]")]
         self.scheduler.add_job(partial(self.goodMorning, sendDateTime=True, users=user), "date",
                                next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=3))
@@ -114,87 +269,432 @@ class SillageDingtalkHandler:
                                next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=9))
 
         self.scheduler.start()
+        await self.stopped.wait()
 
-    def shutdown(self):
+    async def shutdown(self):
+        if self.stopping:
+            return
+        self.stopping = True
         self.scheduler.shutdown(wait=False)
+        await self.lessonReminders.close()
+        if self.metricsServer is not None:
+            await self.metricsServer.close()
+        self.exportTrace()
+        if self.coordinator is not None:
+            self.coordinator.leave()
+        # 退出前发送完发件箱中已到期的记录，仍需重试的记录留待下次启动
+        await self.outboxWorker.close()
+        self.outbox.purge(time.time() - 7 * 24 * 3600)
+        self.outbox.close()
+        # 关闭长连接
+        await apiHandler.aclose()
+        await dingTalkHandler.aclose()
+        self.stopped.set()
+
+    @instrument(jobSeconds, jobRuns, "refreshRemoteData")
+    @traced("refreshRemoteData")
+    async def refreshRemoteData(self):
+        """刷新AccessToken、重新获取课程、重新获取订阅用户列表，并保存快照"""
+        if self.coordinator is not None and not self.coordinator.isLeader:
+            await self.loadSharedSnapshot()  # 只有主进程访问远端，其他进程读取它发布的数据
+            return
+        await dingTalkHandler.refreshAccessToken()
+        courseDiff = await apiHandler.refreshCourses()
+        await self.refreshUsers()
+        if self.coordinator is not None:
+            self.publishSharedSnapshot()
+        await self.afterRefresh(courseDiff)
+
+    @logger.catch
+    @instrument(jobSeconds, jobRuns, "crawlAddressBook")
+    @traced("crawlAddressBook")
+    async def crawlAddressBook(self):
+        """
+        通讯录尚未获取完成时获取通讯录（中断后从检查点继续）；作为单独的任务运行，
+        首次获取耗时较长时不会使每小时的刷新被跳过。已获取完成时直接返回
+        """
+        if self.coordinator is not None and not self.coordinator.isLeader:
+            return  # 通讯录保存在共用的 settings.db 中，只由主进程获取
+        await dingTalkHandler.ensureAddressBook()
+
+    def precomputedOf(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        """取出当前版本下预先计算好的结果，没有时立即计算并保存"""
+        entry = self.precomputed.get(key)
+        if entry is None or entry[0] != self.generation:
+            cacheRequests.labels("precomputed", "miss").inc()
+            entry = self.precomputed[key] = (self.generation, compute())
+        else:
+            cacheRequests.labels("precomputed", "hit").inc()
+        return entry[1]
 
-    def refreshRemoteData(self):
-        """刷新AccessToken、重新获取课程、重新获取订阅用户列表"""
-        dingTalkHandler.accessToken = dingTalkHandler.getAccessToken()
-        apiHandler.refreshCourses()
-        self.refreshUsers()
+    @logger.catch
+    @instrument(jobSeconds, jobRuns, "precomputeNextDigests")
+    @traced("precomputeNextDigests")
+    def precomputeNextDigests(self):
+        """
+        每次刷新后预先渲染下一次早间、晚间推送的消息与明天的日程，
+        到了发送时间只需写入发件箱，耗时不随用户数增长
+        """
+        startTime = time.perf_counter()
+        now = datetime.datetime.now()
+        self.precomputed = {key: entry for key, entry in self.precomputed.items() if entry[0] == self.generation}
+        morningDate = now.date() if now < self.fillHourMin(*MORNING) else now.date() + datetime.timedelta(days=1)
+        nightDate = now.date() if now < self.fillHourMin(*NIGHT) else now.date() + datetime.timedelta(days=1)
+        morningDateStr = morningDate.strftime("%Y-%m-%d")
+        tomorrowDateStr = (nightDate + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        self.digestsOfDate(morningDateStr, f"今天({morningDateStr})", ADDITION)
+        self.digestsOfDate(tomorrowDateStr, f"明天({tomorrowDateStr})", ADDITION)
+        self.calendarPlansOfDate(tomorrowDateStr)
+        logger.info(f"预先计算{morningDateStr}早间与{tomorrowDateStr}晚间的消息和日程，耗时{time.perf_counter() - startTime:.3f}秒")
 
     @logger.catch
-    def goodMorning(self, addition: str = "更多信息: course.siae.top", sendDateTime: bool = False, users: List[UserHandler] = None):
+    @instrument(jobSeconds, jobRuns, "dailyMaintenance")
+    async def dailyMaintenance(self):
+        """常驻运行时每天清理：发件箱中一周前已发送或已放弃的记录、已过去的日程记录；并导出前一天的 span"""
+        self.exportTrace()
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        purged = self.outbox.purge(time.time() - 7 * 24 * 3600)
+        self.calendarSync.prune(today)
+        logger.info(f"清理发件箱中{purged}条已发送或已放弃的记录")
+
+    async def afterRefresh(self, courseDiff: CourseDiff):
+        """课程或用户刷新后：保存快照、（常驻运行时）重新排期课前提醒、通知课程变化、预先计算下一次推送"""
+        self.generation += 1
+        self.saveSnapshot()
+        if self.daemon:
+            counts = self.lessonReminders.reschedule(self.users, courseDiff)
+            logger.info(f"重新排期课前提醒: {counts}")
+        if courseDiff:
+            await self.notifyCourseChanges(courseDiff)
+        self.precomputeNextDigests()
+
+    def publishSharedSnapshot(self):
+        """主进程：把课程与全部用户写入共享快照，再发布新的版本号"""
+        self.sharedSnapshotStore.set("course", apiHandler.toSnapshot())
+        self.sharedSnapshotStore.set("users", [user.toSnapshot() for user in self.allUsers])
+        self.sharedSnapshotStore.save()
+        self.sharedVersion = str(time.time_ns())
+        self.coordinator.store.publish("snapshot", self.sharedVersion)
+
+    async def loadSharedSnapshot(self):
+        """其他进程：主进程发布了新的版本时，读取共享快照"""
+        version = self.coordinator.store.published("snapshot")
+        if version is None or version == self.sharedVersion:
+            return
+        sections = self.sharedSnapshotStore.load()
+        previousCourses = apiHandler.courses
+        apiHandler.loadSnapshot(sections.get("course", {}))
+        courseDiff = diffCourseSets(previousCourses, apiHandler.courses) if previousCourses else CourseDiff.empty()
+        self.allUsers = [UserHandler.fromSnapshot(user) for user in sections.get("users", [])]
+        self.assignShard()
+        self.sharedVersion = version
+        logger.info(f"读取主进程发布的数据：{len(apiHandler.courses)}门课程，{len(self.allUsers)}位用户，本进程负责{len(self.users)}位")
+        await self.afterRefresh(courseDiff)
+
+    @logger.catch
+    @instrument(jobSeconds, jobRuns, "heartbeat")
+    async def heartbeat(self):
+        """分片运行时定期调用：成员变化时重新划分用户，主进程退出后接管，其他进程检查主进程发布的数据"""
+        wasLeader = self.coordinator.isLeader
+        joined, departed = self.coordinator.heartbeat()
+        if joined or departed:
+            # 各进程平分钉钉接口的调用额度
+            dingTalkHandler.rateLimiter.setShare(1 / max(len(self.coordinator.workers), 1))
+            previousUserIds = {user.userId for user in self.users}
+            self.assignShard()
+            gainedUsers = [user for user in self.users if user.userId not in previousUserIds]
+            self.adoptCalendarRecords(gainedUsers, (set(self.coordinator.workers) | departed) - {self.coordinator.workerId})
+            self.generation += 1
+            counts = self.lessonReminders.reschedule(self.users, CourseDiff.empty())
+            logger.info(f"本进程负责{len(self.users)}位用户（接管{len(gainedUsers)}位），重新排期课前提醒: {counts}")
+            self.precomputeNextDigests()
+        if self.coordinator.isLeader:
+            if not wasLeader and self.scheduler.running:
+                self.scheduler.add_job(self.refreshRemoteData)  # 接管主进程后立即刷新并发布
+        else:
+            await self.loadSharedSnapshot()
+
+    def adoptCalendarRecords(self, users: List[UserHandler], workerIds: Set[str]):
+        """接管用户时，从其他进程（同一主机）的发件箱数据库中合并这些用户的日程记录，避免重复创建日程"""
+        unionIds = {user.unionId for user in users}
+        if not unionIds:
+            return
+        adopted = 0
+        for workerId in workerIds:
+            fileName = self.workerFileName(self.baseOutboxFileName, workerId)
+            if os.path.exists(fileName):
+                adopted += self.calendarSync.adopt(fileName, unionIds)
+        if adopted:
+            logger.info(f"从其他进程的发件箱数据库中合并{adopted}条日程记录")
+
+    @logger.catch
+    @instrument(jobSeconds, jobRuns, "goodMorning")
+    @traced("goodMorning")
+    async def goodMorning(self, addition: str = ADDITION, sendDateTime: bool = False, users: List[UserHandler] = None):
+        jobUsers.labels("goodMorning").set(len(users or self.users))
         todayDate = datetime.date.today().strftime("%Y-%m-%d")
-        self.sendCourseOfDate(todayDate, dateDescription=f"今天({todayDate})", sendDateTime=sendDateTime, addition=addition, users=users)
+        await self.sendCourseOfDate(todayDate, dateDescription=f"今天({todayDate})", sendDateTime=sendDateTime, addition=addition, users=users)
 
     @logger.catch
-    def goodNight(self, addition: str = "更多信息: course.siae.top", sendDateTime: bool = False, users: List[UserHandler] = None):
+    @instrument(jobSeconds, jobRuns, "goodNight")
+    @traced("goodNight")
+    async def goodNight(self, addition: str = ADDITION, sendDateTime: bool = False, users: List[UserHandler] = None):
+        jobUsers.labels("goodNight").set(len(users or self.users))
         tomorrowDate = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-        self.sendCourseOfDate(tomorrowDate, f"明天({tomorrowDate})", sendDateTime=sendDateTime, addition=addition, users=users)
-        self.createCalendarForAllUsers(tomorrowDate, users=users)
-        self.shutdown()
+        await self.sendCourseOfDate(tomorrowDate, f"明天({tomorrowDate})", sendDateTime=sendDateTime, addition=addition, users=users)
+        await self.createCalendarForAllUsers(tomorrowDate, users=users)
+        if not self.daemon:
+            await self.shutdown()
 
     @logger.catch
-    def sendCoursesOfLessonNum(self, lessonNum: int, date: str = "", addition: str = "", sendDateTime: bool = False, users: List[UserHandler] = None):
+    async def sendCoursesOfLessonNum(self, lessonNum: int, date: str = "", addition: str = "", sendDateTime: bool = False, users: List[UserHandler] = None):
         if not date:
             date = datetime.date.today().strftime("%Y-%m-%d")  # 默认为今天
 
         if not users:
             users = self.users
 
-        for user in users:
-            courseDecoratorOfThisLessonNum = user.getCourseDecorator().filter_of_date(date).filter_of_lesson_num(lessonNum)
-            if len(courseDecoratorOfThisLessonNum.value):
-                msg = f"{str(courseDecoratorOfThisLessonNum).strip()}"
-                msg += f"\n\n{'-' * 8}\n\n{addition}" if addition else ""
-                msg += f"\n\n{'-' * 8}\n\n{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}" if sendDateTime else ""
+        recipientsOfDigest = self.renderDigestsOfLessonNums(date, [lessonNum], users, addition, sendDateTime)[lessonNum]
+        self.dispatchDigests(recipientsOfDigest, f"lesson:{date}:{lessonNum}")  # 发送企业工作消息
 
-                title = courseDecoratorOfThisLessonNum.get_title()
+    @classmethod
+    def renderDigestsOfLessonNums(cls, date: str, lessonNums: List[int], users: List[UserHandler], addition: str = "",
+                                  sendDateTime: bool = False) -> Dict[int, Dict[Digest, List[str]]]:
+        """渲染 date 当天各节课的消息，同一天只计算一次课程匹配"""
+        def renderOf(lessonNum: int) -> Callable[[CourseDecorator], Optional[Digest]]:
+            def render(courseDecoratorOfThisDate: CourseDecorator) -> Optional[Digest]:
+                courseDecoratorOfThisLessonNum = courseDecoratorOfThisDate.filter_of_lesson_num(lessonNum)
+                if len(courseDecoratorOfThisLessonNum.value):
+                    msg = f"{str(courseDecoratorOfThisLessonNum).strip()}"
+                    msg += f"\n\n{'-' * 8}\n\n{addition}" if addition else ""
+                    msg += f"\n\n{'-' * 8}\n\n{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}" if sendDateTime else ""
 
-                user.sendCorporationMsg(msg, title=title)  # 发送企业工作消息
+                    title = courseDecoratorOfThisLessonNum.get_title()
+                    return title, msg
 
-                # operation_userid = users[0].userId  # 默认：第一个填表单的是一个可以发布公告的人
-                # user.sendBulletin(operation_userid, title, msg)  # 发布公告
+            return render
 
-    @logger.catch
-    def sendCourseOfDate(self, date: str, dateDescription: str = "今天：", addition: str = "", sendDateTime: bool = False,
-                         users: List[UserHandler] = None):
-        if not users:
-            users = self.users
+        coursesOfSubscription = cls.coursesOfUsers(users, date)
+        return {lessonNum: cls.renderDigests(users, date, renderOf(lessonNum), coursesOfSubscription) for lessonNum in lessonNums}
 
-        for user in users:
-            courseDecoratorOfThisDate = user.getCourseDecorator().filter_of_date(date)
+    @logger.catch
+    @traced("sendCourseOfDate")
+    async def sendCourseOfDate(self, date: str, dateDescription: str = "今天：", addition: str = "", sendDateTime: bool = False,
+                               users: List[UserHandler] = None):
+        recipientsOfDigest = self.digestsOfDate(date, dateDescription, addition, sendDateTime, users)
+        self.dispatchDigests(recipientsOfDigest, f"date:{date}")  # 发送企业工作消息
+
+    def digestsOfDate(self, date: str, dateDescription: str, addition: str = "", sendDateTime: bool = False,
+                      users: List[UserHandler] = None) -> Dict[Digest, List[str]]:
+        """渲染 date 当天课程的消息；面向全部用户且不含发送时间时，使用预先计算的结果"""
+        if users or sendDateTime:
+            return self.renderDigestsOfDate(date, dateDescription, addition, sendDateTime, users or self.users)
+        return self.precomputedOf(("date", date, dateDescription, addition),
+                                partial(self.renderDigestsOfDate, date, dateDescription, addition, sendDateTime, self.users))
+
+    def renderDigestsOfDate(self, date: str, dateDescription: str, addition: str, sendDateTime: bool,
+                            users: List[UserHandler]) -> Dict[Digest, List[str]]:
+        def render(courseDecoratorOfThisDate: CourseDecorator) -> Optional[Digest]:
             if len(courseDecoratorOfThisDate.value):
                 msg = f"{dateDescription}\n\n{str(courseDecoratorOfThisDate).strip()}"
                 msg += f"\n\n{'-' * 8}\n\n{addition}" if addition else ""
                 msg += f"\n\n{'-' * 8}\n\n{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}" if sendDateTime else ""
 
                 title = f"{dateDescription}有{len(courseDecoratorOfThisDate.value)}节课"
+                return title, msg
 
-                user.sendCorporationMsg(msg, title=title)  # 发送企业工作消息
+        return self.renderDigests(users, date, render)
 
-    @logger.catch
-    def createCalendarForAllUsers(self, date: str, users: List[UserHandler] = None):
-        if not users:
-            users = self.users
+    @staticmethod
+    def coursesOfUsers(users: List[UserHandler], date: str) -> Dict[CompiledSubscription, CourseDecorator]:
+        """一次性计算各用户的订阅在 date 当天的课程（相同的订阅只计算一次）"""
+        subscriptions = list(dict.fromkeys(user.subscription for user in users))
+        with span("coursesOfUsers", date=date, users=len(users), subscriptions=len(subscriptions)):
+            return dict(zip(subscriptions, apiHandler.matchSubscriptions(subscriptions, date)))
+
+    @classmethod
+    def renderDigests(cls, users: List[UserHandler], date: str, render: Callable[[CourseDecorator], Optional[Digest]],
+                      coursesOfSubscription: Optional[Dict[CompiledSubscription, CourseDecorator]] = None) -> Dict[Digest, List[str]]:
+        """
+        按订阅条件对用户分组，每种订阅只渲染一次消息；再按渲染结果合并接收人，
+        返回 (标题, 内容) -> 接收人userId列表。没有课程的用户不会出现在结果中。\n
+        :param render: 参数为该订阅在 date 当天的课程
+        :param coursesOfSubscription: 已经算好的 coursesOfUsers(users, date)，多次渲染同一天时复用
+        """
+        usersOfSubscription: Dict[CompiledSubscription, List[UserHandler]] = {}
+        for user in users:
+            usersOfSubscription.setdefault(user.subscription, []).append(user)
+
+        if coursesOfSubscription is None:
+            coursesOfSubscription = cls.coursesOfUsers(users, date)
+        recipientsOfDigest: Dict[Digest, List[str]] = {}
+        with span("renderDigests", date=date, users=len(users), subscriptions=len(usersOfSubscription)):
+            for subscription, usersOfThisSubscription in usersOfSubscription.items():
+                digest = render(coursesOfSubscription[subscription])
+                if digest:
+                    recipientsOfDigest.setdefault(digest, []).extend(user.userId for user in usersOfThisSubscription)
+        return recipientsOfDigest
+
+    def dispatchDigests(self, recipientsOfDigest: Dict[Digest, List[str]], keyPrefix: str):
+        """
+        将每条不同的消息写入发件箱（接收人过多时按接口上限分为多条），由后台任务并发发送\n
+        :param keyPrefix: 幂等键的前缀，如任务名与日期；同一任务重复执行时不会重复发送
+        """
+        maxLength = dingTalkHandler.maxUserIdListLength
+        entries = []
+        for (title, msg), userIdList in recipientsOfDigest.items():
+            for i in range(0, len(userIdList), maxLength):
+                payload = {"userIdList": userIdList[i:i + maxLength], "title": title, "text": msg}
+                digestHash = hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+                entries.append(("markdownMsg", payload, f"markdownMsg:{keyPrefix}:{digestHash}"))
+        enqueued = self.outbox.enqueueMany(entries)  # 同一个事务中写入
+        self.outboxWorker.notify()
+        kind = keyPrefix.split(":")[0]
+        digestMessages.labels(kind, "enqueued").inc(enqueued)
+        digestMessages.labels(kind, "skipped").inc(len(entries) - enqueued)
+        digestRecipients.labels(kind).inc(sum(len(entry[1]["userIdList"]) for entry in entries))
+
+    def exportTrace(self):
+        """把已记录的 span 导出为 Chrome trace JSON 并清空"""
+        if tracer.spans:
+            root, ext = os.path.splitext(self.traceFileName)
+            tracer.export(f"{root}.{datetime.datetime.now():%Y%m%d-%H%M%S}{ext}", clear=True)
+
+    @staticmethod
+    async def sendMarkdownMsg(payload: Dict):
+        await dingTalkHandler.sendCorporationMarkdownMsg(payload["userIdList"], title=payload["title"], text=payload["text"])
 
+        # operation_userid = self.users[0].userId  # 默认：第一个填表单的是一个可以发布公告的人
+        # await asyncio.gather(*[dingTalkHandler.sendTextBulletin(operation_userid, userIdList, title, msg)
+        #                        for (title, msg), userIdList in recipientsOfDigest.items()])  # 发布公告
+
+    @logger.catch
+    @traced("createCalendarForAllUsers")
+    async def createCalendarForAllUsers(self, date: str, users: List[UserHandler] = None):
+        plans = self.calendarPlansOfDate(date, users)
+        users = users or self.users
+
+        # 只创建、更新或删除有变化的日程（写入发件箱，日程id在执行后与发件箱记录在同一个事务中保存）
+        counts = await self.calendarSync.sync(date, [user.unionId for user in users], plans)
+        self.outboxWorker.notify()
+        logger.info(f"同步{date}的日程: {counts}")
+        self.calendarSync.prune(datetime.date.today().strftime("%Y-%m-%d"))
+
+    def calendarPlansOfDate(self, date: str, users: List[UserHandler] = None) -> List[CalendarEventPlan]:
+        """各用户在 date 当天每个有课时段的日程；面向全部用户时，使用预先计算的结果"""
+        if users:
+            return self.planCalendar(date, users)
+        return self.precomputedOf(("calendar", date), partial(self.planCalendar, date, self.users))
+
+    def planCalendar(self, date: str, users: List[UserHandler]) -> List[CalendarEventPlan]:
+        plans: List[CalendarEventPlan] = []
+        coursesOfSubscription = self.coursesOfUsers(users, date)
         for user in users:
-            courseDecoratorOfThisDate = user.getCourseDecorator().filter_of_date(date)
-            # 逐个添加日程
+            courseDecoratorOfThisDate = coursesOfSubscription[user.subscription]
             for lessonNum in range(1, 6):
                 courseDecoratorOfThisLessonNum = courseDecoratorOfThisDate.filter_of_lesson_num(lessonNum)
-                startTime, endTime, remindMin = self.getDateTimeOfLesson(lessonNum, datetime.datetime.strptime(date, "%Y-%m-%d").date())  # 创建日程
-                asyncio.run(dingTalkHandler.createCalendar(courseDecoratorOfThisLessonNum.get_title(), str(courseDecoratorOfThisLessonNum),
-                                                           [user.unionId], startTime, endTime, remindMin))
+                if not len(courseDecoratorOfThisLessonNum.value):
+                    continue  # 只为有课程的时段创建日程
+                startTime, endTime, remindMin = self.getDateTimeOfLesson(lessonNum, datetime.datetime.strptime(date, "%Y-%m-%d").date())
+                plans.append(CalendarEventPlan(user.unionId, date, lessonNum, courseDecoratorOfThisLessonNum.get_title(),
+                                               str(courseDecoratorOfThisLessonNum), startTime, endTime, remindMin))
+        return plans
+
+    @staticmethod
+    def renderCourseChange(kind: str, course: CompactCourse, dates: List[str]) -> str:
+        dateStr = "、".join(dates[:5]) + (f" 等{len(dates)}天" if len(dates) > 5 else "")
+        return f"**{kind}** 第 {course.lessonNum} 节课（{dateStr}）\n\n{apiHandler.courseRenderer.fragmentOf(course)}"
+
+    @logger.catch
+    @instrument(jobSeconds, jobRuns, "notifyCourseChanges")
+    @traced("notifyCourseChanges")
+    async def notifyCourseChanges(self, courseDiff: CourseDiff):
+        """
+        通过反向索引找出受课程变化影响的用户，每人推送一条“课程变更”通知，并只为他们更新已同步过的日程。
+        开销与变化的课程数成正比；只关心今天及以后的上课日期。
+        """
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        usersOfSubscription: Dict[CompiledSubscription, List[UserHandler]] = {}
+        for user in self.users:
+            usersOfSubscription.setdefault(user.subscription, []).append(user)
+        subscriptionIndex = SubscriptionIndex(usersOfSubscription)
+
+        changes = [("新增", None, course) for course in courseDiff.added] + \
+                  [("取消", course, None) for course in courseDiff.removed] + \
+                  [("调整", old, new) for old, new in courseDiff.changed]
+        changesOfSubscription: Dict[CompiledSubscription, List[str]] = {}
+        datesOfSubscription: Dict[CompiledSubscription, Set[str]] = {}
+        for kind, old, new in changes:
+            versions = [course for course in (old, new) if course is not None]
+            dates = sorted({date for course in versions for date in course.dates if date >= today})
+            if not dates:
+                continue
+            subscriptions = set().union(*[subscriptionIndex.subscriptionsOf(course) for course in versions])
+            changeStr = self.renderCourseChange(kind, new or old, dates)
+            for subscription in subscriptions:
+                changesOfSubscription.setdefault(subscription, []).append(changeStr)
+                datesOfSubscription.setdefault(subscription, set()).update(dates)
+
+        recipientsOfDigest: Dict[Digest, List[str]] = {}
+        for subscription, changeStrList in changesOfSubscription.items():
+            digest = ("课程变更", "# 课程变更\n\n" + "\n\n---\n\n".join(changeStrList))
+            recipientsOfDigest.setdefault(digest, []).extend(user.userId for user in usersOfSubscription[subscription])
+        logger.info(f"课程变化{len(courseDiff)}门，通知{sum(map(len, recipientsOfDigest.values()))}位用户")
+        self.dispatchDigests(recipientsOfDigest, f"courseChange:{apiHandler.watermark}")
+
+        # 只为受影响的用户重新同步已经创建过日程的日期
+        syncedDates = self.calendarSync.dates()
+        usersOfDate: Dict[str, List[UserHandler]] = {}
+        for subscription, dates in datesOfSubscription.items():
+            for date in dates & syncedDates:
+                usersOfDate.setdefault(date, []).extend(usersOfSubscription[subscription])
+        for date, users in sorted(usersOfDate.items()):
+            await self.createCalendarForAllUsers(date, users=users)
 
     @staticmethod
     def urlStrip(url: str):
-        return re.sub(r"https?://[a-z]+\.siae.top/#/", "", url)
+        return urlStrip(url)
+
+
+def runWorker(workerId: str, leaseFileName: str, metricsPort: int = 0, traceSampleRate: float = 0.0, profileJobs: List[str] = ()):
+    """以分片模式运行一个工作进程"""
+    tracer.configure(traceSampleRate, profileJobs)
+    coordinator = ShardCoordinator(SqliteLeaseStore(leaseFileName), workerId)
+    asyncio.run(SillageDingtalkHandler(daemon=True, coordinator=coordinator, metricsPort=metricsPort).start())
 
 
 if __name__ == '__main__':
-    mainHandler = SillageDingtalkHandler()
-    # mainHandler.test()
-    mainHandler.start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=0, help="在本机启动多个分片工作进程")
+    parser.add_argument("--worker-id", help="作为分片工作进程运行（可在多台主机上分别启动）")
+    parser.add_argument("--lease", default="shards.db", help="分片协调使用的 SQLite 文件")
+    parser.add_argument("--metrics-port", type=int, default=0, help="在本机提供指标的端口（如 9464），默认为 0，表示不提供；--workers 时各进程依次使用之后的端口")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.0, help="追踪的采样率（0~1），0 表示不追踪")
+    parser.add_argument("--profile-job", action="append", default=[], help="用 cProfile 分析该任务（如 goodNight）的下一次运行，可指定多次")
+    parser.add_argument("--once", "--no-daemon", action="store_true", help="不常驻运行：发送完明天的课程后退出，由外部定时重新启动；不发送课前提醒，不能与分片同时使用")
+    args = parser.parse_args()
+    if args.once and (args.workers or args.worker_id):
+        parser.error("--once 不能与 --workers / --worker-id 同时使用")
+    tracer.configure(args.trace_sample_rate, args.profile_job)
+
+    if args.workers:
+        dingTalkHandler.get()  # 在启动子进程前确认应用凭证
+        # 以 spawn 启动子进程，不继承本进程已打开的 SQLite 连接与事件循环等状态，由各子进程自行创建
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=runWorker, args=(f"{socket.gethostname()}-{i}", args.lease, args.metrics_port and args.metrics_port + i,
+                                                                         args.trace_sample_rate, args.profile_job))
+                     for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.worker_id:
+        runWorker(args.worker_id, args.lease, args.metrics_port, args.trace_sample_rate, args.profile_job)
+    else:
+        async def main():
+            mainHandler = SillageDingtalkHandler(daemon=not args.once, metricsPort=args.metrics_port)
+            # await mainHandler.test()
+            await mainHandler.start()
+
+
+        asyncio.run(main())
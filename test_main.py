@@ -0,0 +1,250 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import httpx
+
+import main
+from benchmark.synthetic import SemesterConfig, generateSemester, generateSubscribers, touchCourses
+from utils.course import ApiHandler, CompactCourse, CourseDiff, apiHandler
+from utils.course.courseDiff import diffCourseSets
+from utils.dingtalk import dingTalkHandler
+from utils.dingtalk.outbox import DONE, Outbox
+
+
+class FakeDingTalkHandler:
+    """只提供 SillageDingtalkHandler 用到的接口：发送工作通知与日程接口记录每次调用，其余为空操作"""
+
+    maxUserIdListLength = 100
+
+    def __init__(self):
+        self.messages: List[Tuple[List[str], str, str]] = []  # (接收人, 标题, 内容)
+        self.calendarCalls: List[str] = []
+        self.nextId = 0
+
+    async def sendCorporationMarkdownMsg(self, user_id_list: List[str], title: str, text: str) -> Dict:
+        self.messages.append((list(user_id_list), title, text))
+        return {"errcode": 0}
+
+    async def createCalendar(self, title, content, attendeesUnionIdList, start_time, end_time, remindMin=0):
+        self.calendarCalls.append("create")
+        self.nextId += 1
+        return httpx.Response(200, json={"id": f"event{self.nextId}"})
+
+    async def updateCalendar(self, eventId, title, content, attendeesUnionIdList, start_time, end_time, remindMin=0):
+        self.calendarCalls.append("update")
+        return httpx.Response(200, json={"id": eventId})
+
+    async def deleteCalendar(self, senderUnionId, eventId):
+        self.calendarCalls.append("delete")
+        return httpx.Response(200)
+
+    def loadSnapshot(self, snapshot: Dict):
+        pass
+
+    async def ensureAddressBook(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class SillageDingtalkHandlerTester(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.semester = generateSemester(SemesterConfig(courses=200, teachers=20, rooms=10, courseNames=15))
+        self.courseHandler = ApiHandler()
+        self.setCourses(self.semester.rawCourses)
+        apiHandler.override(self.courseHandler)
+        self.fakeDingTalkHandler = FakeDingTalkHandler()
+        dingTalkHandler.override(self.fakeDingTalkHandler)
+        self.handler = main.SillageDingtalkHandler(os.path.join(self.directory.name, "snapshot.json"),
+                                                   os.path.join(self.directory.name, "outbox.db"), daemon=True)
+        self.handler.allUsers = [main.UserHandler(userId, url, unionId=f"union-{userId}") for userId, url in generateSubscribers(self.semester, 60)]
+        self.handler.assignShard()
+        self.today = datetime.date.today().strftime("%Y-%m-%d")
+
+    async def asyncTearDown(self):
+        self.handler.outbox.close()
+        apiHandler.override(None)
+        dingTalkHandler.override(None)
+        self.directory.cleanup()
+
+    def setCourses(self, rawCourses: List[Dict]) -> Dict[str, CompactCourse]:
+        courses = [CompactCourse.fromRaw(rawCourse, self.courseHandler.nameTable) for rawCourse in rawCourses]
+        self.courseHandler.setCourses({course.id: course for course in courses})
+        return dict(self.courseHandler.courses)
+
+    async def drain(self):
+        while await self.handler.outboxWorker.runOnce():
+            pass
+
+    def idempotencyKeys(self) -> List[str]:
+        return [row[0] for row in self.handler.outbox.connection.execute("SELECT idempotency_key FROM outbox ORDER BY id")]
+
+    async def test_dispatchDigestsChunksRecipients(self):
+        self.fakeDingTalkHandler.maxUserIdListLength = 2
+        recipientsOfDigest = {("标题", "内容"): ["a", "b", "c", "d", "e"], ("标题2", "内容2"): ["f"]}
+        self.handler.dispatchDigests(recipientsOfDigest, f"date:{self.today}")
+        await self.drain()
+        self.assertEqual([(userIdList, title) for userIdList, title, _ in self.fakeDingTalkHandler.messages],
+                         [(["a", "b"], "标题"), (["c", "d"], "标题"), (["e"], "标题"), (["f"], "标题2")])
+
+        # 幂等键为 markdownMsg:{前缀}:{消息内容的sha1}
+        payload = {"userIdList": ["e"], "title": "标题", "text": "内容"}
+        digestHash = hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+        self.assertEqual(self.idempotencyKeys()[2], f"markdownMsg:date:{self.today}:{digestHash}")
+
+    async def test_dispatchDigestsIsIdempotent(self):
+        recipientsOfDigest = {("标题", "内容"): ["a", "b"]}
+        self.handler.dispatchDigests(recipientsOfDigest, "date:2024-03-04")
+        self.handler.dispatchDigests(recipientsOfDigest, "date:2024-03-04")  # 同一任务重复执行
+        self.handler.dispatchDigests(recipientsOfDigest, "date:2024-03-05")
+        await self.drain()
+        self.assertEqual(len(self.fakeDingTalkHandler.messages), 2)
+        self.assertEqual(len(self.idempotencyKeys()), 2)
+
+    async def test_renderDigestsGroupsBySubscription(self):
+        render = lambda courseDecorator: ("标题", str(courseDecorator).strip()) if len(courseDecorator.value) else None
+        recipientsOfDigest = main.SillageDingtalkHandler.renderDigests(self.handler.users, self.today, render)
+        expected: Dict[Tuple[str, str], List[str]] = {}
+        for user in self.handler.users:
+            digest = render(user.getCourseDecorator().filter_of_date(self.today))
+            if digest:
+                expected.setdefault(digest, []).append(user.userId)
+        self.assertTrue(expected)
+        self.assertEqual({digest: sorted(userIds) for digest, userIds in recipientsOfDigest.items()},
+                         {digest: sorted(userIds) for digest, userIds in expected.items()})
+
+    async def test_precomputedDigestsAreReused(self):
+        hits, misses = main.cacheRequests.labels("precomputed", "hit"), main.cacheRequests.labels("precomputed", "miss")
+        self.handler.precomputeNextDigests()
+        dateKeys = [key for key in self.handler.precomputed if key[0] == "date"]
+        self.assertEqual(len(dateKeys), 2)
+        self.assertEqual(len([key for key in self.handler.precomputed if key[0] == "calendar"]), 1)
+
+        _, date, dateDescription, addition = dateKeys[0]
+        hitCount, missCount = hits.value, misses.value
+        digests = self.handler.digestsOfDate(date, dateDescription, addition)
+        self.assertEqual((hits.value - hitCount, misses.value - missCount), (1, 0))
+        self.assertEqual(digests, self.handler.renderDigestsOfDate(date, dateDescription, addition, False, self.handler.users))
+
+        # 课程或用户刷新后，预先计算的结果失效
+        self.handler.generation += 1
+        self.handler.digestsOfDate(date, dateDescription, addition)
+        self.assertEqual((hits.value - hitCount, misses.value - missCount), (1, 1))
+        # 指定用户时不使用预先计算的结果
+        self.handler.digestsOfDate(date, dateDescription, addition, users=self.handler.users[:1])
+        self.assertEqual((hits.value - hitCount, misses.value - missCount), (1, 1))
+
+    async def test_notifyCourseChanges(self):
+        await self.handler.createCalendarForAllUsers(self.today)
+        await self.drain()
+        self.fakeDingTalkHandler.messages.clear()
+        syncedDates = []
+        sync = self.handler.calendarSync.sync
+
+        async def recordingSync(date, unionIds, plans):
+            syncedDates.append((date, sorted(unionIds)))
+            return await sync(date, unionIds, plans)
+
+        self.handler.calendarSync.sync = recordingSync
+
+        old = dict(self.courseHandler.courses)
+        touchCourses(self.semester, 10)
+        courseDiff = diffCourseSets(old, self.setCourses(self.semester.rawCourses))
+        self.assertEqual(len(courseDiff.changed), 10)
+        await self.handler.notifyCourseChanges(courseDiff)
+        await self.drain()
+
+        affected = set()
+        for oldCourse, newCourse in courseDiff.changed:
+            if any(date >= self.today for course in (oldCourse, newCourse) for date in course.dates):
+                affected.update(user for user in self.handler.users
+                                if user.subscription.match(oldCourse) or user.subscription.match(newCourse))
+        self.assertTrue(affected)
+        recipients = [userId for userIdList, _, _ in self.fakeDingTalkHandler.messages for userId in userIdList]
+        self.assertEqual(sorted(recipients), sorted(user.userId for user in affected))  # 每人一条
+        self.assertEqual({title for _, title, _ in self.fakeDingTalkHandler.messages}, {"课程变更"})
+        messageKeys = [key for key in self.idempotencyKeys() if key.startswith("markdownMsg:")]
+        self.assertEqual(len(messageKeys), len(self.fakeDingTalkHandler.messages))
+        self.assertTrue(all(key.startswith(f"markdownMsg:courseChange:{self.courseHandler.watermark}:") for key in messageKeys))
+
+        # 只为受影响的用户重新同步已经创建过日程的日期
+        changedToday = {user.unionId for user in affected
+                        if any(self.today in course.dates and user.subscription.match(course) for pair in courseDiff.changed for course in pair)}
+        self.assertEqual(syncedDates, [(self.today, sorted(changedToday))] if changedToday else [])
+
+
+    async def test_lessonRemindersOnlyWhenDaemon(self):
+        await self.handler.afterRefresh(CourseDiff.empty())
+        self.assertGreater(len(self.handler.lessonReminders.wheel), 0)
+
+        once = main.SillageDingtalkHandler(os.path.join(self.directory.name, "snapshot.once.json"),
+                                           os.path.join(self.directory.name, "outbox.once.db"), daemon=False)
+        once.allUsers = self.handler.allUsers
+        once.assignShard()
+        await once.afterRefresh(CourseDiff.empty())
+        self.assertEqual(len(once.lessonReminders.wheel), 0)
+        await once.lessonReminders.close()  # 未启动时退出也不会出错
+        self.assertIsNone(once.lessonReminders.task)
+        once.outbox.close()
+
+
+    async def test_onceModeExitsAfterOutboxDrains(self):
+        self.handler.saveSnapshot()  # 从快照恢复，不访问远端
+        outboxFileName = os.path.join(self.directory.name, "outbox.once.db")
+        once = main.SillageDingtalkHandler(os.path.join(self.directory.name, "snapshot.json"), outboxFileName, daemon=False)
+        refreshes, signalHandlers, jobs = [], [], []
+
+        async def refreshRemoteData():
+            refreshes.append(datetime.datetime.now())
+
+        # 早间与晚间推送的时间改为启动后不久
+        startTime = datetime.datetime.now()
+
+        def fillHourMin(hour, minute, date=None):
+            if date is not None:
+                return main.SillageDingtalkHandler.fillHourMin(hour, minute, date)
+            return startTime + datetime.timedelta(seconds=0.2 if (hour, minute) == main.MORNING else 0.4)
+
+        addJob = once.scheduler.add_job
+
+        def recordingAddJob(func, trigger=None, **kwargs):
+            jobs.append((func.__name__, trigger))
+            return addJob(func, trigger, **kwargs)
+
+        once.refreshRemoteData = refreshRemoteData
+        once.handleSignals = lambda: signalHandlers.append(True)
+        once.fillHourMin = fillHourMin
+        once.scheduler.add_job = recordingAddJob
+        await asyncio.wait_for(once.start(), timeout=10)  # 晚间推送后退出
+
+        self.assertEqual(signalHandlers, [])
+        self.assertIsNone(once.lessonReminders.task)
+        self.assertEqual(Counter(jobs)[("goodMorning", "date")], 1)
+        self.assertEqual(Counter(jobs)[("goodNight", "date")], 1)
+        self.assertNotIn("cron", [trigger for _, trigger in jobs])
+        self.assertEqual(len(refreshes), 1)
+
+        # 退出前已发送完发件箱中的记录
+        tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        titles = {title for _, title, _ in self.fakeDingTalkHandler.messages}
+        self.assertTrue(any(title.startswith(f"今天({self.today})") for title in titles))
+        self.assertTrue(any(title.startswith(f"明天({tomorrow})") for title in titles))
+        self.assertIn("create", self.fakeDingTalkHandler.calendarCalls)
+        outbox = Outbox(outboxFileName)
+        try:
+            self.assertEqual(list(outbox.counts()), [DONE])
+        finally:
+            outbox.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
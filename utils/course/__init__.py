@@ -1,4 +1,11 @@
 from .apiHandler import ApiHandler, CourseDecorator
+from .compactCourse import CompactCourse, NameTable
+from .courseDiff import CourseDiff
+from .courseIndex import CourseIndex
+from .courseRenderer import CourseRenderer
+from .subscription import CompiledSubscription, urlStrip
+from .subscriptionIndex import SubscriptionIndex
 from .types import *
+from utils.lazy import LazyHandler
 
-apiHandler = ApiHandler()
\ No newline at end of file
+apiHandler: ApiHandler = LazyHandler(ApiHandler)
\ No newline at end of file
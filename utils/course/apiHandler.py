@@ -1,11 +1,23 @@
+import asyncio
+import datetime
 import json
 import math
+import time
 from collections import namedtuple
-from typing import List, Callable, Tuple, Union
-
-import httpx
+from typing import List, Callable, Tuple, Union, Optional, Dict, Set, Mapping, Iterable, Sequence
 
+from utils.course.batchMatcher import BatchMatcher
+from utils.course.compactCourse import CompactCourse, NameTable, courseHasDate, dateToOrdinal
+from utils.course.courseDiff import CourseDiff, diffCourses, diffCourseSets
+from utils.course.courseIndex import CourseIndex, CourseIdSet
+from utils.course.courseRenderer import CourseRenderer
 from utils.course.types import Course
+from utils.httpClient import HttpClientPool
+from utils.metrics import registry
+from utils.tracing import span
+
+requestSeconds = registry.histogram("sillage_pocketbase_request_seconds", "PocketBase 接口单次请求的耗时", ["endpoint"])
+responses = registry.counter("sillage_pocketbase_responses", "PocketBase 接口的响应数", ["endpoint", "status"])
 
 CourseFilter = Callable[[Course], bool]
 
@@ -15,8 +27,36 @@ def whether_two_list_have_same_element(list_a: List, list_b: List):
 
 
 class CourseDecorator:
-    def __init__(self, source: Union[Course, List[Course]]):
-        self.value: List[Course] = source if isinstance(source, list) else [source]
+    def __init__(self, source: Union[Course, List[Course]], index: Optional[CourseIndex] = None,
+                 renderer: Optional[CourseRenderer] = None):
+        self._value: Optional[List[Course]] = source if isinstance(source, list) else [source]
+        self._ids: Optional[CourseIdSet] = None
+        # 若提供了索引，则各 filter_* 方法通过集合求交完成筛选
+        self.index = index
+        # 若提供了渲染器，则 __str__ 与 get_title 复用其缓存
+        self.renderer = renderer
+
+    @classmethod
+    def from_ids(cls, index: CourseIndex, ids: CourseIdSet, renderer: Optional[CourseRenderer] = None) -> "CourseDecorator":
+        decorator = cls([], index, renderer)
+        decorator._value = None  # 延迟到真正访问 value 时再按原始顺序取出课程
+        decorator._ids = ids
+        return decorator
+
+    @property
+    def value(self) -> List[Course]:
+        if self._value is None:
+            self._value = self.index.sortedCourses(self._ids)
+        return self._value
+
+    @property
+    def ids(self) -> CourseIdSet:
+        if self._ids is None:
+            self._ids = frozenset(course.id for course in self._value)
+        return self._ids
+
+    def _narrow(self, ids: CourseIdSet) -> "CourseDecorator":
+        return CourseDecorator.from_ids(self.index, self.ids & ids, self.renderer)
 
     def get_situ_items(self):
         teachers: List[str] = []
@@ -25,22 +65,28 @@ class CourseDecorator:
 
         for course in self.value:
             for situation in course.situations:
-                teachers.extend(situation.teachers)
-                groups.extend(situation.groups)
-                rooms.extend(situation.groups)
+                teachers.extend(situation.teachers or [])
+                groups.extend(situation.groups or [])
+                rooms.extend(situation.rooms or [])
         SituItems = namedtuple("SituItems", ["teachers", "groups", "rooms"])
         return SituItems(list(set(teachers)), list(set(groups)), list(set(rooms)))
 
     def filter(self, filter_function: CourseFilter):
-        return CourseDecorator(list(filter(filter_function, self.value)))
+        return CourseDecorator(list(filter(filter_function, self.value)), self.index, self.renderer)
 
     def filter_grades(self, grades: List[str]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfGrades(grades))
+
         def courseFilter(c: Course) -> bool:
             return c.grade in grades
 
         return self.filter(courseFilter)
 
     def filter_of_lesson_num(self, lesson_number: int):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfLessonNum(lesson_number))
+
         def courseFilter(c: Course) -> bool:
             return c.lessonNum == lesson_number
 
@@ -48,34 +94,53 @@ class CourseDecorator:
 
     def filter_of_grade_groups(self, grade_groups: List[str]):
         grade_groups: List[Tuple[str, str]] = list(map(lambda gg: json.loads(gg), grade_groups))
-        grades = list(map(lambda gg: gg[0], grade_groups))
+        groups_of_grade: Dict[str, Set[str]] = {}
+        for grade, group in grade_groups:
+            groups_of_grade.setdefault(grade, set()).add(group)
+
+        return self.filter_of_grade_group_map(groups_of_grade)
+
+    def filter_of_grade_group_map(self, groups_of_grade: Mapping[str, Iterable[str]]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfGradeGroups(groups_of_grade))
 
         def courseFiler(c: Course) -> bool:
+            groups_of_this_grade = groups_of_grade.get(c.grade, ())
             for situation in c.situations:
-                if len(situation.groups) == 0:
+                if not situation.groups:
                     # 如果某节课没有指定“班级/小组”，则按年级，则符合条件
                     return True
-                groups_of_this_grade = list(map(lambda gg: gg[1], filter(lambda gg: gg[0] == c.grade, grade_groups)))
                 # 如果该课程的某 situation.groups 与需要的 groups 有重叠，则符合条件
                 if whether_two_list_have_same_element(situation.groups, groups_of_this_grade):
                     return True
             return False
 
-        return self.filter_grades(grades).filter(courseFiler)
+        return self.filter_grades(list(groups_of_grade)).filter(courseFiler)
 
     def filter_of_date(self, date: str):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfDate(date))
+
+        ordinal = dateToOrdinal(date)
+
         def courseFiler(c: Course) -> bool:
-            return date in c.dates
+            return courseHasDate(c, date, ordinal)
 
         return self.filter(courseFiler)
 
     def filter_of_methods(self, methods: List[str]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfMethods(methods))
+
         def courseFiler(c: Course) -> bool:
             return c.method in methods
 
         return self.filter(courseFiler)
 
     def filter_of_teachers(self, teachers: List[str]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfTeachers(teachers))
+
         def courseFiler(c: Course) -> bool:
             teacher_list = CourseDecorator(c).get_situ_items().teachers
             return whether_two_list_have_same_element(teacher_list, teachers)
@@ -83,12 +148,18 @@ class CourseDecorator:
         return self.filter(courseFiler)
 
     def filter_of_course_names(self, course_names: List[str]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfCourseNames(course_names))
+
         def courseFiler(c: Course) -> bool:
             return c.info.name in course_names
 
         return self.filter(courseFiler)
 
     def filter_of_rooms(self, rooms: List[str]):
+        if self.index is not None:
+            return self._narrow(self.index.idsOfRooms(rooms))
+
         def courseFiler(c: Course) -> bool:
             room_list = CourseDecorator(c).get_situ_items().rooms
             return whether_two_list_have_same_element(room_list, rooms)
@@ -96,59 +167,137 @@ class CourseDecorator:
         return self.filter(courseFiler)
 
     def get_title(self):
-        return "丨".join([f"{course.info.name}:"
-                         f"{','.join(['-'.join([_ for _ in ['&'.join(situ.groups), '&'.join(situ.rooms)] if _]) for situ in course.situations])}"
-                         for course in self.value])
+        return (self.renderer or CourseRenderer()).renderTitle(self.value)
 
     def __str__(self):
-        def decorateStr(s: str):
-            return s + "\n\n" if s else ""
-
-        def getCourseStr(c: Course):
-            courseStr = ""
-            courseStr += decorateStr(c.info.name)
-            courseStr += decorateStr(c.method)
-            if len(c.situations) >= 1:
-                courseStr += "\n\n".join(["丨".join([item for item in [
-                    decorateStr("&".join(situ.groups) if situ.groups else "").strip(),
-                    decorateStr("&".join(situ.teachers) if situ.teachers else "").strip(),
-                    decorateStr("&".join(situ.rooms) if situ.rooms else "").strip()
-                ] if item]) for situ in c.situations])
-            courseStr += decorateStr(c.note)
-            return courseStr.strip()
-
-        # -----------
-        lessonNumStrList: List[str] = []
-
-        for lessonNum in range(1, 6):
-            lessonNumStr = ""
-            coursesOfLessonNum = self.filter_of_lesson_num(lessonNum).value
-            if len(coursesOfLessonNum):
-                lessonNumStr += f"# 第 {lessonNum} 节课\n\n"
-                lessonNumStr += "\n\n---\n\n".join([getCourseStr(c) for c in coursesOfLessonNum])
-                lessonNumStrList.append(lessonNumStr.strip())
-        return f"\n\n---\n\n".join(lessonNumStrList)
+        with span("CourseDecorator.__str__", courses=len(self.value)):
+            return (self.renderer or CourseRenderer()).render(self.value)
 
 
 class ApiHandler:
     base_url = 'https://sillage.siae.top/api/collections/course/records'
     max_per_page = 200
+    max_concurrent_pages = 5  # 并发获取的最大页数
+    full_resync_interval = datetime.timedelta(hours=24)  # 定期全量同步，以发现被删除的课程
     courseDecorator: CourseDecorator
-
-    def __init__(self):
-        self.courseDecorator = self.getNewCourseDecorator()
-
-    def getNewCourseDecorator(self):
-        res = httpx.get(self.base_url, params=dict(page=1, perPage=1, sort="-updated"))
-        totalItems = res.json()['totalItems']
-
-        rawCourses = []
-        for i in range(math.ceil(totalItems / 200)):
-            res = httpx.get(self.base_url, params=dict(page=i + 1, perPage=self.max_per_page, sort="-updated"))
-            items = res.json()['items']
-            rawCourses += items
-
-        return CourseDecorator([Course(**rawCourse) for rawCourse in rawCourses])
-
-    def refreshCourses(self):
-        self.courseDecorator = self.getNewCourseDecorator()
+    courseIndex: CourseIndex
+
+    def __init__(self, httpClientPool: Optional[HttpClientPool] = None):
+        self.httpClientPool = httpClientPool or HttpClientPool()
+        self.courseRenderer = CourseRenderer()
+        self._courseMatcher: Optional[BatchMatcher] = None
+        self.nameTable = NameTable()  # 课程中出现的各类名称 -> 整数id
+        self.courses: Dict[str, CompactCourse] = {}
+        self.watermark: str = ""  # 已同步课程中最新的 updated
+        self.lastFullSync: Optional[datetime.datetime] = None
+        # 创建时不发起网络请求：先从快照加载，或调用 refreshCourses 获取
+        self.setCourses({})
+
+    def loadSnapshot(self, snapshot: Dict):
+        # 快照中的数据在写入前已校验过，直接转换为紧凑表示；课程整体替换，换用新的 NameTable
+        nameTable = NameTable()
+        courses = [CompactCourse.fromDict(rawCourse, nameTable) for rawCourse in snapshot.get("courses", [])]
+        self.setCourses({course.id: course for course in courses}, nameTable)
+        lastFullSync = snapshot.get("lastFullSync")
+        self.lastFullSync = datetime.datetime.fromisoformat(lastFullSync) if lastFullSync else None
+
+    def toSnapshot(self) -> Dict:
+        return {"courses": [course.dict() for course in self.courseDecorator.value],
+                "lastFullSync": self.lastFullSync.isoformat() if self.lastFullSync else None}
+
+    async def getRawCourses(self, filter_: str = "") -> List[Dict]:
+        """并发获取全部分页；filter_ 为 PocketBase 的筛选表达式"""
+        client = self.httpClientPool.getAsyncClient(self.base_url)
+        semaphore = asyncio.Semaphore(self.max_concurrent_pages)
+
+        async def getPage(page: int) -> Dict:
+            params = dict(page=page, perPage=self.max_per_page, sort="-updated")
+            if filter_:
+                params["filter"] = filter_
+            async with semaphore:
+                startTime = time.perf_counter()
+                res = await client.get(self.base_url, params=params)
+                requestSeconds.labels("course/records").observe(time.perf_counter() - startTime)
+            responses.labels("course/records", res.status_code).inc()
+            res.raise_for_status()
+            return res.json()
+
+        firstPage = await getPage(1)  # 第一页同时给出 totalItems，无需单独探测
+        totalPages = math.ceil(firstPage['totalItems'] / self.max_per_page)
+        otherPages = await asyncio.gather(*[getPage(page) for page in range(2, totalPages + 1)])
+
+        rawCourses = list(firstPage['items'])
+        for res in otherPages:
+            rawCourses += res['items']
+        return rawCourses
+
+    def setCourses(self, courses: Dict[str, CompactCourse], nameTable: Optional[NameTable] = None):
+        """:param nameTable: courses 全部由新的 NameTable 构建时传入，替换原有的，已不再出现的名称随之释放"""
+        if nameTable is not None:
+            self.nameTable = nameTable
+        self.courses = courses
+        self.watermark = max((course.updated or "" for course in courses.values()), default="")
+        # 每次课程变化时重新构建一次索引（纯内存操作），保持接口返回的 -updated 顺序
+        sortedCourses = sorted(courses.values(), key=lambda c: c.updated or "", reverse=True)
+        self.courseIndex = CourseIndex(sortedCourses)
+        self.courseRenderer.retain(sortedCourses)  # 课程变化后丢弃失效的渲染缓存
+        self.courseDecorator = CourseDecorator(sortedCourses, self.courseIndex, self.courseRenderer)
+        self._courseMatcher = None  # 首次匹配时再构建
+
+    @property
+    def courseMatcher(self) -> BatchMatcher:
+        if self._courseMatcher is None:
+            self._courseMatcher = BatchMatcher(self.courseDecorator.value, self.nameTable)
+        return self._courseMatcher
+
+    def matchSubscriptions(self, subscriptions: Sequence, date: Optional[str] = None) -> List[CourseDecorator]:
+        """
+        一次性计算各订阅在 date 当天（不指定时为全部日期）的课程，与 subscription.apply(courseDecorator).filter_of_date(date) 一致\n
+        :param subscriptions: CompiledSubscription 的列表
+        """
+        courses = self.courseDecorator.value
+        return [CourseDecorator([courses[position] for position in positions], self.courseIndex, self.courseRenderer)
+                for positions in self.courseMatcher.match(subscriptions, date)]
+
+    async def getNewCourseDecorator(self) -> CourseDecorator:
+        """全量同步：以新的 NameTable 重新构建全部课程，常驻运行时不会累积已不再出现的名称"""
+        with span("ApiHandler.getRawCourses", full=True):
+            rawCourses = await self.getRawCourses()
+        nameTable = NameTable()
+        with span("ApiHandler.parseCourses", courses=len(rawCourses)):
+            courses = {course.id: course for course in (CompactCourse.fromRaw(rawCourse, nameTable) for rawCourse in rawCourses)}
+        with span("ApiHandler.setCourses", courses=len(courses)):
+            self.setCourses(courses, nameTable)
+        self.lastFullSync = datetime.datetime.now()
+        return self.courseDecorator
+
+    async def getChangedCourses(self) -> List[CompactCourse]:
+        """增量同步：只获取 updated 晚于水位线的课程"""
+        with span("ApiHandler.getRawCourses", full=False):
+            rawCourses = await self.getRawCourses(f'updated>"{self.watermark}"')
+        with span("ApiHandler.parseCourses", courses=len(rawCourses)):
+            return [CompactCourse.fromRaw(rawCourse, self.nameTable) for rawCourse in rawCourses]
+
+    async def refreshCourses(self) -> CourseDiff:
+        """
+        刷新课程，返回与刷新前相比的变化；首次获取课程时返回空的变化。\n
+        增量同步只比较变化了的课程；被删除的课程只能在全量同步时发现
+        """
+        previousCourses = self.courses
+        needFullSync = (not self.watermark or self.lastFullSync is None
+                        or datetime.datetime.now() - self.lastFullSync >= self.full_resync_interval)
+        if needFullSync:
+            await self.getNewCourseDecorator()
+            return diffCourseSets(previousCourses, self.courses) if previousCourses else CourseDiff.empty()
+
+        changedCourses = await self.getChangedCourses()
+        if not changedCourses:
+            return CourseDiff.empty()
+        added, changed = diffCourses(previousCourses, changedCourses)
+        courses = dict(previousCourses)
+        courses.update({course.id: course for course in changedCourses})
+        self.setCourses(courses)
+        return CourseDiff(added, [], changed) if previousCourses else CourseDiff.empty()
+
+    async def aclose(self):
+        await self.httpClientPool.aclose()
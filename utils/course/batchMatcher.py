@@ -0,0 +1,190 @@
+from collections import defaultdict
+from typing import TYPE_CHECKING, DefaultDict, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from utils.course.compactCourse import CompactCourse, NameId, NameTable, dateToOrdinal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if TYPE_CHECKING:
+    from utils.course.subscription import CompiledSubscription
+
+Bitset = int  # 第 i 位表示第 i 门课程
+
+
+def bitsetOf(positions: Iterable[int], size: int) -> Bitset:
+    bitmap = bytearray((size + 7) // 8)
+    for position in positions:
+        bitmap[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+def positionsOf(bits: Bitset) -> List[int]:
+    return [position for position, bit in enumerate(reversed(bin(bits)[2:])) if bit == "1"]
+
+
+class BatchMatcher:
+    """
+    一次性计算全部订阅与全部课程的匹配关系（订阅 × 课程 的矩阵），与逐个调用 CompiledSubscription.apply 的结果一致。
+    课程按列存储：年级、课程性质、课程名称为整数id列，教师、教室、班级/小组与上课日期为成员关系；
+    订阅编码为各维度的掩码。安装了 NumPy 时整体以矩阵运算完成（每个维度的矩阵只包含在课程中出现过的名称），
+    否则以 Python 整数作为位集合逐个订阅计算。
+    """
+
+    def __init__(self, courses: List[CompactCourse], nameTable: NameTable, useNumpy: Optional[bool] = None):
+        self.courses = courses  # 与 CourseIndex 的顺序一致
+        self.nameTable = nameTable
+        self.size = len(courses)
+        self.nameCount = len(nameTable)  # 之后新增的名称不会出现在这些课程中
+        self.useNumpy = numpy is not None if useNumpy is None else useNumpy and numpy is not None
+        if self.useNumpy:
+            self.buildArrays()
+        else:
+            self.buildBitsets()
+
+    def idsOf(self, names: Iterable[str]) -> List[NameId]:
+        """不在课程中出现过的名称不会匹配任何课程"""
+        return [nameId for nameId in map(self.nameTable.idOf, names) if nameId is not None and nameId < self.nameCount]
+
+    # 位集合
+    def buildBitsets(self):
+        byGrade: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byMethod: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byCourseName: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byTeacher: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byRoom: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byGroup: DefaultDict[NameId, List[int]] = defaultdict(list)
+        byDate: DefaultDict[int, List[int]] = defaultdict(list)
+        ungrouped: List[int] = []
+        for position, course in enumerate(self.courses):
+            byGrade[course.gradeId].append(position)
+            byMethod[course.methodId].append(position)
+            byCourseName[course.courseNameId].append(position)
+            for nameId in course.teacherIds:
+                byTeacher[nameId].append(position)
+            for nameId in course.roomIds:
+                byRoom[nameId].append(position)
+            for nameId in course.groupIds:
+                byGroup[nameId].append(position)
+            for ordinal in course.dateOrdinals:
+                byDate[ordinal].append(position)
+            if any(not situation.groups for situation in course.situations):
+                ungrouped.append(position)
+
+        def freeze(index: Dict[int, List[int]]) -> Dict[int, Bitset]:
+            return {key: bitsetOf(positions, self.size) for key, positions in index.items()}
+
+        self.gradeBits, self.methodBits, self.courseNameBits = freeze(byGrade), freeze(byMethod), freeze(byCourseName)
+        self.teacherBits, self.roomBits, self.groupBits = freeze(byTeacher), freeze(byRoom), freeze(byGroup)
+        self.dateBits = freeze(byDate)
+        self.ungroupedBits = bitsetOf(ungrouped, self.size)
+        self.allBits = (1 << self.size) - 1
+
+    def unionOf(self, bitsOfName: Dict[NameId, Bitset], names: Iterable[str]) -> Bitset:
+        bits = 0
+        for nameId in self.idsOf(names):
+            bits |= bitsOfName.get(nameId, 0)
+        return bits
+
+    def matchBitset(self, subscription: "CompiledSubscription", dateBits: Bitset) -> Bitset:
+        bits = dateBits
+        for names, bitsOfName in ((subscription.grades, self.gradeBits), (subscription.rooms, self.roomBits),
+                                  (subscription.methods, self.methodBits), (subscription.teachers, self.teacherBits),
+                                  (subscription.subjects, self.courseNameBits)):
+            if names and bits:
+                bits &= self.unionOf(bitsOfName, names)
+        if subscription.gradeGroups and bits:
+            gradeGroupBits = 0
+            for grade, groups in subscription.groupsOfGrade.items():
+                gradeGroupBits |= self.unionOf(self.gradeBits, [grade]) & (self.ungroupedBits | self.unionOf(self.groupBits, groups))
+            bits &= gradeGroupBits
+        return bits
+
+    # NumPy
+    def buildArrays(self):
+        # 各维度只为在课程中出现过的名称分配行（局部id），矩阵大小与 NameTable 中累积的名称总数无关
+        def rowsOf(nameIds: Iterable[NameId]) -> Dict[NameId, int]:
+            return {nameId: row for row, nameId in enumerate(sorted(set(nameIds)))}
+
+        def column(attr: str, rowOfName: Dict[NameId, int]) -> "numpy.ndarray":
+            return numpy.array([rowOfName[getattr(course, attr)] for course in self.courses], dtype=numpy.int32)
+
+        self.gradeRows = rowsOf(course.gradeId for course in self.courses)
+        self.methodRows = rowsOf(course.methodId for course in self.courses)
+        self.courseNameRows = rowsOf(course.courseNameId for course in self.courses)
+        self.gradeColumn = column("gradeId", self.gradeRows)
+        self.methodColumn = column("methodId", self.methodRows)
+        self.courseNameColumn = column("courseNameId", self.courseNameRows)
+        self.ungroupedColumn = numpy.array([any(not situation.groups for situation in course.situations) for course in self.courses], dtype=bool)
+
+        def membership(attr: str) -> Tuple[Dict[NameId, int], "numpy.ndarray"]:
+            """该维度出现过的名称 × 课程 的成员关系矩阵，用 float32 存储以便直接做矩阵乘法"""
+            rowOfName = rowsOf(nameId for course in self.courses for nameId in getattr(course, attr))
+            matrix = numpy.zeros((len(rowOfName), self.size), dtype=numpy.float32)
+            rows = [rowOfName[nameId] for course in self.courses for nameId in getattr(course, attr)]
+            columns = [position for position, course in enumerate(self.courses) for _ in getattr(course, attr)]
+            matrix[rows, columns] = 1
+            return rowOfName, matrix
+
+        (self.teacherRows, self.teacherMatrix), (self.roomRows, self.roomMatrix), (self.groupRows, self.groupMatrix) = \
+            membership("teacherIds"), membership("roomIds"), membership("groupIds")
+
+        ordinals = [ordinal for course in self.courses for ordinal in course.dateOrdinals]
+        self.firstOrdinal = min(ordinals, default=0)
+        self.dateMatrix = numpy.zeros((max(ordinals, default=-1) - self.firstOrdinal + 1, self.size), dtype=bool)
+        self.dateMatrix[[ordinal - self.firstOrdinal for ordinal in ordinals],
+                        [position for position, course in enumerate(self.courses) for _ in course.dateOrdinals]] = True
+
+    def wanted(self, namesOfSubscriptions: Sequence[Iterable[str]], rowOfName: Dict[NameId, int]):
+        """订阅 × 该维度的名称 的掩码，以及各订阅是否限制了该维度"""
+        mask = numpy.zeros((len(namesOfSubscriptions), len(rowOfName)), dtype=bool)
+        constrained = numpy.zeros(len(namesOfSubscriptions), dtype=bool)
+        for row, names in enumerate(namesOfSubscriptions):
+            if names:
+                constrained[row] = True
+                mask[row, [rowOfName[nameId] for nameId in self.idsOf(names) if nameId in rowOfName]] = True
+        return mask, constrained
+
+    def matchArrays(self, subscriptions: Sequence["CompiledSubscription"], columns: "numpy.ndarray") -> "numpy.ndarray":
+        """只对 columns 中的课程（如当天有课的课程）计算 订阅 × 课程 的匹配矩阵"""
+        result = numpy.ones((len(subscriptions), len(columns)), dtype=bool)
+        for attr, column, rowOfName in (("grades", self.gradeColumn, self.gradeRows), ("methods", self.methodColumn, self.methodRows),
+                                        ("subjects", self.courseNameColumn, self.courseNameRows)):
+            mask, constrained = self.wanted([getattr(subscription, attr) for subscription in subscriptions], rowOfName)
+            result &= mask[:, column[columns]] | ~constrained[:, None]
+        for attr, matrix, rowOfName in (("rooms", self.roomMatrix, self.roomRows), ("teachers", self.teacherMatrix, self.teacherRows)):
+            mask, constrained = self.wanted([getattr(subscription, attr) for subscription in subscriptions], rowOfName)
+            if constrained.any():
+                result[constrained] &= mask[constrained].astype(numpy.float32) @ matrix[:, columns] > 0
+
+        constrained = numpy.array([bool(subscription.gradeGroups) for subscription in subscriptions], dtype=bool)
+        if constrained.any():
+            constrainedSubscriptions = [subscription for subscription in subscriptions if subscription.gradeGroups]
+            gradeColumn, ungroupedColumn, groupMatrix = self.gradeColumn[columns], self.ungroupedColumn[columns], self.groupMatrix[:, columns]
+            gradeGroupResult = numpy.zeros((len(constrainedSubscriptions), len(columns)), dtype=bool)
+            for grade in {grade for subscription in constrainedSubscriptions for grade in subscription.groupsOfGrade}:
+                gradeIds = self.idsOf([grade])
+                if not gradeIds or gradeIds[0] not in self.gradeRows:
+                    continue
+                mask, hasGrade = self.wanted([subscription.groupsOfGrade.get(grade, ()) for subscription in constrainedSubscriptions], self.groupRows)
+                groupMatch = (mask.astype(numpy.float32) @ groupMatrix > 0) | ungroupedColumn[None, :]
+                gradeGroupResult |= groupMatch & (gradeColumn == self.gradeRows[gradeIds[0]])[None, :] & hasGrade[:, None]
+            result[constrained] &= gradeGroupResult
+        return result
+
+    def match(self, subscriptions: Sequence["CompiledSubscription"], date: Optional[str] = None) -> List[List[int]]:
+        """返回每个订阅在 date 当天（不指定时为全部日期）匹配的课程位置，按课程顺序排列"""
+        ordinal = dateToOrdinal(date) if date else None
+        if self.useNumpy:
+            if ordinal is None:
+                columns = numpy.arange(self.size)
+            elif 0 <= ordinal - self.firstOrdinal < len(self.dateMatrix):
+                columns = numpy.flatnonzero(self.dateMatrix[ordinal - self.firstOrdinal])
+            else:
+                columns = numpy.zeros(0, dtype=numpy.int64)
+            return [columns[row].tolist() for row in self.matchArrays(subscriptions, columns)]
+
+        dateBits = self.allBits if ordinal is None else self.dateBits.get(ordinal, 0)
+        return [positionsOf(self.matchBitset(subscription, dateBits)) for subscription in subscriptions]
@@ -0,0 +1,164 @@
+import datetime
+import sys
+from bisect import bisect_left
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+from utils.course.types import Course
+
+NameId = int
+
+
+def dateToOrdinal(date: str) -> int:
+    return datetime.date.fromisoformat(date).toordinal()
+
+
+def ordinalToDate(ordinal: int) -> str:
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+def courseHasDate(course, date: str, ordinal: int) -> bool:
+    """同时适用于 Course 与 CompactCourse；ordinal 为 date 的日序数，由调用方预先算好"""
+    if isinstance(course, CompactCourse):
+        return course.hasDateOrdinal(ordinal)
+    return date in course.dates
+
+
+def dateOrdinalsOf(course) -> Iterable[int]:
+    if isinstance(course, CompactCourse):
+        return course.dateOrdinals
+    return (dateToOrdinal(date) for date in course.dates)
+
+
+class NameTable:
+    """
+    将教师、教室、班级/小组等名称映射为整数id；同一名称只保存一份字符串。
+    只增不减，由持有者在整体替换课程时（如全量同步）换用新的 NameTable，丢弃不再出现的名称
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, NameId] = {}
+        self.names: List[str] = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name: Optional[str]) -> NameId:
+        name = name or ""
+        nameId = self.ids.get(name)
+        if nameId is None:
+            nameId = self.ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return nameId
+
+    def internAll(self, names: Iterable[str]) -> FrozenSet[NameId]:
+        return frozenset(self.intern(name) for name in names)
+
+    def nameOf(self, nameId: NameId) -> str:
+        return self.names[nameId]
+
+    def idOf(self, name: str) -> Optional[NameId]:
+        """查询已有名称的id，不存在时返回 None（不会新增）"""
+        return self.ids.get(name)
+
+
+class CompactSituation(NamedTuple):
+    groups: Tuple[str, ...]
+    teachers: Tuple[str, ...]
+    rooms: Tuple[str, ...]
+
+
+class CompactCourseInfo(NamedTuple):
+    name: str
+    code: Optional[str]
+    bgc: str
+
+
+class CompactCourse(NamedTuple):
+    """
+    课程的紧凑、不可变（可哈希）表示：名称均为驻留的字符串，并预先计算出其整数id集合；上课日期以有序的日序数元组保存。
+    只在接口边界上用 pydantic 校验一次，属性与 Course 相同，可直接用于筛选与渲染。
+    """
+    id: str
+    created: Optional[str]
+    updated: Optional[str]
+    info: CompactCourseInfo
+    situations: Tuple[CompactSituation, ...]
+    grade: str
+    dateOrdinals: Tuple[int, ...]  # 有序的 date.toordinal()
+    lessonNum: int
+    note: Optional[str]
+    method: Optional[str]
+    # 以下均为 NameTable 中的id
+    gradeId: NameId
+    methodId: NameId
+    courseNameId: NameId
+    teacherIds: FrozenSet[NameId]
+    roomIds: FrozenSet[NameId]
+    groupIds: FrozenSet[NameId]
+
+    @property
+    def dates(self) -> List[str]:
+        return [ordinalToDate(ordinal) for ordinal in self.dateOrdinals]
+
+    def hasDateOrdinal(self, ordinal: int) -> bool:
+        i = bisect_left(self.dateOrdinals, ordinal)
+        return i < len(self.dateOrdinals) and self.dateOrdinals[i] == ordinal
+
+    def hasDate(self, date: str) -> bool:
+        return self.hasDateOrdinal(dateToOrdinal(date))
+
+    @classmethod
+    def fromRaw(cls, rawCourse: Dict, nameTable: NameTable) -> "CompactCourse":
+        """接口返回的原始数据：先经 pydantic 校验"""
+        return cls.fromCourse(Course(**rawCourse), nameTable)
+
+    @classmethod
+    def fromCourse(cls, course: Course, nameTable: NameTable) -> "CompactCourse":
+        return cls.build(nameTable, course.id, course.created, course.updated, course.info.name, course.info.code, course.info.bgc,
+                         [(situ.groups, situ.teachers, situ.rooms) for situ in course.situations],
+                         course.grade, course.dates, course.lessonNum, course.note, course.method)
+
+    @classmethod
+    def fromDict(cls, data: Dict, nameTable: NameTable) -> "CompactCourse":
+        """已校验过的数据（如本地快照），不再经过 pydantic"""
+        info = data["info"]
+        return cls.build(nameTable, data["id"], data.get("created"), data.get("updated"), info["name"], info.get("code"), info["bgc"],
+                         [(situ.get("groups"), situ.get("teachers"), situ.get("rooms")) for situ in data["situations"]],
+                         data["grade"], data["dates"], data["lessonNum"], data.get("note"), data.get("method"))
+
+    @classmethod
+    def build(cls, nameTable: NameTable, id_: str, created: Optional[str], updated: Optional[str],
+              name: str, code: Optional[str], bgc: str, situations: Iterable[Tuple[Optional[List[str]], ...]],
+              grade: str, dates: Iterable[str], lessonNum: int, note: Optional[str], method: Optional[str]) -> "CompactCourse":
+        intern, names = nameTable.intern, nameTable.names
+        teacherIds, roomIds, groupIds = set(), set(), set()
+        compactSituations = []
+        for groups, teachers, rooms in situations:
+            groupIdList = [intern(group) for group in groups or ()]
+            teacherIdList = [intern(teacher) for teacher in teachers or ()]
+            roomIdList = [intern(room) for room in rooms or ()]
+            groupIds.update(groupIdList)
+            teacherIds.update(teacherIdList)
+            roomIds.update(roomIdList)
+            compactSituations.append(CompactSituation(tuple(names[i] for i in groupIdList),
+                                                      tuple(names[i] for i in teacherIdList),
+                                                      tuple(names[i] for i in roomIdList)))
+        gradeId, methodId, courseNameId = intern(grade), intern(method), intern(name)
+        return cls(id=id_, created=created, updated=updated,
+                   info=CompactCourseInfo(names[courseNameId], code, sys.intern(bgc)),
+                   situations=tuple(compactSituations),
+                   grade=names[gradeId],
+                   dateOrdinals=tuple(sorted({dateToOrdinal(date) for date in dates})),
+                   lessonNum=lessonNum,
+                   note=note,
+                   method=names[methodId] if method else method,
+                   gradeId=gradeId, methodId=methodId, courseNameId=courseNameId,
+                   teacherIds=frozenset(teacherIds), roomIds=frozenset(roomIds), groupIds=frozenset(groupIds))
+
+    def dict(self) -> Dict:
+        """与 Course.dict() 的结构相同，用于保存快照"""
+        return {"id": self.id, "created": self.created, "updated": self.updated,
+                "info": self.info._asdict(),
+                "situations": [{"groups": list(situation.groups), "teachers": list(situation.teachers), "rooms": list(situation.rooms)}
+                               for situation in self.situations],
+                "grade": self.grade, "dates": self.dates, "lessonNum": self.lessonNum, "note": self.note, "method": self.method}
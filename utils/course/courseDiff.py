@@ -0,0 +1,47 @@
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from utils.course.compactCourse import CompactCourse
+
+
+class CourseDiff(NamedTuple):
+    """两次刷新之间课程的变化"""
+    added: List[CompactCourse]
+    removed: List[CompactCourse]
+    changed: List[Tuple[CompactCourse, CompactCourse]]  # (旧, 新)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    @classmethod
+    def empty(cls) -> "CourseDiff":
+        return cls([], [], [])
+
+    def courses(self) -> Iterable[CompactCourse]:
+        """所有受影响的课程，变化的课程同时给出旧版本与新版本"""
+        yield from self.added
+        yield from self.removed
+        for old, new in self.changed:
+            yield old
+            yield new
+
+
+def diffCourses(old: Dict[str, CompactCourse], candidates: Iterable[CompactCourse]) -> Tuple[List[CompactCourse], List[Tuple[CompactCourse, CompactCourse]]]:
+    """按id与 updated 比较 candidates 与 old，返回 (新增, 修改)；只遍历 candidates"""
+    added: List[CompactCourse] = []
+    changed: List[Tuple[CompactCourse, CompactCourse]] = []
+    for course in candidates:
+        previous = old.get(course.id)
+        if previous is None:
+            added.append(course)
+        elif previous.updated != course.updated:
+            changed.append((previous, course))
+    return added, changed
+
+
+def diffCourseSets(old: Dict[str, CompactCourse], new: Dict[str, CompactCourse]) -> CourseDiff:
+    """全量比较两组课程"""
+    added, changed = diffCourses(old, new.values())
+    return CourseDiff(added, [course for courseId, course in old.items() if courseId not in new], changed)
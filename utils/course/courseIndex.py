@@ -0,0 +1,110 @@
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Set, Tuple, DefaultDict, Hashable
+
+from utils.course.compactCourse import dateOrdinalsOf, dateToOrdinal
+from utils.course.types import Course
+
+CourseId = str
+CourseIdSet = FrozenSet[CourseId]
+
+
+def _freeze(index: Mapping[Hashable, Set[CourseId]]) -> Dict[Hashable, CourseIdSet]:
+    return {key: frozenset(ids) for key, ids in index.items()}
+
+
+class CourseIndex:
+    """
+    课程的倒排索引：在每次刷新课程时构建一次，将各个筛选维度映射到课程id集合，
+    使 CourseDecorator 的筛选变为集合求交，而不必每次线性扫描全部课程。
+    """
+
+    def __init__(self, courses: List[Course]):
+        self.courses: Dict[CourseId, Course] = {course.id: course for course in courses}
+        # 保留接口返回的顺序（按 -updated 排序），以便筛选结果的顺序与原先一致
+        self.positions: Dict[CourseId, int] = {course.id: position for position, course in enumerate(courses)}
+        self.allIds: CourseIdSet = frozenset(self.courses)
+
+        byDate: DefaultDict[int, Set[CourseId]] = defaultdict(set)  # 以日序数为键
+        byGrade: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+        byLessonNum: DefaultDict[int, Set[CourseId]] = defaultdict(set)
+        byMethod: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+        byCourseName: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+        byTeacher: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+        byRoom: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+        byGradeGroup: DefaultDict[Tuple[str, str], Set[CourseId]] = defaultdict(set)
+        # 存在未指定“班级/小组”的 situation 的课程，按年级归类
+        ungroupedByGrade: DefaultDict[str, Set[CourseId]] = defaultdict(set)
+
+        for course in courses:
+            for ordinal in dateOrdinalsOf(course):
+                byDate[ordinal].add(course.id)
+            byGrade[course.grade].add(course.id)
+            byLessonNum[course.lessonNum].add(course.id)
+            byMethod[course.method].add(course.id)
+            byCourseName[course.info.name].add(course.id)
+            for situation in course.situations:
+                for teacher in situation.teachers or []:
+                    byTeacher[teacher].add(course.id)
+                for room in situation.rooms or []:
+                    byRoom[room].add(course.id)
+                if not situation.groups:
+                    ungroupedByGrade[course.grade].add(course.id)
+                for group in situation.groups or []:
+                    byGradeGroup[(course.grade, group)].add(course.id)
+
+        self.byDate: Dict[int, CourseIdSet] = _freeze(byDate)
+        self.byGrade: Dict[str, CourseIdSet] = _freeze(byGrade)
+        self.byLessonNum: Dict[int, CourseIdSet] = _freeze(byLessonNum)
+        self.byMethod: Dict[str, CourseIdSet] = _freeze(byMethod)
+        self.byCourseName: Dict[str, CourseIdSet] = _freeze(byCourseName)
+        self.byTeacher: Dict[str, CourseIdSet] = _freeze(byTeacher)
+        self.byRoom: Dict[str, CourseIdSet] = _freeze(byRoom)
+        self.byGradeGroup: Dict[Tuple[str, str], CourseIdSet] = _freeze(byGradeGroup)
+        self.ungroupedByGrade: Dict[str, CourseIdSet] = _freeze(ungroupedByGrade)
+
+    def __len__(self):
+        return len(self.courses)
+
+    @staticmethod
+    def _union(index: Mapping[Hashable, CourseIdSet], keys: Iterable[Hashable]) -> CourseIdSet:
+        ids: Set[CourseId] = set()
+        for key in keys:
+            ids.update(index.get(key, ()))
+        return frozenset(ids)
+
+    def idsOfDate(self, date: str) -> CourseIdSet:
+        return self.byDate.get(dateToOrdinal(date), frozenset())
+
+    def idsOfLessonNum(self, lessonNum: int) -> CourseIdSet:
+        return self.byLessonNum.get(lessonNum, frozenset())
+
+    def idsOfGrades(self, grades: Iterable[str]) -> CourseIdSet:
+        return self._union(self.byGrade, grades)
+
+    def idsOfMethods(self, methods: Iterable[str]) -> CourseIdSet:
+        return self._union(self.byMethod, methods)
+
+    def idsOfCourseNames(self, courseNames: Iterable[str]) -> CourseIdSet:
+        return self._union(self.byCourseName, courseNames)
+
+    def idsOfTeachers(self, teachers: Iterable[str]) -> CourseIdSet:
+        return self._union(self.byTeacher, teachers)
+
+    def idsOfRooms(self, rooms: Iterable[str]) -> CourseIdSet:
+        return self._union(self.byRoom, rooms)
+
+    def idsOfGradeGroups(self, groupsOfGrade: Mapping[str, Iterable[str]]) -> CourseIdSet:
+        """
+        与 CourseDecorator.filter_of_grade_groups 语义一致：课程的年级需在 groupsOfGrade 中，
+        且存在某个 situation 未指定“班级/小组”，或其“班级/小组”与该年级需要的 groups 有重叠
+        """
+        ids: Set[CourseId] = set()
+        for grade, groups in groupsOfGrade.items():
+            ids.update(self.ungroupedByGrade.get(grade, ()))
+            for group in groups:
+                ids.update(self.byGradeGroup.get((grade, group), ()))
+        return frozenset(ids)
+
+    def sortedCourses(self, ids: Iterable[CourseId]) -> List[Course]:
+        """按接口返回的原始顺序取出课程"""
+        return [self.courses[courseId] for courseId in sorted(ids, key=self.positions.__getitem__)]
@@ -0,0 +1,115 @@
+from typing import Dict, Iterable, List, Tuple
+
+from utils.course.types import Course
+from utils.metrics import registry
+
+cacheRequests = registry.counter("sillage_cache_requests", "缓存的查询次数", ["cache", "result"])
+fragmentHits, fragmentMisses = cacheRequests.labels("courseFragment", "hit"), cacheRequests.labels("courseFragment", "miss")
+digestHits, digestMisses = cacheRequests.labels("courseDigest", "hit"), cacheRequests.labels("courseDigest", "miss")
+
+FragmentKey = Tuple[str, str]  # (课程id, updated)
+DigestKey = Tuple[str, ...]  # 按顺序排列的课程id
+
+
+def decorateStr(s: str):
+    return s + "\n\n" if s else ""
+
+
+def renderCourse(c: Course) -> str:
+    courseStr = ""
+    courseStr += decorateStr(c.info.name)
+    courseStr += decorateStr(c.method)
+    if len(c.situations) >= 1:
+        courseStr += "\n\n".join(["丨".join([item for item in [
+            decorateStr("&".join(situ.groups) if situ.groups else "").strip(),
+            decorateStr("&".join(situ.teachers) if situ.teachers else "").strip(),
+            decorateStr("&".join(situ.rooms) if situ.rooms else "").strip()
+        ] if item]) for situ in c.situations])
+    courseStr += decorateStr(c.note)
+    return courseStr.strip()
+
+
+def renderCourseTitle(c: Course) -> str:
+    return f"{c.info.name}:" \
+           f"{','.join(['-'.join([_ for _ in ['&'.join(situ.groups or []), '&'.join(situ.rooms or [])] if _]) for situ in c.situations])}"
+
+
+class CourseRenderer:
+    """
+    分两步渲染课程摘要：每门课程的片段只渲染一次，按 (课程id, updated) 缓存；
+    整份摘要由片段拼接而成，按课程id的元组缓存。同一份摘要发给多个用户时只需渲染一次。
+    课程刷新后调用 retain 丢弃已失效的缓存。
+    """
+
+    maxDigests = 4096  # 缓存的摘要数量上限，超出时丢弃最早的
+
+    def __init__(self):
+        self.fragments: Dict[FragmentKey, str] = {}
+        self.titleFragments: Dict[FragmentKey, str] = {}
+        self.digests: Dict[DigestKey, str] = {}
+        self.titles: Dict[DigestKey, str] = {}
+
+    def clear(self):
+        self.fragments.clear()
+        self.titleFragments.clear()
+        self.digests.clear()
+        self.titles.clear()
+
+    def retain(self, courses: Iterable[Course]):
+        """只保留仍存在且未修改的课程的片段；摘要全部丢弃"""
+        keys = {(course.id, course.updated or "") for course in courses}
+        self.fragments = {key: value for key, value in self.fragments.items() if key in keys}
+        self.titleFragments = {key: value for key, value in self.titleFragments.items() if key in keys}
+        self.digests.clear()
+        self.titles.clear()
+
+    def fragmentOf(self, course: Course) -> str:
+        key = (course.id, course.updated or "")
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragmentMisses.inc()
+            fragment = self.fragments[key] = renderCourse(course)
+        else:
+            fragmentHits.inc()
+        return fragment
+
+    def titleFragmentOf(self, course: Course) -> str:
+        key = (course.id, course.updated or "")
+        fragment = self.titleFragments.get(key)
+        if fragment is None:
+            fragment = self.titleFragments[key] = renderCourseTitle(course)
+        return fragment
+
+    def remember(self, cache: Dict[DigestKey, str], key: DigestKey, value: str) -> str:
+        if len(cache) >= self.maxDigests:
+            del cache[next(iter(cache))]
+        cache[key] = value
+        return value
+
+    def render(self, courses: List[Course]) -> str:
+        """按第几节课分组拼接课程片段"""
+        key = tuple(course.id for course in courses)
+        digest = self.digests.get(key)
+        if digest is not None:
+            digestHits.inc()
+            return digest
+        digestMisses.inc()
+
+        coursesOfLessonNum: Dict[int, List[Course]] = {lessonNum: [] for lessonNum in range(1, 6)}
+        for course in courses:
+            if course.lessonNum in coursesOfLessonNum:
+                coursesOfLessonNum[course.lessonNum].append(course)
+        lessonNumStrList: List[str] = []
+        for lessonNum, coursesOfThisLessonNum in coursesOfLessonNum.items():
+            if len(coursesOfThisLessonNum):
+                lessonNumStr = f"# 第 {lessonNum} 节课\n\n"
+                lessonNumStr += "\n\n---\n\n".join([self.fragmentOf(c) for c in coursesOfThisLessonNum])
+                lessonNumStrList.append(lessonNumStr.strip())
+        return self.remember(self.digests, key, f"\n\n---\n\n".join(lessonNumStrList))
+
+    def renderTitle(self, courses: List[Course]) -> str:
+        key = tuple(course.id for course in courses)
+        title = self.titles.get(key)
+        if title is not None:
+            return title
+        return self.remember(self.titles, key, "丨".join([self.titleFragmentOf(course) for course in courses]))
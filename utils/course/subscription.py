@@ -0,0 +1,92 @@
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Optional, Tuple, List
+from urllib.parse import urlparse, parse_qs
+
+from utils.course.apiHandler import CourseDecorator
+from utils.course.types import Course, QueryParseResult
+
+
+def urlStrip(url: str):
+    return re.sub(r"https?://[a-z]+\.siae.top/#/", "", url)
+
+
+def _frozen(values: Optional[list]) -> FrozenSet[str]:
+    return frozenset(values) if values else frozenset()
+
+
+@dataclass(frozen=True)
+class CompiledSubscription:
+    """
+    预先编译好的订阅条件。仅在刷新用户时解析一次订阅网址，之后各任务直接使用该对象筛选课程。
+    空集合表示该维度不做限制；对象不可变且可哈希，可用于对相同的订阅去重。
+    """
+    grades: FrozenSet[str] = frozenset()
+    rooms: FrozenSet[str] = frozenset()
+    methods: FrozenSet[str] = frozenset()
+    teachers: FrozenSet[str] = frozenset()
+    subjects: FrozenSet[str] = frozenset()
+    gradeGroups: FrozenSet[Tuple[str, str]] = frozenset()
+    # 由 gradeGroups 预先计算出的 年级 -> 班级/小组 映射
+    groupsOfGrade: Dict[str, FrozenSet[str]] = field(default_factory=dict, init=False, compare=False, hash=False, repr=False)
+
+    def __post_init__(self):
+        groupsOfGrade: Dict[str, set] = {}
+        for grade, group in self.gradeGroups:
+            groupsOfGrade.setdefault(grade, set()).add(group)
+        object.__setattr__(self, "groupsOfGrade", {grade: frozenset(groups) for grade, groups in groupsOfGrade.items()})
+
+    @classmethod
+    def fromUrl(cls, subscribedUrl: str) -> "CompiledSubscription":
+        urlParseResult = urlparse(urlStrip(subscribedUrl))
+        queryParseResult = QueryParseResult(**parse_qs(urlParseResult.query))
+        return cls(grades=_frozen(queryParseResult.grade),
+                   rooms=_frozen(queryParseResult.room),
+                   methods=_frozen(queryParseResult.method),
+                   teachers=_frozen(queryParseResult.teacher),
+                   subjects=_frozen(queryParseResult.subject),
+                   gradeGroups=frozenset(tuple(json.loads(gg)) for gg in queryParseResult.group or []))
+
+    def toDict(self) -> Dict[str, List]:
+        return {"grades": sorted(self.grades), "rooms": sorted(self.rooms), "methods": sorted(self.methods),
+                "teachers": sorted(self.teachers), "subjects": sorted(self.subjects), "gradeGroups": sorted(self.gradeGroups)}
+
+    @classmethod
+    def fromDict(cls, data: Dict[str, List]) -> "CompiledSubscription":
+        return cls(grades=frozenset(data.get("grades", [])),
+                   rooms=frozenset(data.get("rooms", [])),
+                   methods=frozenset(data.get("methods", [])),
+                   teachers=frozenset(data.get("teachers", [])),
+                   subjects=frozenset(data.get("subjects", [])),
+                   gradeGroups=frozenset(tuple(gg) for gg in data.get("gradeGroups", [])))
+
+    def apply(self, courseDecorator: CourseDecorator) -> CourseDecorator:
+        """筛选出符合订阅条件的课程"""
+        courseDecorator = courseDecorator.filter_grades(self.grades) if self.grades else courseDecorator
+        courseDecorator = courseDecorator.filter_of_rooms(self.rooms) if self.rooms else courseDecorator
+        courseDecorator = courseDecorator.filter_of_methods(self.methods) if self.methods else courseDecorator
+        courseDecorator = courseDecorator.filter_of_teachers(self.teachers) if self.teachers else courseDecorator
+        courseDecorator = courseDecorator.filter_of_grade_group_map(self.groupsOfGrade) if self.gradeGroups else courseDecorator
+        courseDecorator = courseDecorator.filter_of_course_names(self.subjects) if self.subjects else courseDecorator
+        return courseDecorator
+
+    def match(self, course: Course) -> bool:
+        """判断单个课程是否符合订阅条件"""
+        if self.grades and course.grade not in self.grades:
+            return False
+        if self.methods and course.method not in self.methods:
+            return False
+        if self.subjects and course.info.name not in self.subjects:
+            return False
+        if self.rooms and not any(self.rooms.intersection(situ.rooms or ()) for situ in course.situations):
+            return False
+        if self.teachers and not any(self.teachers.intersection(situ.teachers or ()) for situ in course.situations):
+            return False
+        if self.gradeGroups:
+            if course.grade not in self.groupsOfGrade:
+                return False
+            groupsOfThisGrade = self.groupsOfGrade[course.grade]
+            if not any((not situ.groups) or groupsOfThisGrade.intersection(situ.groups) for situ in course.situations):
+                return False
+        return True
@@ -0,0 +1,58 @@
+from collections import defaultdict
+from typing import DefaultDict, Dict, FrozenSet, Iterable, List, Set
+
+from utils.course.subscription import CompiledSubscription
+from utils.course.types import Course
+
+
+class SubscriptionIndex:
+    """
+    从课程属性到订阅的反向索引：每个订阅只登记在它限制的一个维度（按年级、班级/小组的年级、课程名称、教师、教室、课程性质的顺序）下，
+    查询时按课程的属性取出候选订阅，再用 CompiledSubscription.match 逐个确认。
+    查询的开销与候选订阅数成正比，而不是与全部订阅数成正比。
+    """
+
+    def __init__(self, subscriptions: Iterable[CompiledSubscription]):
+        self.byGrade: DefaultDict[str, List[CompiledSubscription]] = defaultdict(list)
+        self.byCourseName: DefaultDict[str, List[CompiledSubscription]] = defaultdict(list)
+        self.byTeacher: DefaultDict[str, List[CompiledSubscription]] = defaultdict(list)
+        self.byRoom: DefaultDict[str, List[CompiledSubscription]] = defaultdict(list)
+        self.byMethod: DefaultDict[str, List[CompiledSubscription]] = defaultdict(list)
+        self.unconstrained: List[CompiledSubscription] = []  # 不做任何限制的订阅
+
+        for subscription in dict.fromkeys(subscriptions):
+            if subscription.grades:
+                self.register(self.byGrade, subscription.grades, subscription)
+            elif subscription.gradeGroups:
+                self.register(self.byGrade, frozenset(subscription.groupsOfGrade), subscription)
+            elif subscription.subjects:
+                self.register(self.byCourseName, subscription.subjects, subscription)
+            elif subscription.teachers:
+                self.register(self.byTeacher, subscription.teachers, subscription)
+            elif subscription.rooms:
+                self.register(self.byRoom, subscription.rooms, subscription)
+            elif subscription.methods:
+                self.register(self.byMethod, subscription.methods, subscription)
+            else:
+                self.unconstrained.append(subscription)
+
+    @staticmethod
+    def register(index: Dict[str, List[CompiledSubscription]], keys: FrozenSet[str], subscription: CompiledSubscription):
+        for key in keys:
+            index[key].append(subscription)
+
+    def candidatesOf(self, course: Course) -> Set[CompiledSubscription]:
+        candidates: Set[CompiledSubscription] = set(self.unconstrained)
+        candidates.update(self.byGrade.get(course.grade, ()))
+        candidates.update(self.byCourseName.get(course.info.name, ()))
+        candidates.update(self.byMethod.get(course.method, ()))
+        for situation in course.situations:
+            for teacher in situation.teachers or ():
+                candidates.update(self.byTeacher.get(teacher, ()))
+            for room in situation.rooms or ():
+                candidates.update(self.byRoom.get(room, ()))
+        return candidates
+
+    def subscriptionsOf(self, course: Course) -> Set[CompiledSubscription]:
+        """订阅了该课程的订阅条件"""
+        return {subscription for subscription in self.candidatesOf(course) if subscription.match(course)}
@@ -0,0 +1,35 @@
+import unittest
+
+from utils.course.apiHandler import CourseDecorator
+from utils.course.courseIndex import CourseIndex
+from utils.course.types import Course
+
+
+def courseOf(id_: str, groups, rooms) -> Course:
+    return Course(id=id_, created=None, updated=None, info={"name": "课程", "code": None, "bgc": "#ffffff"},
+                  situations=[{"groups": groups, "teachers": ["教师"], "rooms": rooms}], grade="24级",
+                  dates=["2024-03-04"], lessonNum=1, note="", method="CM")
+
+
+class CourseDecoratorTester(unittest.TestCase):
+    def setUp(self):
+        # 班级名称与另一门课程的教室同名，用于区分按教室与按班级筛选
+        self.courses = [courseOf("a", ["101"], ["教室1"]), courseOf("b", ["A班"], ["101"]), courseOf("c", None, None)]
+
+    def test_situItemsRoomsAreRooms(self):
+        situItems = CourseDecorator(self.courses).get_situ_items()
+        self.assertEqual(sorted(situItems.rooms), ["101", "教室1"])
+        self.assertEqual(sorted(situItems.groups), ["101", "A班"])
+        self.assertEqual(CourseDecorator(self.courses[0]).get_situ_items().rooms, ["教室1"])
+
+    def test_filterOfRoomsMatchesIndex(self):
+        plain = CourseDecorator(self.courses)
+        indexed = CourseDecorator(self.courses, CourseIndex(self.courses))
+        for rooms in (["101"], ["教室1"], ["A班"], []):
+            self.assertEqual([course.id for course in plain.filter_of_rooms(rooms).value],
+                             [course.id for course in indexed.filter_of_rooms(rooms).value], rooms)
+        self.assertEqual([course.id for course in plain.filter_of_rooms(["101"]).value], ["b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
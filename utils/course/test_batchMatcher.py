@@ -0,0 +1,57 @@
+import datetime
+import unittest
+
+from benchmark.synthetic import SemesterConfig, generateSemester, generateSubscribers, subscriptionUrl
+from utils.course.apiHandler import ApiHandler
+from utils.course.batchMatcher import BatchMatcher, numpy
+from utils.course.compactCourse import CompactCourse
+from utils.course.subscription import CompiledSubscription
+
+
+class BatchMatcherTester(unittest.TestCase):
+    def setUp(self):
+        self.semester = generateSemester(SemesterConfig(courses=300, teachers=30, rooms=15, courseNames=20), start=datetime.date(2024, 3, 4))
+        self.handler = ApiHandler()
+        # 先登记课程中不会出现的名称，模拟 NameTable 只增不减
+        for i in range(500):
+            self.handler.nameTable.intern(f"已删除的教师{i}")
+        courses = [CompactCourse.fromRaw(rawCourse, self.handler.nameTable) for rawCourse in self.semester.rawCourses]
+        self.handler.setCourses({course.id: course for course in courses})
+        urls = [url for _, url in generateSubscribers(self.semester, 300)]
+        urls += [subscriptionUrl(teacher=["已删除的教师1"]), subscriptionUrl(teacher=["不存在的教师", self.semester.teachers[0]]),
+                 subscriptionUrl(grade=[self.semester.grades[0]], group=['["不存在的年级", "A班"]']),
+                 subscriptionUrl(grade=[self.semester.grades[1]], method=["TD"], room=[self.semester.rooms[0]]),
+                 subscriptionUrl()]
+        self.subscriptions = list(dict.fromkeys(CompiledSubscription.fromUrl(url) for url in urls))
+
+    def expected(self, date: str):
+        return [[course.id for course in subscription.apply(self.handler.courseDecorator).filter_of_date(date).value]
+                for subscription in self.subscriptions]
+
+    def matched(self, matcher: BatchMatcher, date: str):
+        courses = self.handler.courseDecorator.value
+        return [[courses[position].id for position in positions] for positions in matcher.match(self.subscriptions, date)]
+
+    def assertSameAsApply(self, useNumpy: bool):
+        matcher = BatchMatcher(self.handler.courseDecorator.value, self.handler.nameTable, useNumpy=useNumpy)
+        for days in (0, 1, 7, 365):
+            date = (self.semester.start + datetime.timedelta(days=days)).isoformat()
+            self.assertEqual(self.matched(matcher, date), self.expected(date), date)
+
+    def test_bitset(self):
+        self.assertSameAsApply(False)
+
+    @unittest.skipIf(numpy is None, "未安装 NumPy")
+    def test_numpy(self):
+        self.assertSameAsApply(True)
+
+    @unittest.skipIf(numpy is None, "未安装 NumPy")
+    def test_matrixSizeIndependentOfNameTable(self):
+        matcher = BatchMatcher(self.handler.courseDecorator.value, self.handler.nameTable, useNumpy=True)
+        self.assertEqual(matcher.teacherMatrix.shape, (len(self.semester.teachers), len(self.handler.courses)))
+        self.assertLessEqual(matcher.roomMatrix.shape[0], len(self.semester.rooms))
+        self.assertLess(len(matcher.gradeRows), len(self.handler.nameTable))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import datetime
+import unittest
+
+from benchmark.mockServers import MockPocketBase, MockServerConfig, mockTransport
+from benchmark.synthetic import SemesterConfig, generateSemester, subscriptionUrl
+from utils.course.apiHandler import ApiHandler
+from utils.course.compactCourse import CompactCourse, NameTable
+from utils.course.subscription import CompiledSubscription
+from utils.httpClient import HttpClientPool
+
+
+def rawCourseOf(id_: str, teacher: str, dates=("2024-03-05", "2024-03-04")) -> dict:
+    return {"id": id_, "created": None, "updated": "2024-01-01", "info": {"name": "课程", "code": None, "bgc": "#ffffff"},
+            "situations": [{"groups": ["A班"], "teachers": [teacher], "rooms": ["教室"]}], "grade": "24级",
+            "dates": list(dates), "lessonNum": 1, "note": "", "method": "CM"}
+
+
+class CompactCourseTester(unittest.TestCase):
+    def test_hashable(self):
+        nameTable = NameTable()
+        course = CompactCourse.fromDict(rawCourseOf("a", "教师"), nameTable)
+        same = CompactCourse.fromDict(rawCourseOf("a", "教师"), nameTable)
+        self.assertEqual(len({course, same}), 1)
+        self.assertEqual(course.dates, ["2024-03-04", "2024-03-05"])
+        self.assertTrue(course.hasDate("2024-03-05"))
+        self.assertFalse(course.hasDate("2024-03-06"))
+
+    def test_loadSnapshotReplacesNameTable(self):
+        handler = ApiHandler()
+        handler.loadSnapshot({"courses": [rawCourseOf("a", "旧教师")]})
+        handler.loadSnapshot({"courses": [rawCourseOf("a", "新教师")]})
+        self.assertIsNone(handler.nameTable.idOf("旧教师"))
+        self.assertEqual(handler.courseDecorator.filter_of_teachers(["新教师"]).value[0].id, "a")
+
+
+class FullSyncTester(unittest.IsolatedAsyncioTestCase):
+    async def test_fullSyncDropsStaleNames(self):
+        semester = generateSemester(SemesterConfig(courses=50), start=datetime.date(2024, 3, 4))
+        handler = ApiHandler(HttpClientPool(asyncTransport=mockTransport(MockPocketBase(semester.rawCourses, MockServerConfig(latency=0)))))
+        try:
+            await handler.refreshCourses()
+            handler.nameTable.intern("已删除的教师")  # 如之前增量同步时出现、之后被删除的名称
+            handler.lastFullSync = None
+            await handler.refreshCourses()
+            self.assertIsNone(handler.nameTable.idOf("已删除的教师"))
+            self.assertEqual(len(handler.courses), 50)
+            subscription = CompiledSubscription.fromUrl(subscriptionUrl(teacher=[semester.teachers[0]]))
+            self.assertEqual([course.id for course in handler.matchSubscriptions([subscription])[0].value],
+                             [course.id for course in subscription.apply(handler.courseDecorator).value])
+        finally:
+            await handler.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from utils.course.compactCourse import CompactCourse, NameTable
+from utils.course.courseDiff import CourseDiff, diffCourses, diffCourseSets
+
+nameTable = NameTable()
+
+
+def courseOf(id_: str, updated: str) -> CompactCourse:
+    return CompactCourse.build(nameTable, id_, None, updated, "课程", None, "#ffffff", [(["A班"], ["教师"], ["教室"])],
+                               "24级", ["2024-03-04"], 1, "", "CM")
+
+
+class CourseDiffTester(unittest.TestCase):
+    def setUp(self):
+        self.old = {course.id: course for course in (courseOf("a", "1"), courseOf("b", "1"), courseOf("c", "1"))}
+
+    def test_diffCourses(self):
+        added, changed = diffCourses(self.old, [courseOf("a", "1"), courseOf("b", "2"), courseOf("d", "2")])
+        self.assertEqual([course.id for course in added], ["d"])
+        self.assertEqual([(old.updated, new.updated) for old, new in changed], [("1", "2")])
+        self.assertEqual(changed[0][0].id, "b")
+
+    def test_diffCourseSets(self):
+        new = {course.id: course for course in (courseOf("a", "1"), courseOf("b", "2"), courseOf("d", "2"))}
+        courseDiff = diffCourseSets(self.old, new)
+        self.assertEqual(([course.id for course in courseDiff.added], [course.id for course in courseDiff.removed]), (["d"], ["c"]))
+        self.assertEqual(len(courseDiff), 3)
+        self.assertEqual([(course.id, course.updated) for course in courseDiff.courses()], [("d", "2"), ("c", "1"), ("b", "1"), ("b", "2")])
+
+    def test_empty(self):
+        self.assertFalse(CourseDiff.empty())
+        self.assertFalse(diffCourseSets(self.old, dict(self.old)))
+        self.assertEqual(len(CourseDiff.empty()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 from utils.dingtalk.dingTalkHandler import DingTalkHandler
+from utils.lazy import LazyHandler
 
-dingTalkHandler = DingTalkHandler("settings.db")
+dingTalkHandler: DingTalkHandler = LazyHandler(lambda: DingTalkHandler("settings.db"))
 
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Set
+
+from loguru import logger
+from tqdm import tqdm
+
+from utils.dingtalk.types import AddressBook, DepartmentId, DepartmentName, UserDetail, UserId
+
+ROOT_DEPARTMENT_ID: DepartmentId = 1
+
+
+class AddressBookCrawler:
+    """
+    并发、可断点续传的通讯录爬取：按广度优先遍历部门树，同时处理多个部门（由限流器控制速率），
+    每个用户的详细信息只获取一次；定期将进度写入检查点文件，中断后再次运行会从检查点继续。
+    """
+
+    def __init__(self, dingTalkHandler, checkpointFileName: str, concurrency: int = 4, checkpointInterval: float = 5.0):
+        self.dingTalkHandler = dingTalkHandler
+        self.checkpointFileName = checkpointFileName
+        self.concurrency = concurrency  # 同时处理的部门数
+        self.checkpointInterval = checkpointInterval  # 写入检查点的最短间隔（秒）
+
+        self.pending: List[DepartmentId] = [ROOT_DEPARTMENT_ID]  # 待处理的部门
+        self.departments: Dict[DepartmentId, Dict] = {}  # 已处理的部门: dept_id -> {"dept_name", "userids"}
+        self.users: Dict[UserId, UserDetail] = {}  # 已获取的用户详细信息
+        self.checkpointedAt = 0.0
+
+    def loadCheckpoint(self) -> bool:
+        if not os.path.exists(self.checkpointFileName):
+            return False
+        try:
+            with open(self.checkpointFileName, encoding="utf-8") as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取通讯录检查点失败，将重新获取: {e}")
+            return False
+        self.pending = checkpoint["pending"]
+        self.departments = {int(deptId): department for deptId, department in checkpoint["departments"].items()}
+        self.users = checkpoint["users"]
+        logger.info(f"从检查点继续获取通讯录：已完成{len(self.departments)}个部门，待处理{len(self.pending)}个部门")
+        return True
+
+    def saveCheckpoint(self, inProgress: Set[DepartmentId]):
+        # 处理中的部门也记为待处理，恢复时重新处理
+        checkpoint = {"pending": sorted(set(self.pending) | inProgress), "departments": self.departments, "users": self.users}
+        tempFileName = f"{self.checkpointFileName}.tmp"
+        with open(tempFileName, "wt", encoding="utf-8") as file:
+            json.dump(checkpoint, file, ensure_ascii=False)
+        os.replace(tempFileName, self.checkpointFileName)
+        self.checkpointedAt = time.monotonic()
+
+    async def getSimpleUserIdList(self, deptId: DepartmentId) -> List[UserId]:
+        url = "https://oapi.dingtalk.com/topapi/user/listsimple"
+        userIdList: List[UserId] = []
+        cursor = 0
+        while True:
+            data = dict(dept_id=deptId, cursor=cursor, size=100)
+            response = await self.dingTalkHandler.getDingTalkResponse("POST", url, json=data)
+            userIdList += [simpleUser["userid"] for simpleUser in response["result"]["list"]]
+            if not response["result"]["has_more"]:
+                return userIdList
+            cursor = response["result"]["next_cursor"]
+
+    async def crawlDepartment(self, deptId: DepartmentId) -> List[DepartmentId]:
+        """获取部门的名称与成员，返回其子部门"""
+        deptName: DepartmentName
+        subDeptIdList, deptName, userIdList = await asyncio.gather(self.dingTalkHandler.getSubDepartmentIdList(deptId),
+                                                                   self.dingTalkHandler.getDepartmentName(deptId),
+                                                                   self.getSimpleUserIdList(deptId))
+        newUserIdList = [userId for userId in dict.fromkeys(userIdList) if userId not in self.users]
+        for userId, userDetail in zip(newUserIdList, await asyncio.gather(*[self.dingTalkHandler.getUserDetail(userId) for userId in newUserIdList])):
+            self.users[userId] = userDetail
+        self.departments[deptId] = {"dept_name": deptName, "userids": userIdList}
+        return subDeptIdList
+
+    async def crawl(self) -> AddressBook:
+        self.loadCheckpoint()
+
+        queue: asyncio.Queue = asyncio.Queue()
+        waiting: List[DepartmentId] = list(dict.fromkeys(self.pending))  # 与 queue 中的部门一致，用于写入检查点
+        for deptId in waiting:
+            queue.put_nowait(deptId)
+        inProgress: Set[DepartmentId] = set()
+        failed: Set[DepartmentId] = set()
+        errors: List[Exception] = []
+        progress = tqdm(desc="正在获取部门成员信息", initial=len(self.departments), total=len(self.departments) + len(waiting))
+
+        def checkpoint():
+            self.pending = waiting + list(failed)
+            self.saveCheckpoint(inProgress)
+
+        async def worker():
+            while True:
+                deptId = await queue.get()
+                waiting.remove(deptId)
+                try:
+                    if deptId in self.departments:
+                        continue
+                    inProgress.add(deptId)
+                    try:
+                        subDeptIdList = await self.crawlDepartment(deptId)
+                    except Exception as e:
+                        # 失败的部门留待下次从检查点恢复时重试
+                        logger.error(f"获取部门{deptId}的信息时出错: {e}")
+                        failed.add(deptId)
+                        errors.append(e)
+                        continue
+                    finally:
+                        inProgress.discard(deptId)
+                    waiting.extend(subDeptIdList)
+                    for subDeptId in subDeptIdList:
+                        queue.put_nowait(subDeptId)
+                    progress.total += len(subDeptIdList)
+                    progress.update()
+                    if time.monotonic() - self.checkpointedAt >= self.checkpointInterval:
+                        checkpoint()
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await queue.join()
+        except BaseException:
+            checkpoint()
+            raise
+        finally:
+            for task in workers:
+                task.cancel()
+            progress.close()
+
+        if errors:
+            checkpoint()
+            raise errors[0]
+
+        if os.path.exists(self.checkpointFileName):
+            os.remove(self.checkpointFileName)
+        return [{"dept_id": deptId, "dept_name": department["dept_name"], "users": [self.users[userId] for userId in department["userids"]]}
+                for deptId, department in self.departments.items()]
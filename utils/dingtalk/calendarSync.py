@@ -0,0 +1,217 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import sqlite3
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from loguru import logger
+
+from utils.dingtalk.dingTalkHandler import DingTalkHandler
+from utils.dingtalk.outbox import Effect, Outbox
+from utils.dingtalk.types import UnionId
+
+EventKey = Tuple[UnionId, str, int]  # (unionId, 日期, 第几节课)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendar_events (
+    union_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    lesson_num INTEGER NOT NULL,
+    event_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (union_id, date, lesson_num)
+);
+"""
+
+
+@lru_cache(maxsize=4096)
+def contentHashOf(title: str, content: str, startTime: datetime.datetime, endTime: datetime.datetime, remindMin: int) -> str:
+    # 订阅相同的用户日程内容也相同，只需计算一次
+    content = json.dumps([title, content, startTime.isoformat(), endTime.isoformat(), remindMin], ensure_ascii=False)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class CalendarEventPlan(NamedTuple):
+    """某用户某天某节课应当存在的日程"""
+    unionId: UnionId
+    date: str
+    lessonNum: int
+    title: str
+    content: str
+    startTime: datetime.datetime
+    endTime: datetime.datetime
+    remindMin: int
+
+    @property
+    def key(self) -> EventKey:
+        return self.unionId, self.date, self.lessonNum
+
+    @property
+    def contentHash(self) -> str:
+        return contentHashOf(self.title, self.content, self.startTime, self.endTime, self.remindMin)
+
+    def toDict(self) -> Dict:
+        return {**self._asdict(), "startTime": self.startTime.isoformat(), "endTime": self.endTime.isoformat()}
+
+    @classmethod
+    def fromDict(cls, data: Dict) -> "CalendarEventPlan":
+        return cls(**{**data, "startTime": datetime.datetime.fromisoformat(data["startTime"]),
+                      "endTime": datetime.datetime.fromisoformat(data["endTime"])})
+
+
+class CalendarSync:
+    """
+    幂等的日程同步：记录已创建日程的id与内容哈希，只创建新的日程、更新内容变化的日程、删除不再需要的日程；
+    内容未变化的日程直接跳过，因此重复执行不会产生重复的日程。
+    提供 outbox 时，sync 只把操作写入发件箱，由发件箱的后台任务调用 runOperation 执行；
+    日程记录保存在发件箱的数据库中，与标记操作完成在同一个事务中写入，重启后不会重复创建已创建的日程。
+    未提供 outbox 时只保存在内存中。
+    """
+
+    outboxKind = "calendar"
+
+    def __init__(self, dingTalkHandler: DingTalkHandler, outbox: Optional[Outbox] = None):
+        self.dingTalkHandler = dingTalkHandler
+        self.outbox = outbox
+        self.locks: Dict[EventKey, asyncio.Lock] = {}  # 同一日程的操作按写入发件箱的顺序依次执行
+        self.events: Dict[EventKey, Tuple[str, str]] = {}  # (unionId, 日期, 第几节课) -> (日程id, 内容哈希)，数据库中记录的缓存
+        if outbox is not None:
+            with outbox.connection:
+                outbox.connection.executescript(SCHEMA)
+            rows = outbox.connection.execute("SELECT union_id, date, lesson_num, event_id, content_hash FROM calendar_events")
+            self.events = {(unionId, date, lessonNum): (eventId, contentHash) for unionId, date, lessonNum, eventId, contentHash in rows}
+
+    def merge(self, records: Iterable[Iterable]) -> int:
+        """合并 [unionId, 日期, 第几节课, 日程id, 内容哈希] 形式的记录（已有的记录不覆盖），返回合并的条数"""
+        merged = [(unionId, date, lessonNum, eventId, contentHash) for unionId, date, lessonNum, eventId, contentHash in records
+                  if (unionId, date, lessonNum) not in self.events]
+        for unionId, date, lessonNum, eventId, contentHash in merged:
+            self.events[(unionId, date, lessonNum)] = (eventId, contentHash)
+        if merged and self.outbox is not None:
+            with self.outbox.connection:
+                self.outbox.connection.executemany("INSERT OR IGNORE INTO calendar_events VALUES (?, ?, ?, ?, ?)", merged)
+        return len(merged)
+
+    def adopt(self, fileName: str, unionIds: Set[UnionId]) -> int:
+        """接管其他进程的用户时，从它的发件箱数据库中合并这些用户的日程记录，返回合并的条数"""
+        connection = sqlite3.connect(fileName)
+        try:
+            rows = connection.execute("SELECT union_id, date, lesson_num, event_id, content_hash FROM calendar_events").fetchall()
+        except sqlite3.OperationalError:  # 该进程还未创建日程记录表
+            rows = []
+        finally:
+            connection.close()
+        return self.merge(row for row in rows if row[0] in unionIds)
+
+    def dates(self) -> Set[str]:
+        """已同步过日程的日期"""
+        return {key[1] for key in self.events}
+
+    def prune(self, beforeDate: str):
+        """丢弃早于 beforeDate 的记录"""
+        self.events = {key: value for key, value in self.events.items() if key[1] >= beforeDate}
+        if self.outbox is not None:
+            with self.outbox.connection:
+                self.outbox.connection.execute("DELETE FROM calendar_events WHERE date < ?", (beforeDate,))
+        self.locks = {key: lock for key, lock in self.locks.items() if key[1] >= beforeDate or lock.locked()}
+
+    async def create(self, plan: CalendarEventPlan):
+        response = await self.dingTalkHandler.createCalendar(plan.title, plan.content, [plan.unionId], plan.startTime, plan.endTime, plan.remindMin)
+        if response.status_code != 200:
+            raise Exception(f"为{plan.unionId}创建{plan.date}第{plan.lessonNum}节课的日程失败: {response.text}")
+        self.events[plan.key] = (response.json()["id"], plan.contentHash)
+
+    async def update(self, eventId: str, plan: CalendarEventPlan):
+        response = await self.dingTalkHandler.updateCalendar(eventId, plan.title, plan.content, [plan.unionId],
+                                                             plan.startTime, plan.endTime, plan.remindMin)
+        if response.status_code == 404:  # 日程已被用户删除，重新创建
+            self.events.pop(plan.key, None)
+            await self.create(plan)
+        elif response.status_code != 200:
+            raise Exception(f"更新{plan.unionId}在{plan.date}第{plan.lessonNum}节课的日程失败: {response.text}")
+        else:
+            self.events[plan.key] = (eventId, plan.contentHash)
+
+    async def delete(self, key: EventKey):
+        eventId, _ = self.events[key]
+        response = await self.dingTalkHandler.deleteCalendar(key[0], eventId)
+        if response.status_code not in (200, 204, 404):
+            raise Exception(f"删除{key[0]}在{key[1]}第{key[2]}节课的日程失败: {response.text}")
+        self.events.pop(key, None)
+
+    @staticmethod
+    def persist(key: EventKey, value: Optional[Tuple[str, str]]) -> Effect:
+        """把某日程的记录写入数据库（value 为 None 时删除），由发件箱在标记操作完成的事务中执行"""
+        def effect(connection: sqlite3.Connection):
+            if value is None:
+                connection.execute("DELETE FROM calendar_events WHERE union_id = ? AND date = ? AND lesson_num = ?", key)
+            else:
+                connection.execute("INSERT OR REPLACE INTO calendar_events VALUES (?, ?, ?, ?, ?)", (*key, *value))
+
+        return effect
+
+    async def runOperation(self, operation: Dict) -> Optional[Effect]:
+        """
+        执行发件箱中的一次日程操作。执行前对照当前记录：已是目标状态的操作直接跳过，
+        因此同一操作被重复执行（如崩溃后重发）不会产生重复的日程。
+        返回写入该日程记录的 effect，由发件箱与标记完成一起提交
+        """
+        plan = CalendarEventPlan.fromDict(operation["plan"]) if operation["op"] == "upsert" else None
+        key: EventKey = plan.key if plan is not None else tuple(operation["key"])
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            current = self.events.get(key)
+            if plan is None:
+                if current is None:
+                    return None
+                await self.delete(key)
+            elif current is None:
+                await self.create(plan)
+            elif current[1] != plan.contentHash:
+                await self.update(current[0], plan)
+            else:
+                return None
+            return self.persist(key, self.events.get(key))
+
+    def enqueue(self, operations: List[Tuple[Dict, str]]):
+        """在同一个事务中写入发件箱；operations 为 (操作, 幂等键) 列表"""
+        self.outbox.enqueueMany([(self.outboxKind, operation, f"{self.outboxKind}:{idempotencyKey}") for operation, idempotencyKey in operations],
+                                rearmFinished=True)
+
+    async def sync(self, date: str, unionIds: Iterable[UnionId], plans: List[CalendarEventPlan]) -> Dict[str, int]:
+        """
+        将 unionIds 中各用户在 date 当天的日程同步为 plans，返回各类操作的次数\n
+        :param plans: 只需包含有课程的时段
+        """
+        planOfKey: Dict[EventKey, CalendarEventPlan] = {plan.key: plan for plan in plans}
+        unionIds = set(unionIds)
+
+        tasks = []
+        operations: List[Tuple[Dict, str]] = []
+        counts = {"created": 0, "updated": 0, "deleted": 0, "skipped": 0}
+        for key, plan in planOfKey.items():
+            contentHash = plan.contentHash
+            if key in self.events and self.events[key][1] == contentHash:
+                counts["skipped"] += 1
+                continue
+            counts["updated" if key in self.events else "created"] += 1
+            if self.outbox is not None:
+                operations.append(({"op": "upsert", "plan": plan.toDict()}, f"{plan.unionId}:{date}:{plan.lessonNum}:{contentHash}"))
+            elif key in self.events:
+                tasks.append(self.update(self.events[key][0], plan))
+            else:
+                tasks.append(self.create(plan))
+        for key in [key for key in self.events if key[1] == date and key[0] in unionIds and key not in planOfKey]:
+            counts["deleted"] += 1
+            if self.outbox is not None:
+                operations.append(({"op": "delete", "key": list(key)}, f"{key[0]}:{date}:{key[2]}:{self.events[key][0]}:delete"))
+            else:
+                tasks.append(self.delete(key))
+        if operations:
+            self.enqueue(operations)
+
+        for result in await asyncio.gather(*tasks, return_exceptions=True):  # 由限流器控制并发与速率
+            if isinstance(result, BaseException):
+                logger.error(f"同步{date}的日程时出错: {result}")
+        return counts
@@ -1,155 +1,249 @@
 import json
 import datetime
+import time
+
+from typing import AsyncIterator
+from urllib.parse import urlparse
 
 import httpx
-from tqdm import tqdm
+from loguru import logger
 import asyncio
 
+from utils.dingtalk.addressBookCrawler import AddressBookCrawler
+from utils.dingtalk.rateLimiter import RateLimiter, isThrottled
+from utils.dingtalk.settingsStore import SettingsStore
+from utils.dingtalk.tokenManager import TokenManager, isTokenInvalid
 from utils.dingtalk.types import *
+from utils.dingtalk.unionIdCache import UnionIdCache
+from utils.httpClient import HttpClientPool
+from utils.metrics import registry
+from utils.tracing import span, traced
 
-
-def getSettings(settingFileName) -> Settings:
-    import json
-    _settings = dict()
-    try:
-        with open(settingFileName, encoding="utf-8") as settings_json:
-            print(f"\nTIPS：已自动加载缓存。若需重新输入密钥等敏感信息，请删除配置文件”{settingFileName}“\n")
-            _settings = json.load(settings_json)
-    finally:
-        return _settings
-
-
-def outputSettings(settings: Settings, settingFileName):
-    with open(settingFileName, "wt", encoding="utf-8") as file:
-        json.dump(settings, file, ensure_ascii=False)
+requestSeconds = registry.histogram("sillage_dingtalk_request_seconds", "钉钉接口单次请求的耗时（不含限流等待与退避）", ["endpoint"])
+responses = registry.counter("sillage_dingtalk_responses", "钉钉接口的响应数，errcode 为旧版接口的 errcode、新版接口的 code（成功时为 0）", ["endpoint", "errcode"])
+throttledResponses = registry.counter("sillage_dingtalk_throttled", "被钉钉限流的次数", ["endpoint"])
 
 
 class DingTalkHandler:
-    def __init__(self, settingFileName: str = "settings.json"):
+    maxUserIdListLength = 100  # 工作通知每次最多发送给100个用户
+    headerTokenHosts = {"api.dingtalk.com"}  # 新版接口通过请求头传递 AccessToken，旧版接口通过 access_token 参数
+
+    def __init__(self, settingFileName: str = "settings.db", httpClientPool: Optional[HttpClientPool] = None,
+                 rateLimiter: Optional[RateLimiter] = None):
         self.settingFileName = settingFileName
-        settings = getSettings(settingFileName)
+        self.httpClientPool = httpClientPool or HttpClientPool()
+        self.rateLimiter = rateLimiter or RateLimiter()
+        self.store = SettingsStore(settingFileName)  # 旧版的 JSON 配置文件会被自动迁移
+        self.unionIdCache = UnionIdCache(self.store)
         # 权限
-        self.agentId: str = _ if (_ := settings.get("AGENT_ID", None)) else input("请输入AgentId: ")
-        self.appKey: str = _ if (_ := settings.get("APP_KEY", None)) else input("请输入AppKey: ")
-        self.appSecret: str = _ if (_ := settings.get("APP_SECRET", None)) else input("请输入AppSecret: ")
+        self.agentId: str = self.getOrInputCredential("AGENT_ID", "请输入AgentId: ")
+        self.appKey: str = self.getOrInputCredential("APP_KEY", "请输入AppKey: ")
+        self.appSecret: str = self.getOrInputCredential("APP_SECRET", "请输入AppSecret: ")
         assert self.agentId and self.appKey and self.appSecret
 
-        self.accessToken: str = self.getAccessToken()
+        # 创建时不发起网络请求：AccessToken 在第一次请求时获取，通讯录由 ensureAddressBook 在后台获取
+        self.tokenManager = TokenManager(self.fetchAccessToken)
+
+    def getOrInputCredential(self, key: str, prompt: str) -> str:
+        value = self.store.getCredential(key)
+        if not value:
+            value = input(prompt)
+            self.store.setCredential(key, value)
+        return value
+
+    @property
+    def status(self) -> str:
+        return self.store.getCredential("STATUS", "INIT")
+
+    @status.setter
+    def status(self, value: str):
+        self.store.setCredential("STATUS", value)
+
+    @property
+    def addressBook(self) -> AddressBook:
+        """从数据库中读取通讯录；查询单个用户时请使用 store.getUser / store.getUserByUnionId"""
+        return self.store.getAddressBook()
+
+    def loadSnapshot(self, snapshot: Dict):
+        """迁移旧版快照中的通讯录与 unionId"""
+        if snapshot.get("addressBook") and self.status != "DONE":
+            self.store.saveAddressBook(snapshot["addressBook"])
+            self.status = "DONE"
+        self.unionIdCache.loadSnapshot(snapshot.get("unionIds", {}))
+
+    async def ensureAddressBook(self):
+        """若通讯录尚未获取完成，则获取通讯录"""
+        if self.status != "DONE":
+            await self.refreshAddressBook()
 
-        self.status = settings.get("STATUS", "INIT")
+    async def refreshAddressBook(self):
+        addressBook = await self.getAddressBook()
+        self.store.saveAddressBook(addressBook)  # 同一个事务中写入，失败时保留原有的通讯录
 
-        if self.status == "DONE":
-            self.addressBook: AddressBook = settings.get("ADDRESS_BOOK", {})
-        else:
-            asyncio.run(self.refreshAddressBook())
+    @property
+    def accessToken(self) -> Optional[str]:
+        return self.tokenManager.token
 
-    async def refreshAddressBook(self):
-        self.addressBook = await self.getAddressBook()
-        outputSettings({"AGENT_ID": self.agentId,
-                        "APP_KEY": self.appKey,
-                        "APP_SECRET": self.appSecret,
-                        "STATUS": self.status,
-                        "ADDRESS_BOOK": self.addressBook}, self.settingFileName)
-
-    def getAccessToken(self) -> str:
+    async def fetchAccessToken(self) -> Tuple[str, float]:
         url = "https://oapi.dingtalk.com/gettoken"
         params = dict(appkey=self.appKey, appsecret=self.appSecret)
         try:
-            accessToken = httpx.get(url, params=params).json()["access_token"]
+            response = await self.getDingTalkResponse("GET", url, useToken=False, params=params)
         except Exception as e:
-            print(f"ERROR：验证密钥失败，请检查应用凭证是否正确，或检查网络连接。({e})")
+            logger.error(f"验证密钥失败，请检查应用凭证是否正确，或检查网络连接。({e})")
             raise e
-        self.status = "PREPARED"
-        self.accessToken = accessToken
-        return accessToken
+        if self.status == "INIT":
+            self.status = "PREPARED"
+        return response["access_token"], response.get("expires_in", 7200)
+
+    async def refreshAccessToken(self) -> str:
+        """确保 AccessToken 有效：未过期时直接返回，临近过期时在后台刷新"""
+        return await self.tokenManager.get()
+
+    async def aclose(self):
+        await self.httpClientPool.aclose()
+        self.store.close()
+
+    @staticmethod
+    def isThrottledResponse(response: httpx.Response) -> bool:
+        if response.status_code == 429:  # 新版接口（api.dingtalk.com）限流时返回 429
+            return True
+        try:
+            body = response.json()
+        except ValueError:
+            return False
+        return isinstance(body, dict) and isThrottled(body)
 
-    def refreshAccessToken(self):
-        self.accessToken = self.getAccessToken()
+    @staticmethod
+    def errcodeOf(response: httpx.Response) -> str:
+        try:
+            body = response.json()
+        except ValueError:
+            return str(response.status_code)
+        if not isinstance(body, dict):
+            return str(response.status_code)
+        if "errcode" in body:
+            return str(body["errcode"])
+        return "0" if response.is_success else str(body.get("code", response.status_code))
 
     @staticmethod
-    async def getDingTalkResponse(method: Method, url: str, **kwargs) -> Dict:
-        if method == "GET":
-            async with httpx.AsyncClient() as client:
-                response = (await client.get(url, **kwargs)).json()
-        elif method == "POST":
-            async with httpx.AsyncClient() as client:
-                response = (await client.post(url, **kwargs)).json()
+    def isTokenInvalidResponse(response: httpx.Response) -> bool:
+        if response.status_code == 401:
+            return True
+        try:
+            body = response.json()
+        except ValueError:
+            return False
+        return isinstance(body, dict) and isTokenInvalid(body)
+
+    def withAccessToken(self, url: str, accessToken: str, kwargs: Dict) -> Dict:
+        kwargs = dict(kwargs)
+        if urlparse(url).hostname in self.headerTokenHosts:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "x-acs-dingtalk-access-token": accessToken}
         else:
+            kwargs["params"] = {**(kwargs.get("params") or {}), "access_token": accessToken}
+        return kwargs
+
+    async def requestDingTalk(self, method: Method, url: str, endpoint: Optional[str] = None, useToken: bool = True, **kwargs) -> httpx.Response:
+        """
+        经过该接口的限流器发送请求；被钉钉限流时降低并发与速率，并退避重试；
+        AccessToken 失效时刷新后重试一次
+
+        :param endpoint: 限流器的分组名，默认为url的路径（路径中含有id时应另行指定）
+        :param useToken: 是否自动附带 AccessToken
+        """
+        if method not in ("GET", "POST", "PUT", "DELETE"):
             raise Exception("暂不支持别的请求方式")
+        endpoint = endpoint or urlparse(url).path
+        limiter = self.rateLimiter.of(endpoint)
+        client = self.httpClientPool.getAsyncClient(url)
+
+        # span 的总耗时减去其中各次 http 的耗时，即为等待限流器与退避的时间
+        with span("DingTalkHandler.requestDingTalk", endpoint=endpoint, method=method) as requestSpan:
+            attempt = 0
+            tokenRetried = False
+            while True:
+                requestKwargs = kwargs
+                if useToken:
+                    accessToken = await self.tokenManager.get()
+                    requestKwargs = self.withAccessToken(url, accessToken, kwargs)
+                async with limiter:
+                    startTime = time.perf_counter()
+                    try:
+                        with span("http", endpoint=endpoint):
+                            response = await client.request(method, url, **requestKwargs)
+                    except httpx.HTTPError as e:
+                        responses.labels(endpoint, type(e).__name__).inc()
+                        raise
+                    finally:
+                        requestSeconds.labels(endpoint).observe(time.perf_counter() - startTime)
+                errcode = self.errcodeOf(response)
+                responses.labels(endpoint, errcode).inc()
+                requestSpan.set(attempts=attempt + 1, errcode=errcode)
+                if not self.isThrottledResponse(response):
+                    if useToken and not tokenRetried and self.isTokenInvalidResponse(response):
+                        logger.info("AccessToken已失效，刷新后重试")
+                        self.tokenManager.invalidate(accessToken)
+                        tokenRetried = True
+                        continue
+                    await limiter.onSuccess()  # AccessToken 失效的响应不计为成功，不提高并发上限
+                    return response
+                limiter.onThrottled()
+                throttledResponses.labels(endpoint).inc()
+                if attempt >= limiter.config.maxRetries:
+                    return response
+                await asyncio.sleep(limiter.backoff(attempt))
+                attempt += 1
+
+    @traced("DingTalkHandler.getDingTalkResponse")
+    async def getDingTalkResponse(self, method: Method, url: str, **kwargs) -> Dict:
+        response = (await self.requestDingTalk(method, url, **kwargs)).json()
         if response.get("errcode", -1) != 0:
             raise Exception(response.get("errmsg", str(response)))
         return response
 
     async def getSubDepartmentIdList(self, departmentId: DepartmentId = 1) -> List[DepartmentId]:
         url = "https://oapi.dingtalk.com/topapi/v2/department/listsubid"
-        params = dict(access_token=self.accessToken)
         data = dict(dept_id=departmentId)
-        response = await self.getDingTalkResponse("POST", url=url, params=params, json=data)
+        response = await self.getDingTalkResponse("POST", url=url, json=data)
         return response["result"]["dept_id_list"]
 
-    async def getDescendantDepartmentIdList(self, departmentId: DepartmentId = 1) -> List[DepartmentId]:
-        descendantDepartmentIdList = await self.getSubDepartmentIdList(departmentId)
-        if len(descendantDepartmentIdList) != 0:
-            for descendantDepartmentId in tqdm(descendantDepartmentIdList, desc="正在获取部门信息"):
-                descendantDepartmentIdList += await self.getSubDepartmentIdList(descendantDepartmentId)
-        return descendantDepartmentIdList + [1]  # 根部门 id=1
-
-    async def getSimpleUserList(self, dept_id: DepartmentId = 1, cursor=0, size=100) -> List[UserInfoDict]:
-        url = "https://oapi.dingtalk.com/topapi/user/listsimple"
-        params = dict(access_token=self.accessToken)
-        data = dict(dept_id=dept_id, cursor=cursor, size=size)
-        response = await self.getDingTalkResponse("POST", url, params=params, json=data)
-        userList: List[UserInfoDict] = response["result"]["list"]
-
-        if response["result"]["has_more"]:
-            userList = userList + (await self.getSimpleUserList(dept_id=dept_id, cursor=cursor + 1, size=size))
-
-        return userList
-
     async def getUserDetail(self, userId: UserId) -> UserDetail:
         url = "https://oapi.dingtalk.com/topapi/v2/user/get"
-        params = dict(access_token=self.accessToken)
         data = dict(userid=userId)
-        response = await self.getDingTalkResponse("POST", url, params=params, json=data)
+        response = await self.getDingTalkResponse("POST", url, json=data)
         return response["result"]
 
-    async def getUserDetailListOfDepartment(self, dept_id: DepartmentId = 1) -> List[UserDetail]:
-        simpleUserList = await self.getSimpleUserList(dept_id)
-
-        # return [await self.getUserDetail(simpleUser["userid"]) for simpleUser in simpleUserList]
-
-        # # 不可行：会请求到钉钉限流
-        # userDetailListOfDepartment: List[UserDetail] = []
-        # for f in asyncio.as_completed([self.getUserDetail(simpleUser["userid"]) for simpleUser in simpleUserList]):
-        #     userDetailListOfDepartment.append(await f)
-        # return userDetailListOfDepartment
-
-        return [(await self.getUserDetail(simpleUser["userid"])) for simpleUser in simpleUserList]
-
     async def getDepartmentName(self, departmentId: DepartmentId = 1) -> DepartmentName:
         url = "https://oapi.dingtalk.com/topapi/v2/department/get"
-        params = dict(access_token=self.accessToken)
         data = dict(dept_id=departmentId)
-        response = await self.getDingTalkResponse("POST", url, params=params, json=data)
+        response = await self.getDingTalkResponse("POST", url, json=data)
         return response["result"]["name"]
 
-    async def getDeptAddressBook(self, dept_id: DepartmentId = 1) -> DeptAddressBook:
-        return {"dept_id": dept_id, "dept_name": await self.getDepartmentName(dept_id), "users": await self.getUserDetailListOfDepartment(dept_id)}
-
     async def getAddressBook(self) -> AddressBook:
         self.status = "WORKING"
-        departmentIdList = await self.getDescendantDepartmentIdList()
-        addressBook = [(await self.getDeptAddressBook(departmentId)) for departmentId in tqdm(departmentIdList, desc="正在获取部门成员信息")]
+        # 并发遍历部门树，进度写入检查点文件，中断后可继续
+        crawler = AddressBookCrawler(self, checkpointFileName=f"{self.settingFileName}.addressbook.json")
+        addressBook = await crawler.crawl()
         self.status = "DONE"
         return addressBook
 
-    async def getUnionIdOfUserId(self, userId: str) -> str:
+    async def fetchUnionIdOfUserId(self, userId: str) -> str:
         userDetail = await self.getUserDetail(userId)
         return userDetail["unionid"]
 
+    async def getUnionIdOfUserId(self, userId: str) -> str:
+        if (unionId := self.unionIdCache.get(userId)) is None:
+            unionId = await self.fetchUnionIdOfUserId(userId)
+            self.unionIdCache.set(userId, unionId)
+        return unionId
+
+    async def getUnionIdsOfUserIds(self, userIdList: List[UserId]) -> Dict[UserId, UnionId]:
+        """批量获取unionId，只查询缓存中没有的用户；查询失败的用户不会出现在结果中"""
+        return await self.unionIdCache.resolve(userIdList, self.fetchUnionIdOfUserId)
+
     async def sendBulletin(self, data) -> Dict:
         url = "https://oapi.dingtalk.com/topapi/blackboard/create"
-        params = dict(access_token=self.accessToken)
 
         # private_level = 20 if whether_private else 0
         # data = {"create_request": {
@@ -165,7 +259,7 @@ class DingTalkHandler:
         #     "author": self.publisher[0]
         # }}
 
-        return await self.getDingTalkResponse("POST", url, params=params, json=data)
+        return await self.getDingTalkResponse("POST", url, json=data)
 
     async def sendTextBulletin(self, operation_userid: str, user_id_list: List[UserId], title: str, content: str,
                                author: str = "辣橙", is_private: bool = True, use_ding: bool = True, push_top: bool = False):
@@ -184,7 +278,6 @@ class DingTalkHandler:
             "author": author
         }}
         await self.sendBulletin(bulletin_data)
-        await asyncio.sleep(1)
 
     async def sendCorporationMsg(self, user_id_list: List[UserId], msg: Dict) -> Dict:
         """
@@ -194,12 +287,11 @@ class DingTalkHandler:
         :return: post请求后的结果
         """
         url = "https://oapi.dingtalk.com/topapi/message/corpconversation/asyncsend_v2"
-        params = dict(access_token=self.accessToken)
         data = {"agent_id": self.agentId,
                 "msg": msg,
                 "userid_list": ",".join(user_id_list)}
 
-        return await self.getDingTalkResponse("POST", url, params=params, json=data)
+        return await self.getDingTalkResponse("POST", url, json=data)
 
     async def sendCorporationTextMsg(self, user_id_list: List[UserId], text: str) -> Dict:
         """发送文字类型的工作消息"""
@@ -209,11 +301,10 @@ class DingTalkHandler:
         """发送Markdown类型的工作消息"""
         return await self.sendCorporationMsg(user_id_list, msg={"msgtype": "markdown", "markdown": {"title": title, "text": text}})
 
-    async def createCalendar(self, title: str, content: str, attendeesUnionIdList: List[str],
-                             start_time: datetime.datetime, end_time: datetime.datetime, remindMin: int = 0):
-        senderUnionId = attendeesUnionIdList[0]  # 将第一位与会者设为发起人
-        url = f"https://api.dingtalk.com/v1.0/calendar/users/{senderUnionId}/calendars/primary/events"
-        data = {
+    @staticmethod
+    def getCalendarEventData(title: str, content: str, attendeesUnionIdList: List[str],
+                             start_time: datetime.datetime, end_time: datetime.datetime, remindMin: int = 0) -> Dict:
+        return {
             "summary": title,
             "description": content,
             "isAllDay": False,
@@ -228,41 +319,61 @@ class DingTalkHandler:
             "reminders": [{"method": "dingtalk", "minutes": remindMin}] if remindMin else [],
             "attendees": [{"id": attendeesUnionId, "isOptional": False} for attendeesUnionId in attendeesUnionIdList],
         }
-        response = httpx.post(url, json=data, headers={"x-acs-dingtalk-access-token": self.accessToken})
+
+    async def createCalendar(self, title: str, content: str, attendeesUnionIdList: List[str],
+                             start_time: datetime.datetime, end_time: datetime.datetime, remindMin: int = 0):
+        senderUnionId = attendeesUnionIdList[0]  # 将第一位与会者设为发起人
+        url = f"https://api.dingtalk.com/v1.0/calendar/users/{senderUnionId}/calendars/primary/events"
+        data = self.getCalendarEventData(title, content, attendeesUnionIdList, start_time, end_time, remindMin)
+        response = await self.requestDingTalk("POST", url, endpoint="calendar/events", json=data)
+        return response
+
+    async def updateCalendar(self, eventId: str, title: str, content: str, attendeesUnionIdList: List[str],
+                             start_time: datetime.datetime, end_time: datetime.datetime, remindMin: int = 0):
+        senderUnionId = attendeesUnionIdList[0]
+        url = f"https://api.dingtalk.com/v1.0/calendar/users/{senderUnionId}/calendars/primary/events/{eventId}"
+        data = self.getCalendarEventData(title, content, attendeesUnionIdList, start_time, end_time, remindMin)
+        data["id"] = eventId
+        response = await self.requestDingTalk("PUT", url, endpoint="calendar/events", json=data)
+        return response
+
+    async def deleteCalendar(self, senderUnionId: str, eventId: str):
+        url = f"https://api.dingtalk.com/v1.0/calendar/users/{senderUnionId}/calendars/primary/events/{eventId}"
+        response = await self.requestDingTalk("DELETE", url, endpoint="calendar/events")
         return response
 
-    def getForms(self) -> List[FormProfile]:
+    async def getForms(self) -> List[FormProfile]:
         url = f"https://api.dingtalk.com/v1.0/swform/users/forms"
-        headers = {"x-acs-dingtalk-access-token": self.accessToken}
         params = dict(maxResults=200, bizType=0, nextToken=0)
 
-        rawForms = httpx.get(url, headers=headers, params=params).json()["result"]["list"]
+        rawForms = (await self.requestDingTalk("GET", url, params=params)).json()["result"]["list"]
         return [FormProfile(**rawForm) for rawForm in rawForms]
 
-    def getFormRecords(self, formCode: str) -> List[FormRecord]:
+    async def getFormRecordPages(self, formCode: str) -> AsyncIterator[List[FormRecord]]:
+        """逐页获取表单的提交记录"""
         url = f"https://api.dingtalk.com/v1.0/swform/forms/{formCode}/instances"
-        headers = {"x-acs-dingtalk-access-token": self.accessToken}
-        params = dict(maxResults=100, bizType=0, nextToken=0)
-        response: dict = httpx.get(url, headers=headers, params=params).json()
-
-        rawFormResult = response.get("result", {"hasMore": False, "nextToken": 10, "list": []})
-        formResult = FormResult(**rawFormResult)
-        forms = formResult.list
-
-        while formResult.hasMore:
-            params = dict(maxResults=100, bizType=0, nextToken=formResult.nextToken)
-            response = httpx.get(url, headers=headers, params=params).json()
+        nextToken = 0
+        while True:
+            params = dict(maxResults=100, bizType=0, nextToken=nextToken)
+            response: dict = (await self.requestDingTalk("GET", url, endpoint="swform/instances", params=params)).json()
             rawFormResult = response.get("result", {"hasMore": False, "nextToken": 10, "list": []})
             formResult = FormResult(**rawFormResult)
-            forms += formResult.list
-
+            yield formResult.list or []
+            if not formResult.hasMore:
+                break
+            nextToken = formResult.nextToken
+
+    async def getFormRecords(self, formCode: str) -> List[FormRecord]:
+        forms: List[FormRecord] = []
+        async for formRecords in self.getFormRecordPages(formCode):
+            forms += formRecords
         return forms
 
-    def getSillageUserAndUrlList(self) -> List[Tuple[FormRecord, str]]:
+    async def getSillageUserAndUrlList(self) -> List[Tuple[FormRecord, str]]:
         outputs: List[Tuple[FormRecord, str]] = []
 
-        forms = self.getForms()
-        formRecords = self.getFormRecords(forms[0].formCode)
+        forms = await self.getForms()
+        formRecords = await self.getFormRecords(forms[0].formCode)
         for formRecord in formRecords:
             # 查找 是否启用钉钉推送
             if len([formDetail for formDetail in formRecord.forms if (formDetail.label == '是否启用钉钉推送？' and formDetail.value == '启用')]):
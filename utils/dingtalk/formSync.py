@@ -0,0 +1,121 @@
+import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from utils.dingtalk.dingTalkHandler import DingTalkHandler
+from utils.dingtalk.types import FormRecord, UserId
+
+ENABLE_LABEL = '是否启用钉钉推送？'
+URL_LABEL = '请输入您要订阅的课表网址：'
+
+
+class Subscriber(NamedTuple):
+    """从表单提交记录中提取出的订阅信息"""
+    formInstanceId: str
+    userId: UserId
+    url: str
+    enabled: bool
+    modifyTime: str
+
+
+def extractSubscriber(formRecord: FormRecord) -> Subscriber:
+    """遍历一次表单内容，提取出 是否启用钉钉推送 与 用户订阅的链接"""
+    enabled, url = False, None
+    for formDetail in formRecord.forms:
+        if formDetail.label == ENABLE_LABEL:
+            enabled = formDetail.value == '启用'
+        elif formDetail.label == URL_LABEL and url is None:
+            url = formDetail.value
+    if enabled and url is None:
+        raise Exception("表单内容已变更，请检查！")
+    return Subscriber(formRecord.formInstanceId, formRecord.submitterUserId, url or "", enabled, formRecord.modifyTime)
+
+
+class FormSync:
+    """
+    增量同步订阅表单：以 modifyTime 为水位线，逐页获取提交记录，遇到整页都不晚于水位线的记录时停止翻页；
+    只保存提取后的订阅信息（存于 SettingsStore 的 subscriptions 表）。同一用户多次提交时以最后修改的一条为准，
+    关闭推送的用户不再出现在订阅列表中。
+    钉钉的表单接口不支持按修改时间筛选，因此仍定期全量同步一次，以防修改旧记录后其顺序没有提前。
+    提前停止依赖于接口按修改时间从新到旧返回记录：每页都检查顺序，发现不是从新到旧时本次获取全部记录。
+    """
+
+    full_resync_interval = datetime.timedelta(hours=24)
+
+    def __init__(self, dingTalkHandler: DingTalkHandler):
+        self.dingTalkHandler = dingTalkHandler
+
+    @property
+    def store(self):
+        return self.dingTalkHandler.store
+
+    @property
+    def formCode(self) -> str:
+        return self.store.getWatermark("forms.formCode")
+
+    @property
+    def watermark(self) -> str:
+        """已同步记录中最晚的 modifyTime"""
+        return self.store.getWatermark("forms.watermark")
+
+    @property
+    def lastFullSync(self) -> Optional[datetime.datetime]:
+        lastFullSync = self.store.getWatermark("forms.lastFullSync")
+        return datetime.datetime.fromisoformat(lastFullSync) if lastFullSync else None
+
+    def loadSnapshot(self, snapshot: Dict):
+        """迁移旧版快照中的同步状态"""
+        if not snapshot or self.watermark:
+            return
+        self.store.replaceSubscriptions(Subscriber(*subscriber) for subscriber in snapshot.get("subscribers", []))
+        for name in ("formCode", "watermark", "lastFullSync"):
+            if snapshot.get(name):
+                self.store.setWatermark(f"forms.{name}", snapshot[name])
+
+    async def sync(self) -> int:
+        """同步表单提交记录，返回新增或修改的记录数"""
+        formCode = self.formCode
+        if not formCode:
+            forms = await self.dingTalkHandler.getForms()
+            formCode = forms[0].formCode
+            self.store.setWatermark("forms.formCode", formCode)
+
+        lastFullSync = self.lastFullSync
+        full = (not self.watermark or lastFullSync is None
+                or datetime.datetime.now() - lastFullSync >= self.full_resync_interval)
+        watermark = "" if full else self.watermark
+
+        subscribers: Dict[str, Subscriber] = {}  # 本次新增或修改的记录
+        newestFirst = True
+        previousModifyTime: Optional[str] = None  # 上一页最后一条记录的修改时间
+        async for formRecords in self.dingTalkHandler.getFormRecordPages(formCode):
+            modifyTimes = ([previousModifyTime] if previousModifyTime is not None else []) + [formRecord.modifyTime for formRecord in formRecords]
+            if newestFirst and any(later > earlier for earlier, later in zip(modifyTimes, modifyTimes[1:])):
+                newestFirst = False
+                logger.warning("表单接口返回的提交记录不是按修改时间从新到旧排列，本次将获取全部记录")
+            if formRecords:
+                previousModifyTime = formRecords[-1].modifyTime
+
+            newRecords = [formRecord for formRecord in formRecords
+                          if full or formRecord.modifyTime > watermark or not self.store.hasSubscription(formRecord.formInstanceId)]
+            for formRecord in newRecords:
+                try:
+                    subscribers[formRecord.formInstanceId] = extractSubscriber(formRecord)
+                except Exception as e:
+                    logger.error(f"解析{formRecord.submitterUserId}的表单提交记录{formRecord.formInstanceId}时出错，已跳过: {e}")
+            if newestFirst and not full and formRecords and not newRecords:
+                break  # 整页都是已同步过的记录，更早的记录不会再有变化
+
+        if full:
+            self.store.replaceSubscriptions(subscribers.values())
+            self.store.setWatermark("forms.lastFullSync", datetime.datetime.now().isoformat())
+        else:
+            self.store.upsertSubscriptions(subscribers.values())
+        newWatermark = max((subscriber.modifyTime for subscriber in subscribers.values()), default="")
+        self.store.setWatermark("forms.watermark", max(watermark, newWatermark))
+        return len(subscribers)
+
+    def getSubscribedUrls(self) -> List[Tuple[UserId, str]]:
+        """返回启用了钉钉推送的 (userId, 订阅网址)；同一用户多次提交时以最后修改的一条为准"""
+        return self.store.getEnabledSubscriptions()
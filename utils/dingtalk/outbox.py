@@ -0,0 +1,229 @@
+import asyncio
+import json
+import random
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from utils.metrics import registry
+from utils.tracing import span
+
+itemSeconds = registry.histogram("sillage_outbox_item_seconds", "发件箱中每条记录的处理耗时", ["kind"])
+itemResults = registry.counter("sillage_outbox_items", "发件箱处理的记录数", ["kind", "result"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+PENDING, IN_FLIGHT, DONE, FAILED = "pending", "inflight", "done", "failed"
+
+Entry = Tuple[str, Dict, str]  # (记录类型, 内容, 幂等键)
+Effect = Callable[[sqlite3.Connection], None]  # 与标记完成在同一个事务中执行的写入
+
+
+class OutboxItem(NamedTuple):
+    id: int
+    idempotencyKey: str
+    kind: str
+    payload: Dict
+    attempts: int
+
+
+class Outbox:
+    """
+    持久化的发件箱（SQLite）：任务只负责把渲染好的消息与日程操作写入发件箱，由 OutboxWorker 在后台发送。
+    每条记录有幂等键，重复写入同一个键会被忽略；发送失败后按指数退避重试，超过次数后标记为失败。
+    进程崩溃时处于发送中的记录会在下次启动时（recover）重新发送。
+    处理结果需要持久化的（如日程id），可在 complete 时传入 effect，与标记完成写在同一个事务中。
+    """
+
+    def __init__(self, fileName: str = "outbox.db", maxAttempts: int = 8, backoffBase: float = 2.0, backoffMax: float = 600.0):
+        self.fileName = fileName
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase  # 第一次重试前的等待时间（秒）
+        self.backoffMax = backoffMax
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def enqueue(self, kind: str, payload: Dict, idempotencyKey: str, rearmFinished: bool = False) -> bool:
+        """
+        返回是否写入。幂等键已存在时忽略本次写入；
+        若 rearmFinished 为真，则已完成或已放弃的同键记录会被重新置为待发送（仅忽略尚未发送完的重复记录），
+        适用于处理函数本身幂等、允许再次执行的操作
+        """
+        return self.enqueueMany([(kind, payload, idempotencyKey)], rearmFinished) == 1
+
+    def enqueueMany(self, entries: Iterable[Entry], rearmFinished: bool = False) -> int:
+        """在同一个事务中写入多条记录，返回写入的条数；幂等键的处理与 enqueue 相同"""
+        now = time.time()
+        sql = "INSERT INTO outbox (idempotency_key, kind, payload, status, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        if rearmFinished:
+            sql += ("ON CONFLICT (idempotency_key) DO UPDATE SET kind = excluded.kind, payload = excluded.payload, status = excluded.status, "
+                    f"attempts = 0, next_attempt_at = excluded.next_attempt_at, updated_at = excluded.updated_at WHERE status IN ('{DONE}', '{FAILED}')")
+        else:
+            sql += "ON CONFLICT (idempotency_key) DO NOTHING"
+        rows = [(idempotencyKey, kind, json.dumps(payload, ensure_ascii=False), PENDING, now, now, now) for kind, payload, idempotencyKey in entries]
+        with self.connection:
+            cursor = self.connection.executemany(sql, rows)
+        return max(cursor.rowcount, 0)
+
+    def recover(self) -> int:
+        """将上次退出时仍在发送中的记录重新标记为待发送"""
+        with self.connection:
+            cursor = self.connection.execute("UPDATE outbox SET status = ?, updated_at = ? WHERE status = ?", (PENDING, time.time(), IN_FLIGHT))
+        if cursor.rowcount:
+            logger.info(f"发件箱中有{cursor.rowcount}条记录在上次退出时未发送完成，将重新发送")
+        return cursor.rowcount
+
+    def claim(self, limit: int) -> List[OutboxItem]:
+        """取出最多 limit 条到期的待发送记录，并标记为发送中"""
+        now = time.time()
+        with self.connection:
+            rows = self.connection.execute("SELECT id, idempotency_key, kind, payload, attempts FROM outbox "
+                                           "WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?", (PENDING, now, limit)).fetchall()
+            self.connection.executemany("UPDATE outbox SET status = ?, updated_at = ? WHERE id = ?", [(IN_FLIGHT, now, row["id"]) for row in rows])
+        return [OutboxItem(row["id"], row["idempotency_key"], row["kind"], json.loads(row["payload"]), row["attempts"]) for row in rows]
+
+    def complete(self, itemId: int, effect: Optional[Effect] = None):
+        with self.connection:
+            if effect is not None:
+                effect(self.connection)
+            self.connection.execute("UPDATE outbox SET status = ?, updated_at = ? WHERE id = ?", (DONE, time.time(), itemId))
+
+    def fail(self, item: OutboxItem, error: str):
+        attempts = item.attempts + 1
+        now = time.time()
+        if attempts >= self.maxAttempts:
+            status, nextAttemptAt = FAILED, now
+            logger.error(f"发件箱记录{item.idempotencyKey}重试{attempts}次后仍失败，已放弃: {error}")
+        else:
+            status = PENDING
+            delay = min(self.backoffBase * 2 ** (attempts - 1), self.backoffMax)
+            nextAttemptAt = now + delay * random.uniform(0.8, 1.2)
+        with self.connection:
+            self.connection.execute("UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                                    (status, attempts, nextAttemptAt, error, now, item.id))
+
+    def counts(self) -> Dict[str, int]:
+        return {row["status"]: row["count"] for row in self.connection.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status")}
+
+    def nextAttemptAt(self) -> Optional[float]:
+        row = self.connection.execute("SELECT MIN(next_attempt_at) AS at FROM outbox WHERE status = ?", (PENDING,)).fetchone()
+        return row["at"]
+
+    def purge(self, before: float) -> int:
+        """删除早于 before 的已完成与已放弃的记录；已放弃的记录在此之前保留，便于查看 last_error"""
+        with self.connection:
+            return self.connection.execute("DELETE FROM outbox WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, before)).rowcount
+
+
+Handler = Callable[[Dict], Awaitable[Optional[Effect]]]
+
+
+class OutboxWorker:
+    """
+    从发件箱中取出记录并发送：每次取出一批，由 concurrency 个协程并发处理（速率由 DingTalkHandler 的限流器控制）。
+    handlers 为 记录类型 -> 处理函数；处理函数抛出异常即视为失败，稍后重试；返回的 effect 在标记完成的事务中执行。
+    """
+
+    def __init__(self, outbox: Outbox, handlers: Dict[str, Handler], concurrency: int = 8, batchSize: int = 50,
+                 pollInterval: float = 1.0):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.batchSize = batchSize
+        self.pollInterval = pollInterval  # 没有到期记录时的最长等待时间（秒）
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+
+    def notify(self):
+        """写入新记录后调用，立即开始发送"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def process(self, item: OutboxItem, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            startTime = time.perf_counter()
+            try:
+                handler = self.handlers[item.kind]
+                with span("OutboxWorker.process", kind=item.kind, attempt=item.attempts + 1):
+                    effect = await handler(item.payload)
+            except Exception as e:
+                logger.warning(f"发送发件箱记录{item.idempotencyKey}失败（第{item.attempts + 1}次）: {e}")
+                self.outbox.fail(item, str(e))
+                itemResults.labels(item.kind, "failed").inc()
+            else:
+                self.outbox.complete(item.id, effect)
+                itemResults.labels(item.kind, "done").inc()
+            finally:
+                itemSeconds.labels(item.kind).observe(time.perf_counter() - startTime)
+
+    async def runOnce(self) -> int:
+        """处理一批到期的记录，返回处理的记录数"""
+        items = self.outbox.claim(self.batchSize)
+        if items:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*[self.process(item, semaphore) for item in items])
+        return len(items)
+
+    def start(self) -> asyncio.Task:
+        """在当前事件循环中启动后台发送"""
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.outbox.recover()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                if await self.runOnce():
+                    continue
+                self.wakeup.clear()
+                nextAttemptAt = self.outbox.nextAttemptAt()
+                timeout = self.pollInterval if nextAttemptAt is None else min(max(nextAttemptAt - time.time(), 0), self.pollInterval)
+            except Exception:  # 如数据库暂时不可用，稍后继续，不让后台发送就此停止
+                logger.exception("发件箱后台发送出错")
+                self.wakeup.clear()
+                timeout = self.pollInterval
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self, timeout: float = 60.0) -> bool:
+        """
+        停止后台发送，并在退出前把已到期的记录发送完（正在退避等待重试的记录留待下次启动），
+        返回是否在超时前发送完毕
+        """
+        self.stopping = True
+        self.notify()
+        if self.task is not None:
+            await self.task  # 等待正在处理的一批完成
+            self.task = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not await self.runOnce():
+                return True
+        logger.warning(f"发件箱未能在{timeout}秒内发送完毕: {self.outbox.counts()}")
+        return False
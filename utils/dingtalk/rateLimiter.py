@@ -0,0 +1,155 @@
+import asyncio
+import random
+import time
+from typing import Dict, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+# 钉钉的限流错误码
+#   88 + sub_code 90018: 当前应用调用该接口的QPS超过限制
+#   90002: 服务器繁忙        90005: 企业调用接口次数过多
+#   90006: 应用调用接口次数过多（每分钟）    90018: 应用调用接口次数过多（每秒）
+#   -1: 系统繁忙
+THROTTLE_ERRCODES = {-1, 90002, 90005, 90006, 90018}
+THROTTLE_SUB_CODES = {"90002", "90005", "90006", "90018"}
+
+
+def isThrottled(response: Dict) -> bool:
+    """判断钉钉接口的返回结果是否为限流错误"""
+    errcode = response.get("errcode", 0)
+    if errcode in THROTTLE_ERRCODES:
+        return True
+    return errcode == 88 and str(response.get("sub_code", "")) in THROTTLE_SUB_CODES
+
+
+class RateLimitConfig(BaseModel):
+    qps: float = 20.0  # 钉钉企业内部应用默认：单个应用调用单个接口 20次/秒
+    burst: float = 20.0  # 令牌桶容量
+    maxInFlight: int = 10  # 并发上限
+    minInFlight: int = 1  # 并发下限
+    increaseEvery: int = 20  # 每连续成功多少次，并发上限加一（加性增）
+    decreaseFactor: float = 0.5  # 被限流时并发上限与速率的缩小倍数（乘性减）
+    decreaseCooldown: float = 1.0  # 两次乘性减之间的最短间隔（秒），避免同一批被限流的请求反复降低
+    maxRetries: int = 5  # 被限流后的最大重试次数
+    backoffBase: float = 0.5  # 退避的初始等待时间（秒）
+    backoffMax: float = 16.0  # 退避的最大等待时间（秒）
+
+
+class TokenBucket:
+    """令牌桶：以 rate 的速率补充令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updatedAt = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AdaptiveLimiter:
+    """
+    单个接口的限流器：令牌桶控制速率，可调整上限的信号量控制并发数。
+    按 AIMD 调整：连续成功时缓慢提高并发上限与速率，被限流时成倍降低。
+    """
+
+    def __init__(self, endpoint: str, config: RateLimitConfig):
+        self.endpoint = endpoint
+        self.config = config
+        self.bucket = TokenBucket(config.qps, config.burst)
+        self.limit = config.maxInFlight
+        self.inFlight = 0
+        self.successes = 0
+        self.decreasedAt = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.inFlight < self.limit)
+            self.inFlight += 1
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            # 等待令牌时被取消（如关闭发件箱超时），不会调用 __aexit__，需在此归还并发名额
+            await self.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    async def release(self):
+        self.inFlight -= 1  # 先归还名额，即使等待锁时再次被取消也不会泄漏
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def onSuccess(self):
+        self.successes += 1
+        if self.successes >= self.config.increaseEvery:
+            self.successes = 0
+            self.limit = min(self.config.maxInFlight, self.limit + 1)
+            self.bucket.rate = min(self.config.qps, self.bucket.rate + 1)
+            async with self._condition:
+                self._condition.notify_all()  # 并发上限提高后，唤醒等待中的请求
+
+    def onThrottled(self):
+        self.successes = 0
+        now = time.monotonic()
+        if now - self.decreasedAt < self.config.decreaseCooldown:
+            return
+        self.decreasedAt = now
+        self.limit = max(self.config.minInFlight, int(self.limit * self.config.decreaseFactor))
+        self.bucket.rate = max(1.0, self.bucket.rate * self.config.decreaseFactor)
+        self.bucket.tokens = min(self.bucket.tokens, 0)
+        logger.warning(f"接口{self.endpoint}被钉钉限流，并发上限降为{self.limit}，速率降为{self.bucket.rate:.1f}次/秒")
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待时间（指数退避 + 随机抖动）"""
+        delay = min(self.config.backoffMax, self.config.backoffBase * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+
+class RateLimiter:
+    """按接口划分的限流器集合"""
+
+    def __init__(self, defaultConfig: Optional[RateLimitConfig] = None, endpointConfigs: Optional[Dict[str, RateLimitConfig]] = None):
+        self.defaultConfig = defaultConfig or RateLimitConfig()
+        self.endpointConfigs = endpointConfigs or {}
+        self.baseConfigs = (self.defaultConfig, dict(self.endpointConfigs))
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def setShare(self, share: float):
+        """多个进程共用同一个应用的调用额度时，本进程只使用其中的 share（0~1）"""
+        def scaled(config: RateLimitConfig) -> RateLimitConfig:
+            return config.copy(update={"qps": config.qps * share, "burst": max(1.0, config.burst * share),
+                                       "maxInFlight": max(config.minInFlight, int(config.maxInFlight * share))})
+
+        defaultConfig, endpointConfigs = self.baseConfigs
+        self.defaultConfig = scaled(defaultConfig)
+        self.endpointConfigs = {endpoint: scaled(config) for endpoint, config in endpointConfigs.items()}
+        self._limiters = {}  # 之后的请求使用新的限流器
+
+    def of(self, endpoint: str) -> AdaptiveLimiter:
+        """获取接口对应的限流器（需在事件循环中调用）"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 锁与条件变量绑定在事件循环上，事件循环变化后需要重新创建
+            self._limiters = {}
+            self._loop = loop
+        if endpoint not in self._limiters:
+            self._limiters[endpoint] = AdaptiveLimiter(endpoint, self.endpointConfigs.get(endpoint, self.defaultConfig))
+        return self._limiters[endpoint]
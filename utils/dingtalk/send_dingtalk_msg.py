@@ -3,7 +3,7 @@ import asyncio
 
 
 async def send_dingtalk_msg():
-    userInfoTupleList = dingTalkHandler.getSillageUserAndUrlList()
+    userInfoTupleList = await dingTalkHandler.getSillageUserAndUrlList()
 
     for userInfoTuple in userInfoTupleList:
         await dingTalkHandler.sendCorporationTextMsg([userInfoTuple[0].submitterUserId], userInfoTuple[1])
@@ -0,0 +1,227 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from utils.dingtalk.types import AddressBook, DepartmentId, Settings, UnionId, UserDetail, UserId
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS credentials (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS departments (
+    dept_id INTEGER PRIMARY KEY,
+    dept_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    userid TEXT PRIMARY KEY,
+    unionid TEXT,
+    name TEXT,
+    detail TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_unionid ON users (unionid);
+CREATE TABLE IF NOT EXISTS department_users (
+    dept_id INTEGER NOT NULL,
+    userid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (dept_id, userid)
+);
+CREATE INDEX IF NOT EXISTS department_users_userid ON department_users (userid);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    form_instance_id TEXT PRIMARY KEY,
+    userid TEXT NOT NULL,
+    url TEXT NOT NULL,
+    enabled INTEGER NOT NULL,
+    modify_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_userid ON subscriptions (userid, modify_time);
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def isSqliteFile(fileName: str) -> bool:
+    with open(fileName, "rb") as file:
+        return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class SettingsStore:
+    """
+    基于 SQLite 的配置存储：应用凭证、部门、用户（可按 userid 或 unionid 查询）、订阅与同步水位线各自一张表，
+    按行增量写入、按需读取。打开旧版的 JSON 配置文件时会自动迁移，原文件另存为 *.json.bak。
+    每个公开的写入方法各自为一个事务；以 _ 开头的写入方法不开启事务，由调用它们的公开方法统一提交。
+    """
+
+    def __init__(self, fileName: str = "settings.db"):
+        self.fileName = fileName
+        legacySettings: Optional[Settings] = None
+        if os.path.exists(fileName) and os.path.getsize(fileName) and not isSqliteFile(fileName):
+            legacySettings = self.readLegacySettings(fileName)
+            os.replace(fileName, f"{fileName}.json.bak")
+
+        try:
+            self.connection = sqlite3.connect(fileName, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+            if legacySettings is not None:
+                self.migrate(legacySettings)
+        except Exception:
+            if legacySettings is not None:  # 迁移失败时恢复旧版配置文件，下次启动时重新迁移
+                self.restoreLegacySettings()
+            raise
+
+    def restoreLegacySettings(self):
+        connection = getattr(self, "connection", None)
+        if connection is not None:
+            connection.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(f"{self.fileName}{suffix}"):
+                os.remove(f"{self.fileName}{suffix}")
+        os.replace(f"{self.fileName}.json.bak", self.fileName)
+
+    @staticmethod
+    def readLegacySettings(fileName: str) -> Settings:
+        try:
+            with open(fileName, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"无法读取旧版配置文件“{fileName}”，将不迁移其中的数据: {e}")
+            return {}
+
+    def migrate(self, settings: Settings):
+        """在同一个事务中迁移，失败时不写入任何数据"""
+        logger.info(f"正在将旧版配置文件“{self.fileName}”迁移至 SQLite")
+        with self.connection:
+            for key in ("AGENT_ID", "APP_KEY", "APP_SECRET", "STATUS"):
+                if settings.get(key):
+                    self._setCredential(key, settings[key])
+            for deptAddressBook in settings.get("ADDRESS_BOOK") or []:
+                self._saveDepartment(deptAddressBook["dept_id"], deptAddressBook["dept_name"], deptAddressBook["users"])
+
+    def close(self):
+        self.connection.close()
+
+    # 凭证
+    def getCredential(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM credentials WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def setCredential(self, key: str, value: str):
+        with self.connection:
+            self._setCredential(key, value)
+
+    def _setCredential(self, key: str, value: str):
+        self.connection.execute("INSERT INTO credentials (key, value) VALUES (?, ?) "
+                                "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value))
+
+    # 用户与部门
+    def upsertUsers(self, userDetails: Iterable[UserDetail]):
+        with self.connection:
+            self._upsertUsers(userDetails)
+
+    def _upsertUsers(self, userDetails: Iterable[UserDetail]):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT INTO users (userid, unionid, name, detail, fetched_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (userid) DO UPDATE SET unionid = excluded.unionid, name = excluded.name, "
+            "detail = excluded.detail, fetched_at = excluded.fetched_at",
+            [(userDetail["userid"], userDetail.get("unionid"), userDetail.get("name"), json.dumps(userDetail, ensure_ascii=False), now)
+             for userDetail in userDetails])
+
+    def setUnionId(self, userId: UserId, unionId: UnionId, fetchedAt: Optional[float] = None):
+        """只记录 unionId（不在通讯录中的用户没有详细信息）"""
+        with self.connection:
+            self.connection.execute("INSERT INTO users (userid, unionid, fetched_at) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (userid) DO UPDATE SET unionid = excluded.unionid, fetched_at = excluded.fetched_at",
+                                    (userId, unionId, time.time() if fetchedAt is None else fetchedAt))
+
+    def getUnionId(self, userId: UserId) -> Optional[Tuple[UnionId, float]]:
+        row = self.connection.execute("SELECT unionid, fetched_at FROM users WHERE userid = ?", (userId,)).fetchone()
+        return (row["unionid"], row["fetched_at"]) if row and row["unionid"] else None
+
+    def getUser(self, userId: UserId) -> Optional[UserDetail]:
+        row = self.connection.execute("SELECT detail FROM users WHERE userid = ?", (userId,)).fetchone()
+        return json.loads(row["detail"]) if row and row["detail"] else None
+
+    def getUserByUnionId(self, unionId: UnionId) -> Optional[UserDetail]:
+        row = self.connection.execute("SELECT detail FROM users WHERE unionid = ?", (unionId,)).fetchone()
+        return json.loads(row["detail"]) if row and row["detail"] else None
+
+    def saveAddressBook(self, addressBook: AddressBook):
+        """在同一个事务中写入整个通讯录"""
+        with self.connection:
+            for deptAddressBook in addressBook:
+                self._saveDepartment(deptAddressBook["dept_id"], deptAddressBook["dept_name"], deptAddressBook["users"])
+
+    def saveDepartment(self, deptId: DepartmentId, deptName: str, userDetails: List[UserDetail]):
+        with self.connection:
+            self._saveDepartment(deptId, deptName, userDetails)
+
+    def _saveDepartment(self, deptId: DepartmentId, deptName: str, userDetails: List[UserDetail]):
+        self.connection.execute("INSERT INTO departments (dept_id, dept_name) VALUES (?, ?) "
+                                "ON CONFLICT (dept_id) DO UPDATE SET dept_name = excluded.dept_name", (deptId, deptName))
+        self._upsertUsers(userDetails)
+        self.connection.execute("DELETE FROM department_users WHERE dept_id = ?", (deptId,))
+        self.connection.executemany("INSERT OR IGNORE INTO department_users (dept_id, userid, position) VALUES (?, ?, ?)",
+                                    [(deptId, userDetail["userid"], position) for position, userDetail in enumerate(userDetails)])
+
+    def getAddressBook(self) -> AddressBook:
+        addressBook: AddressBook = []
+        for department in self.connection.execute("SELECT dept_id, dept_name FROM departments ORDER BY dept_id"):
+            rows = self.connection.execute("SELECT users.detail FROM department_users JOIN users USING (userid) "
+                                           "WHERE department_users.dept_id = ? ORDER BY position", (department["dept_id"],))
+            addressBook.append({"dept_id": department["dept_id"], "dept_name": department["dept_name"],
+                                "users": [json.loads(row["detail"]) for row in rows if row["detail"]]})
+        return addressBook
+
+    # 订阅
+    def upsertSubscriptions(self, subscriptions: Iterable[Tuple[str, UserId, str, bool, str]]):
+        """subscriptions: (formInstanceId, userId, url, enabled, modifyTime)"""
+        with self.connection:
+            self._upsertSubscriptions(subscriptions)
+
+    def _upsertSubscriptions(self, subscriptions: Iterable[Tuple[str, UserId, str, bool, str]]):
+        self.connection.executemany(
+            "INSERT INTO subscriptions (form_instance_id, userid, url, enabled, modify_time) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (form_instance_id) DO UPDATE SET userid = excluded.userid, url = excluded.url, "
+            "enabled = excluded.enabled, modify_time = excluded.modify_time",
+            [(formInstanceId, userId, url, int(enabled), modifyTime) for formInstanceId, userId, url, enabled, modifyTime in subscriptions])
+
+    def replaceSubscriptions(self, subscriptions: Iterable[Tuple[str, UserId, str, bool, str]]):
+        with self.connection:
+            self.connection.execute("DELETE FROM subscriptions")
+            self._upsertSubscriptions(subscriptions)
+
+    def hasSubscription(self, formInstanceId: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM subscriptions WHERE form_instance_id = ?", (formInstanceId,)).fetchone() is not None
+
+    def getEnabledSubscriptions(self) -> List[Tuple[UserId, str]]:
+        """每个用户最后修改的一条提交记录中启用了推送的 (userId, 订阅网址)；修改时间相同时以后写入的一条为准"""
+        rows = self.connection.execute(
+            "SELECT userid, url, enabled FROM (SELECT userid, url, enabled, "
+            "ROW_NUMBER() OVER (PARTITION BY userid ORDER BY modify_time DESC, rowid DESC) AS position FROM subscriptions) "
+            "WHERE position = 1 ORDER BY userid")
+        return [(row["userid"], row["url"]) for row in rows if row["enabled"]]
+
+    # 水位线
+    def getWatermark(self, name: str, default: str = "") -> str:
+        row = self.connection.execute("SELECT value FROM watermarks WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row else default
+
+    def setWatermark(self, name: str, value: str):
+        with self.connection:
+            self.connection.execute("INSERT INTO watermarks (name, value) VALUES (?, ?) "
+                                    "ON CONFLICT (name) DO UPDATE SET value = excluded.value", (name, value))
+
+    def getWatermarks(self) -> Dict[str, str]:
+        return {row["name"]: row["value"] for row in self.connection.execute("SELECT name, value FROM watermarks")}
@@ -0,0 +1,125 @@
+import datetime
+import os
+import tempfile
+import unittest
+from typing import Dict, List
+
+import httpx
+
+from utils.dingtalk.calendarSync import CalendarEventPlan, CalendarSync
+from utils.dingtalk.outbox import Outbox, OutboxWorker
+
+
+def planOf(unionId: str, lessonNum: int, title: str = "课程", date: str = "2024-03-04") -> CalendarEventPlan:
+    startTime = datetime.datetime.fromisoformat(f"{date}T08:00:00") + datetime.timedelta(hours=2 * lessonNum)
+    return CalendarEventPlan(unionId, date, lessonNum, title, "", startTime, startTime + datetime.timedelta(hours=1, minutes=30), 15)
+
+
+class FakeDingTalkHandler:
+    """只提供 CalendarSync 用到的日程接口，记录每次调用"""
+
+    def __init__(self):
+        self.calls: List[str] = []
+        self.events: Dict[str, str] = {}  # 日程id -> 标题
+        self.nextId = 0
+
+    async def createCalendar(self, title, content, attendeesUnionIdList, start_time, end_time, remindMin=0):
+        self.calls.append("create")
+        self.nextId += 1
+        self.events[f"event{self.nextId}"] = title
+        return httpx.Response(200, json={"id": f"event{self.nextId}"})
+
+    async def updateCalendar(self, eventId, title, content, attendeesUnionIdList, start_time, end_time, remindMin=0):
+        self.calls.append("update")
+        if eventId not in self.events:
+            return httpx.Response(404, text="not found")
+        self.events[eventId] = title
+        return httpx.Response(200, json={"id": eventId})
+
+    async def deleteCalendar(self, senderUnionId, eventId):
+        self.calls.append("delete")
+        self.events.pop(eventId, None)
+        return httpx.Response(200)
+
+
+class CalendarSyncTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.fileName = os.path.join(self.directory.name, "outbox.db")
+        self.outbox = Outbox(self.fileName)
+        self.dingTalkHandler = FakeDingTalkHandler()
+        self.calendarSync = CalendarSync(self.dingTalkHandler, self.outbox)
+
+    def tearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    async def syncAndSend(self, unionIds: List[str], plans: List[CalendarEventPlan], date: str = "2024-03-04") -> Dict[str, int]:
+        counts = await self.calendarSync.sync(date, unionIds, plans)
+        worker = OutboxWorker(self.outbox, {CalendarSync.outboxKind: self.calendarSync.runOperation})
+        while await worker.runOnce():
+            pass
+        return counts
+
+    def storedEvents(self) -> Dict:
+        return {(unionId, date, lessonNum): (eventId, contentHash) for unionId, date, lessonNum, eventId, contentHash
+                in self.outbox.connection.execute("SELECT * FROM calendar_events")}
+
+    async def test_diff(self):
+        counts = await self.syncAndSend(["a", "b"], [planOf("a", 1), planOf("a", 2), planOf("b", 1)])
+        self.assertEqual(counts, {"created": 3, "updated": 0, "deleted": 0, "skipped": 0})
+        self.assertEqual(self.storedEvents(), self.calendarSync.events)
+
+        # a 第1节课不变、第2节课内容变化，b 第1节课不再需要
+        counts = await self.syncAndSend(["a", "b"], [planOf("a", 1), planOf("a", 2, title="新课程")])
+        self.assertEqual(counts, {"created": 0, "updated": 1, "deleted": 1, "skipped": 1})
+        self.assertEqual(self.dingTalkHandler.calls, ["create"] * 3 + ["update", "delete"])
+        self.assertEqual(sorted(self.dingTalkHandler.events.values()), ["新课程", "课程"])
+        self.assertEqual(self.storedEvents(), self.calendarSync.events)
+        self.assertNotIn(("b", "2024-03-04", 1), self.storedEvents())
+
+    async def test_otherUsersAndDatesUntouched(self):
+        await self.syncAndSend(["a", "b"], [planOf("a", 1), planOf("b", 1)])
+        await self.syncAndSend(["a"], [planOf("a", 1, date="2024-03-05")], date="2024-03-05")
+        counts = await self.syncAndSend(["a"], [])
+        self.assertEqual(counts["deleted"], 1)
+        self.assertEqual(sorted(self.calendarSync.events), [("a", "2024-03-05", 1), ("b", "2024-03-04", 1)])
+
+    async def test_recordsSurviveRestart(self):
+        await self.syncAndSend(["a"], [planOf("a", 1)])
+        restarted = CalendarSync(self.dingTalkHandler, self.outbox)
+        self.assertEqual(restarted.events, self.calendarSync.events)
+        self.calendarSync = restarted
+        self.assertEqual((await self.syncAndSend(["a"], [planOf("a", 1)]))["skipped"], 1)
+        self.assertEqual(self.dingTalkHandler.calls, ["create"])
+
+    async def test_repeatedOperationIsSkipped(self):
+        operation = {"op": "upsert", "plan": planOf("a", 1).toDict()}
+        self.assertIsNotNone(await self.calendarSync.runOperation(operation))
+        self.assertIsNone(await self.calendarSync.runOperation(operation))  # 如崩溃后重发
+        self.assertEqual(self.dingTalkHandler.calls, ["create"])
+
+    async def test_updateDeletedEventRecreates(self):
+        await self.syncAndSend(["a"], [planOf("a", 1)])
+        self.dingTalkHandler.events.clear()  # 用户删除了日程
+        await self.syncAndSend(["a"], [planOf("a", 1, title="新课程")])
+        self.assertEqual(self.dingTalkHandler.calls, ["create", "update", "create"])
+        self.assertEqual(self.storedEvents()[("a", "2024-03-04", 1)][0], "event2")
+
+    async def test_adoptAndPrune(self):
+        await self.syncAndSend(["a", "b"], [planOf("a", 1), planOf("b", 1, date="2024-03-05")], date="2024-03-04")
+        otherOutbox = Outbox(os.path.join(self.directory.name, "outbox.other.db"))
+        other = CalendarSync(self.dingTalkHandler, otherOutbox)
+        try:
+            self.assertEqual(other.adopt(self.fileName, {"a"}), 1)
+            self.assertEqual(other.adopt(self.fileName, {"a"}), 0)
+            self.assertEqual(list(other.events), [("a", "2024-03-04", 1)])
+            other.prune("2024-03-05")
+            self.assertEqual(other.events, {})
+            self.assertEqual(otherOutbox.connection.execute("SELECT COUNT(*) FROM calendar_events").fetchone()[0], 0)
+        finally:
+            otherOutbox.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
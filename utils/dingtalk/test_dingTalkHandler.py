@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+import httpx
+
+from utils.dingtalk.dingTalkHandler import DingTalkHandler
+from utils.dingtalk.rateLimiter import RateLimitConfig, RateLimiter
+from utils.dingtalk.settingsStore import SettingsStore
+from utils.httpClient import HttpClientPool
+
+
+class RequestDingTalkTester(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        settingFileName = os.path.join(self.directory.name, "settings.db")
+        store = SettingsStore(settingFileName)
+        for key, value in (("AGENT_ID", "0"), ("APP_KEY", "key"), ("APP_SECRET", "secret")):
+            store.setCredential(key, value)
+        store.close()
+        self.tokens = 0
+        self.dingTalkHandler = DingTalkHandler(settingFileName, HttpClientPool(asyncTransport=httpx.MockTransport(self.handle)),
+                                               RateLimiter(RateLimitConfig(qps=1000, burst=1000, maxInFlight=4, increaseEvery=1)))
+
+    async def asyncTearDown(self):
+        await self.dingTalkHandler.aclose()
+        self.directory.cleanup()
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/gettoken":
+            self.tokens += 1
+            return httpx.Response(200, json={"errcode": 0, "access_token": f"token{self.tokens}", "expires_in": 7200})
+        if request.url.params.get("access_token") != "token2":  # 第一个 AccessToken 已失效
+            return httpx.Response(200, json={"errcode": 40014, "errmsg": "不合法的access_token"})
+        return httpx.Response(200, json={"errcode": 0})
+
+    async def test_invalidTokenIsNotCountedAsSuccess(self):
+        endpoint = "/topapi/test"
+        limiter = self.dingTalkHandler.rateLimiter.of(endpoint)
+        limiter.limit = 1
+        response = await self.dingTalkHandler.requestDingTalk("POST", f"https://oapi.dingtalk.com{endpoint}", json={})
+        self.assertEqual((response.json()["errcode"], self.tokens), (0, 2))
+        self.assertEqual(limiter.limit, 2)  # 只有刷新后成功的那一次提高了并发上限
+
+
+if __name__ == '__main__':
+    unittest.main()
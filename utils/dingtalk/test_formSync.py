@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+from utils.dingtalk.formSync import ENABLE_LABEL, URL_LABEL, FormSync
+from utils.dingtalk.settingsStore import SettingsStore
+from utils.dingtalk.types import FormProfile, FormRecord
+
+
+def formRecordOf(formInstanceId: str, userId: str, modifyTime: str, url: str = "", enabled: bool = True, broken: bool = False) -> FormRecord:
+    forms = [{"label": ENABLE_LABEL, "value": "启用" if enabled else "关闭"}]
+    if not broken:
+        forms.append({"label": URL_LABEL, "value": url or f"https://course.siae.top/#/course/?grade={userId}"})
+    return FormRecord(forms=forms, createTime=modifyTime, modifyTime=modifyTime, formCode="form", submitterUserId=userId,
+                      formInstanceId=formInstanceId)
+
+
+class FakeDingTalkHandler:
+    """只提供 FormSync 用到的接口：表单列表与逐页返回的提交记录"""
+
+    def __init__(self, store: SettingsStore, pages: List[List[FormRecord]]):
+        self.store = store
+        self.pages = pages
+        self.requestedPages = 0
+
+    async def getForms(self) -> List[FormProfile]:
+        return [FormProfile(formCode="form", creator="", name="订阅钉钉推送", memo="")]
+
+    async def getFormRecordPages(self, formCode: str):
+        for page in self.pages:
+            self.requestedPages += 1
+            yield page
+
+
+class FormSyncTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SettingsStore(os.path.join(self.directory.name, "settings.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    async def fullSync(self, pages: List[List[FormRecord]]) -> FormSync:
+        formSync = FormSync(FakeDingTalkHandler(self.store, pages))
+        await formSync.sync()
+        return formSync
+
+    async def test_fullSyncLatestSubmissionWins(self):
+        formSync = await self.fullSync([[formRecordOf("2", "a", "2024-01-02", url="new"), formRecordOf("1", "a", "2024-01-01", url="old"),
+                                         formRecordOf("3", "b", "2024-01-01", enabled=False)]])
+        self.assertEqual(formSync.getSubscribedUrls(), [("a", "new")])
+        self.assertEqual(formSync.watermark, "2024-01-02")
+
+    async def test_incrementalStopsAtSyncedPage(self):
+        synced = [[formRecordOf("2", "a", "2024-01-02")], [formRecordOf("1", "b", "2024-01-01")]]
+        formSync = await self.fullSync(synced)
+        handler = FakeDingTalkHandler(self.store, [[formRecordOf("3", "c", "2024-01-03")]] + synced)
+        formSync.dingTalkHandler = handler
+        self.assertEqual(await formSync.sync(), 1)
+        self.assertEqual(handler.requestedPages, 2)  # 第二页都已同步过，不再获取第三页
+        self.assertEqual(formSync.watermark, "2024-01-03")
+        self.assertEqual(sorted(formSync.getSubscribedUrls())[2][0], "c")
+
+    async def test_incrementalFetchesAllPagesWhenNotNewestFirst(self):
+        formSync = await self.fullSync([[formRecordOf("2", "a", "2024-01-02")], [formRecordOf("1", "b", "2024-01-01")]])
+        # 接口按修改时间从旧到新返回：第一页都已同步过，新记录在第二页
+        handler = FakeDingTalkHandler(self.store, [[formRecordOf("1", "b", "2024-01-01"), formRecordOf("2", "a", "2024-01-02")],
+                                                   [formRecordOf("3", "c", "2024-01-03")]])
+        formSync.dingTalkHandler = handler
+        self.assertEqual(await formSync.sync(), 1)
+        self.assertEqual(handler.requestedPages, 2)
+        self.assertIn("c", [userId for userId, _ in formSync.getSubscribedUrls()])
+
+    async def test_brokenRecordIsSkipped(self):
+        formSync = await self.fullSync([[formRecordOf("2", "a", "2024-01-02", broken=True), formRecordOf("1", "b", "2024-01-01")]])
+        self.assertEqual([userId for userId, _ in formSync.getSubscribedUrls()], ["b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
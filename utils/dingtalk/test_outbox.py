@@ -0,0 +1,134 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from utils.dingtalk.outbox import DONE, FAILED, IN_FLIGHT, PENDING, Outbox, OutboxWorker
+
+
+class OutboxTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(os.path.join(self.directory.name, "outbox.db"), maxAttempts=3, backoffBase=10)
+
+    def tearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    def statusOf(self, idempotencyKey: str) -> str:
+        return self.outbox.connection.execute("SELECT status FROM outbox WHERE idempotency_key = ?", (idempotencyKey,)).fetchone()["status"]
+
+    def test_enqueueIsIdempotent(self):
+        self.assertTrue(self.outbox.enqueue("msg", {"n": 1}, "a"))
+        self.assertFalse(self.outbox.enqueue("msg", {"n": 2}, "a"))
+        self.assertEqual(self.outbox.enqueueMany([("msg", {}, "a"), ("msg", {}, "b")]), 1)
+        self.assertEqual([item.payload for item in self.outbox.claim(10)], [{"n": 1}, {}])
+
+    def test_claim(self):
+        self.outbox.enqueueMany([("msg", {}, str(i)) for i in range(3)])
+        self.assertEqual([item.idempotencyKey for item in self.outbox.claim(2)], ["0", "1"])
+        self.assertEqual([item.idempotencyKey for item in self.outbox.claim(2)], ["2"])
+        self.assertEqual(self.outbox.claim(2), [])
+        self.assertEqual(self.outbox.counts(), {IN_FLIGHT: 3})
+
+    def test_failBacksOffThenGivesUp(self):
+        self.outbox.enqueue("msg", {}, "a")
+        item, = self.outbox.claim(1)
+        self.outbox.fail(item, "error")
+        self.assertEqual(self.statusOf("a"), PENDING)
+        self.assertGreater(self.outbox.nextAttemptAt(), time.time() + 5)  # 第一次重试前约等待 backoffBase 秒
+        self.assertEqual(self.outbox.claim(1), [])
+        self.outbox.fail(item._replace(attempts=2), "error")
+        self.assertEqual(self.statusOf("a"), FAILED)
+        self.assertIsNone(self.outbox.nextAttemptAt())
+
+    def test_rearmFinished(self):
+        self.outbox.enqueue("msg", {"n": 1}, "a")
+        item, = self.outbox.claim(1)
+        self.assertFalse(self.outbox.enqueue("msg", {"n": 2}, "a", rearmFinished=True))  # 尚未发送完，不重复写入
+        self.outbox.complete(item.id)
+        self.assertTrue(self.outbox.enqueue("msg", {"n": 2}, "a", rearmFinished=True))
+        item, = self.outbox.claim(1)
+        self.assertEqual((item.payload, item.attempts), ({"n": 2}, 0))
+
+    def test_recover(self):
+        self.outbox.enqueue("msg", {}, "a")
+        self.outbox.claim(1)
+        self.assertEqual(self.outbox.recover(), 1)
+        self.assertEqual(self.statusOf("a"), PENDING)
+        self.assertEqual(len(self.outbox.claim(1)), 1)
+
+    def test_purge(self):
+        self.outbox.enqueueMany([("msg", {}, key) for key in "abc"])
+        done, failed, _ = self.outbox.claim(3)
+        self.outbox.complete(done.id)
+        self.outbox.fail(failed._replace(attempts=2), "error")
+        self.assertEqual(self.outbox.purge(time.time() - 60), 0)
+        self.assertEqual(self.outbox.purge(time.time() + 1), 2)
+        self.assertEqual(self.outbox.counts(), {IN_FLIGHT: 1})
+
+    def test_completeRunsEffectInSameTransaction(self):
+        self.outbox.connection.execute("CREATE TABLE effects (value TEXT)")
+        self.outbox.enqueue("msg", {}, "a")
+        item, = self.outbox.claim(1)
+
+        def failingEffect(connection):
+            connection.execute("INSERT INTO effects VALUES ('x')")
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            self.outbox.complete(item.id, failingEffect)
+        self.assertEqual(self.outbox.connection.execute("SELECT COUNT(*) FROM effects").fetchone()[0], 0)
+        self.assertEqual(self.statusOf("a"), IN_FLIGHT)
+        self.outbox.complete(item.id, lambda connection: connection.execute("INSERT INTO effects VALUES ('y')"))
+        self.assertEqual(self.outbox.connection.execute("SELECT value FROM effects").fetchall()[0][0], "y")
+        self.assertEqual(self.statusOf("a"), DONE)
+
+
+class OutboxWorkerTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(os.path.join(self.directory.name, "outbox.db"))
+        self.sent = []
+
+    def tearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    async def send(self, payload):
+        if payload.get("fail"):
+            raise Exception("failed")
+        self.sent.append(payload["n"])
+
+    async def test_runOnce(self):
+        worker = OutboxWorker(self.outbox, {"msg": self.send})
+        self.outbox.enqueueMany([("msg", {"n": 1}, "a"), ("msg", {"fail": True}, "b"), ("unknown", {}, "c")])
+        self.assertEqual(await worker.runOnce(), 3)
+        self.assertEqual(self.sent, [1])
+        self.assertEqual(self.outbox.counts(), {DONE: 1, PENDING: 2})
+
+    async def test_runContinuesAfterError(self):
+        worker = OutboxWorker(self.outbox, {"msg": self.send}, pollInterval=0.01)
+        claim = self.outbox.claim
+        calls = []
+
+        def flakyClaim(limit):
+            calls.append(limit)
+            if len(calls) == 1:
+                raise RuntimeError("database is locked")
+            return claim(limit)
+
+        self.outbox.claim = flakyClaim
+        self.outbox.enqueue("msg", {"n": 1}, "a")
+        worker.start()
+        for _ in range(100):
+            if self.sent:
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(await worker.close(timeout=1))
+        self.assertEqual(self.sent, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+
+from utils.dingtalk.rateLimiter import AdaptiveLimiter, RateLimitConfig, RateLimiter, isThrottled
+
+
+class AdaptiveLimiterTester(unittest.IsolatedAsyncioTestCase):
+    async def test_maxInFlight(self):
+        limiter = AdaptiveLimiter("test", RateLimitConfig(qps=1000, burst=1000, maxInFlight=2))
+        await limiter.__aenter__()
+        await limiter.__aenter__()
+        waiter = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        await limiter.__aexit__(None, None, None)
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(limiter.inFlight, 2)
+
+    async def test_cancelWhileWaitingForToken(self):
+        limiter = AdaptiveLimiter("test", RateLimitConfig(qps=1, burst=1, maxInFlight=5))
+        async with limiter:
+            waiter = asyncio.create_task(limiter.__aenter__())  # 令牌已用完，等待约 1 秒
+            await asyncio.sleep(0.01)
+            self.assertEqual(limiter.inFlight, 2)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertEqual(limiter.inFlight, 1)
+        self.assertEqual(limiter.inFlight, 0)
+
+    async def test_onSuccessWakesWaiters(self):
+        limiter = AdaptiveLimiter("test", RateLimitConfig(qps=1000, burst=1000, maxInFlight=2, increaseEvery=1))
+        limiter.limit = 1
+        await limiter.__aenter__()
+        waiter = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        await limiter.onSuccess()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual((limiter.limit, limiter.inFlight), (2, 2))
+
+    async def test_onThrottled(self):
+        limiter = AdaptiveLimiter("test", RateLimitConfig(qps=20, burst=20, maxInFlight=8, decreaseCooldown=60))
+        limiter.onThrottled()
+        self.assertEqual((limiter.limit, limiter.bucket.rate), (4, 10))
+        limiter.onThrottled()  # 冷却时间内不再降低
+        self.assertEqual((limiter.limit, limiter.bucket.rate), (4, 10))
+
+    async def test_backoff(self):
+        limiter = AdaptiveLimiter("test", RateLimitConfig(backoffBase=1, backoffMax=4))
+        self.assertTrue(0.5 <= limiter.backoff(0) <= 1)
+        self.assertTrue(2 <= limiter.backoff(10) <= 4)
+
+
+class RateLimiterTester(unittest.IsolatedAsyncioTestCase):
+    async def test_setShare(self):
+        rateLimiter = RateLimiter(RateLimitConfig(qps=20, burst=20, maxInFlight=10))
+        before = rateLimiter.of("a")
+        self.assertIs(rateLimiter.of("a"), before)
+        rateLimiter.setShare(0.5)
+        after = rateLimiter.of("a")
+        self.assertIsNot(after, before)
+        self.assertEqual((after.config.qps, after.limit), (10, 5))
+
+
+class ThrottledTester(unittest.TestCase):
+    def test_isThrottled(self):
+        self.assertTrue(isThrottled({"errcode": 90018}))
+        self.assertTrue(isThrottled({"errcode": 88, "sub_code": "90018"}))
+        self.assertFalse(isThrottled({"errcode": 88, "sub_code": "40014"}))
+        self.assertFalse(isThrottled({"errcode": 0}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from utils.dingtalk.settingsStore import SettingsStore
+
+
+class SettingsStoreTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SettingsStore(os.path.join(self.directory.name, "settings.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_latestSubmissionWinsOnTie(self):
+        # 同一用户的两条记录修改时间相同时，以后写入的一条为准
+        self.store.upsertSubscriptions([("1", "a", "first", True, "2024-01-01"), ("2", "a", "second", False, "2024-01-01"),
+                                        ("3", "b", "first", False, "2024-01-01"), ("4", "b", "second", True, "2024-01-01")])
+        self.assertEqual(self.store.getEnabledSubscriptions(), [("b", "second")])
+
+    def test_unionIds(self):
+        self.store.upsertUsers([{"userid": "a", "unionid": "ua", "name": "A"}])
+        self.store.setUnionId("b", "ub", fetchedAt=1.0)
+        self.assertEqual(self.store.getUnionId("b"), ("ub", 1.0))
+        self.assertEqual(self.store.getUserByUnionId("ua")["name"], "A")
+        self.assertIsNone(self.store.getUnionId("c"))
+
+    def test_migrateLegacySettings(self):
+        fileName = os.path.join(self.directory.name, "legacy.json")
+        with open(fileName, "w", encoding="utf-8") as file:
+            file.write('{"AGENT_ID": "1", "STATUS": "DONE", "ADDRESS_BOOK": [{"dept_id": 1, "dept_name": "root", '
+                       '"users": [{"userid": "a", "unionid": "ua", "name": "A"}]}]}')
+        store = SettingsStore(fileName)
+        try:
+            self.assertEqual(store.getCredential("AGENT_ID"), "1")
+            self.assertEqual(store.getUnionId("a")[0], "ua")
+            self.assertEqual(store.getAddressBook()[0]["users"][0]["name"], "A")
+            self.assertTrue(os.path.exists(f"{fileName}.json.bak"))
+        finally:
+            store.close()
+
+    def test_saveAddressBookIsAtomic(self):
+        self.store.saveAddressBook([{"dept_id": 1, "dept_name": "root", "users": [{"userid": "a", "unionid": "ua", "name": "A"}]}])
+        brokenAddressBook = [{"dept_id": 1, "dept_name": "新名称", "users": [{"userid": "b", "unionid": "ub", "name": "B"}]},
+                             {"dept_id": 2, "dept_name": "sub", "users": [{"unionid": "uc", "name": "缺少userid"}]}]
+        with self.assertRaises(KeyError):
+            self.store.saveAddressBook(brokenAddressBook)
+        self.assertEqual([(department["dept_name"], [user["userid"] for user in department["users"]]) for department in self.store.getAddressBook()],
+                         [("root", ["a"])])
+        self.assertIsNone(self.store.getUnionId("b"))
+
+    def test_failedMigrationWritesNothing(self):
+        fileName = os.path.join(self.directory.name, "legacy.json")
+        content = ('{"AGENT_ID": "1", "ADDRESS_BOOK": [{"dept_id": 1, "dept_name": "root", "users": [{"userid": "a", "unionid": "ua"}]}, '
+                   '{"dept_id": 2, "dept_name": "sub", "users": [{"unionid": "ub"}]}]}')
+        with open(fileName, "w", encoding="utf-8") as file:
+            file.write(content)
+        with self.assertRaises(KeyError):
+            SettingsStore(fileName)
+        # 旧版配置文件原样恢复，下次启动时重新迁移
+        with open(fileName, encoding="utf-8") as file:
+            self.assertEqual(file.read(), content)
+        self.assertFalse(os.path.exists(f"{fileName}.json.bak"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import asyncio
+import unittest
+
+from utils.dingtalk.tokenManager import TokenManager, isTokenInvalid
+
+
+class TokenManagerTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fetches = 0
+        self.failNext = False
+        self.expiresIn = 7200.0
+
+    async def fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(0.01)
+        if self.failNext:
+            self.failNext = False
+            raise Exception("fetch failed")
+        return f"token{self.fetches}", self.expiresIn
+
+    async def test_singleFlight(self):
+        tokenManager = TokenManager(self.fetch)
+        tokens = await asyncio.gather(*[tokenManager.get() for _ in range(20)])
+        self.assertEqual((set(tokens), self.fetches), ({"token1"}, 1))
+        self.assertEqual(await tokenManager.get(), "token1")
+        self.assertEqual(self.fetches, 1)
+
+    async def test_refreshAheadInBackground(self):
+        self.expiresIn = 300.0  # 不足 refreshAhead，但仍多于 minValidity
+        tokenManager = TokenManager(self.fetch)
+        self.assertEqual(await tokenManager.get(), "token1")
+        self.assertEqual(await tokenManager.get(), "token1")  # 不等待后台刷新
+        await tokenManager._refreshing
+        self.assertEqual((await tokenManager.get(), self.fetches), ("token2", 2))
+
+    async def test_invalidate(self):
+        tokenManager = TokenManager(self.fetch)
+        await tokenManager.get()
+        tokenManager.invalidate("token0")  # 已被刷新过的旧 token
+        self.assertEqual(await tokenManager.get(), "token1")
+        tokenManager.invalidate("token1")
+        self.assertEqual(await asyncio.gather(tokenManager.get(), tokenManager.get()), ["token2", "token2"])
+        self.assertEqual(self.fetches, 2)
+
+    async def test_cancelledCallerDoesNotCancelRefresh(self):
+        tokenManager = TokenManager(self.fetch)
+        caller = asyncio.create_task(tokenManager.get())
+        other = asyncio.create_task(tokenManager.get())
+        await asyncio.sleep(0)
+        caller.cancel()
+        self.assertEqual(await other, "token1")
+        self.assertEqual(self.fetches, 1)
+
+    async def test_failedRefreshIsRetried(self):
+        tokenManager = TokenManager(self.fetch)
+        self.failNext = True
+        with self.assertRaises(Exception):
+            await tokenManager.get()
+        self.assertEqual(await tokenManager.get(), "token2")
+
+
+class TokenInvalidTester(unittest.TestCase):
+    def test_isTokenInvalid(self):
+        self.assertTrue(isTokenInvalid({"errcode": 40014}))
+        self.assertTrue(isTokenInvalid({"code": "InvalidAuthentication"}))
+        self.assertFalse(isTokenInvalid({"errcode": 0}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+# AccessToken 失效的错误码
+#   旧版接口（oapi.dingtalk.com）  40014: 不合法的access_token    42001: access_token超时
+#   新版接口（api.dingtalk.com）  HTTP 401，code 为 InvalidAuthentication
+INVALID_TOKEN_ERRCODES = {40014, 42001}
+INVALID_TOKEN_CODES = {"InvalidAuthentication"}
+
+
+def isTokenInvalid(response: Dict) -> bool:
+    """判断钉钉接口的返回结果是否为 AccessToken 失效"""
+    return response.get("errcode", 0) in INVALID_TOKEN_ERRCODES or response.get("code") in INVALID_TOKEN_CODES
+
+
+Fetcher = Callable[[], Awaitable[Tuple[str, float]]]  # 返回 (AccessToken, 有效期（秒）)
+
+
+class TokenManager:
+    """
+    管理 AccessToken 的有效期：剩余有效期不足 refreshAhead 时在后台提前刷新，期间仍使用当前的 AccessToken；
+    不足 minValidity 或已被标记失效时，等待刷新完成后再使用。
+    同一时刻只有一个刷新请求，并发的调用者共享它的结果。
+    """
+
+    def __init__(self, fetch: Fetcher, refreshAhead: float = 600.0, minValidity: float = 60.0):
+        self.fetch = fetch
+        self.refreshAhead = refreshAhead
+        self.minValidity = minValidity
+        self.token: Optional[str] = None
+        self.expiresAt = 0.0  # time.monotonic()
+        self._refreshing: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def remaining(self) -> float:
+        """剩余有效期（秒）"""
+        return self.expiresAt - time.monotonic() if self.token is not None else 0.0
+
+    async def get(self) -> str:
+        remaining = self.remaining()
+        if remaining <= self.minValidity:
+            return await self.refresh()
+        if remaining <= self.refreshAhead:
+            self.startRefresh()
+        return self.token
+
+    async def refresh(self) -> str:
+        """刷新 AccessToken；已有刷新进行中时等待它完成。调用者被取消时不会取消共享的刷新"""
+        return await asyncio.shield(self.startRefresh())
+
+    def invalidate(self, token: str):
+        """钉钉返回 AccessToken 失效时调用；token 已被刷新过则忽略，避免重复刷新"""
+        if token == self.token:
+            self.expiresAt = 0.0
+
+    def startRefresh(self) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        if self._refreshing is None or self._refreshing.done() or self._loop is not loop:
+            self._loop = loop
+            self._refreshing = loop.create_task(self._refresh())
+            self._refreshing.add_done_callback(self._onRefreshed)
+        return self._refreshing
+
+    async def _refresh(self) -> str:
+        token, expiresIn = await self.fetch()
+        self.token, self.expiresAt = token, time.monotonic() + expiresIn
+        return token
+
+    @staticmethod
+    def _onRefreshed(task: asyncio.Task):
+        # 后台刷新失败时不影响当前的 AccessToken，下次调用 get 时会再次尝试
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"刷新AccessToken失败: {task.exception()}")
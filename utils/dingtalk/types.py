@@ -6,7 +6,7 @@ UserName = str
 UnionId = str
 DepartmentId = int
 DepartmentName = str
-Method = Literal["GET", "POST"]
+Method = Literal["GET", "POST", "PUT", "DELETE"]
 
 UserNameIdDict = Dict[UserName, UserId]
 
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from utils.dingtalk.settingsStore import SettingsStore
+from utils.dingtalk.types import UserId, UnionId
+from utils.metrics import registry
+
+cacheRequests = registry.counter("sillage_cache_requests", "缓存的查询次数", ["cache", "result"])
+
+
+class UnionIdCache:
+    """
+    userId -> unionId 的缓存。unionId 不会变化，因此只需为新出现的用户查询一次；
+    提供 store 时缓存保存在其 users 表中（通讯录中的用户已有 unionId），否则只保存在内存中。
+    """
+
+    def __init__(self, store: Optional[SettingsStore] = None, ttl: float = 30 * 24 * 3600, batchSize: int = 50):
+        self.store = store
+        self.ttl = ttl  # 缓存有效期（秒）
+        self.batchSize = batchSize  # 每批并发查询的用户数
+        self.entries: Dict[UserId, Tuple[UnionId, float]] = {}  # userId -> (unionId, 获取时间)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def loadSnapshot(self, snapshot: Dict[UserId, List]):
+        for userId, (unionId, fetchedAt) in snapshot.items():
+            self.entries[userId] = (unionId, fetchedAt)
+            if self.store is not None:
+                self.store.setUnionId(userId, unionId, fetchedAt)
+
+    def get(self, userId: UserId) -> Optional[UnionId]:
+        entry = self.entries.get(userId)
+        if entry is None and self.store is not None:
+            entry = self.store.getUnionId(userId)
+            if entry is not None:
+                self.entries[userId] = entry
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def set(self, userId: UserId, unionId: UnionId):
+        self.entries[userId] = (unionId, time.time())
+        if self.store is not None:
+            self.store.setUnionId(userId, unionId)
+
+    async def resolve(self, userIds: Iterable[UserId], fetch: Callable[[UserId], Awaitable[UnionId]]) -> Dict[UserId, UnionId]:
+        """
+        返回各用户的 unionId；只为缓存中没有（或已过期）的用户调用 fetch，按批并发查询。
+        查询失败的用户不会出现在结果中。
+        """
+        result: Dict[UserId, UnionId] = {}
+        misses: List[UserId] = []
+        for userId in dict.fromkeys(userIds):
+            unionId = self.get(userId)
+            if unionId is None:
+                misses.append(userId)
+            else:
+                result[userId] = unionId
+        cacheRequests.labels("unionId", "hit").inc(len(result))
+        cacheRequests.labels("unionId", "miss").inc(len(misses))
+
+        for i in range(0, len(misses), self.batchSize):
+            batch = misses[i:i + self.batchSize]
+            for userId, unionId in zip(batch, await asyncio.gather(*[fetch(userId) for userId in batch], return_exceptions=True)):
+                if isinstance(unionId, BaseException):
+                    logger.error(f"""获取id为"{userId}"的用户详细信息时出错: {unionId}""")
+                    continue
+                self.set(userId, unionId)
+                result[userId] = unionId
+        return result
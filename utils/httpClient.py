@@ -0,0 +1,88 @@
+import asyncio
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel
+
+
+class HttpClientConfig(BaseModel):
+    maxConnections: int = 20  # 每个主机的最大连接数
+    maxKeepaliveConnections: int = 10  # 每个主机保持的空闲长连接数
+    keepaliveExpiry: float = 60.0  # 空闲长连接的保留时间（秒）
+    timeout: float = 10.0  # 请求超时时间（秒）
+    connectTimeout: float = 5.0  # 建立连接的超时时间（秒）
+    http2: bool = False  # 是否启用HTTP/2（需要安装 h2）
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.maxConnections,
+                            max_keepalive_connections=self.maxKeepaliveConnections,
+                            keepalive_expiry=self.keepaliveExpiry)
+
+    def timeouts(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connectTimeout)
+
+
+def _http2Available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class HttpClientPool:
+    """
+    长期存活的异步HTTP客户端池：每个主机一个客户端，复用连接（keep-alive），避免每次请求都重新进行TCP+TLS握手。
+    客户端与创建它的事件循环绑定；测试时可通过 asyncTransport 注入模拟的传输层。
+    """
+
+    def __init__(self, config: Optional[HttpClientConfig] = None, asyncTransport: Optional[httpx.AsyncBaseTransport] = None):
+        self.config = config or HttpClientConfig()
+        if self.config.http2 and not _http2Available():
+            logger.warning("未安装 h2，已禁用HTTP/2")
+            self.config = self.config.copy(update={"http2": False})
+        self.asyncTransport = asyncTransport
+
+        self._asyncClients: Dict[str, httpx.AsyncClient] = {}
+        self._asyncClientsLoop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def hostOf(url: str) -> str:
+        parseResult = urlparse(url)
+        return f"{parseResult.scheme}://{parseResult.netloc}"
+
+    def getAsyncClient(self, url: str) -> httpx.AsyncClient:
+        """获取url所在主机的异步客户端（需在事件循环中调用）"""
+        host = self.hostOf(url)
+        loop = asyncio.get_running_loop()
+        if self._asyncClientsLoop is not loop:
+            # 异步客户端的连接与创建它的事件循环绑定，事件循环变化后需要重新创建
+            self.discardAsyncClients()
+            self._asyncClientsLoop = loop
+        if host not in self._asyncClients:
+            self._asyncClients[host] = httpx.AsyncClient(limits=self.config.limits(), timeout=self.config.timeouts(),
+                                                         http2=self.config.http2, transport=self.asyncTransport)
+        return self._asyncClients[host]
+
+    def discardAsyncClients(self):
+        """
+        丢弃绑定在旧事件循环上的客户端：旧事件循环仍在（其他线程中）运行时在其上关闭；
+        已停止或已关闭时无法再在其上关闭连接，只能交由垃圾回收释放
+        """
+        clients, loop = list(self._asyncClients.values()), self._asyncClientsLoop
+        self._asyncClients = {}
+        if not clients:
+            return
+        if loop is not None and loop.is_running() and not loop.is_closed():
+            for client in clients:
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        else:
+            logger.debug(f"丢弃{len(clients)}个绑定在已停止的事件循环上的HTTP客户端")
+
+    async def aclose(self):
+        """关闭所有客户端（需在创建它们的事件循环中调用）"""
+        for client in self._asyncClients.values():
+            await client.aclose()
+        self._asyncClients = {}
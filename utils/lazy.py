@@ -0,0 +1,30 @@
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyHandler(Generic[T]):
+    """在首次访问属性时才创建实例，使导入模块时不会发起任何网络请求"""
+
+    def __init__(self, factory: Callable[[], T]):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+
+    def get(self) -> T:
+        if self._instance is None:
+            object.__setattr__(self, "_instance", self._factory())
+        return self._instance
+
+    def override(self, instance: T):
+        """替换为指定的实例，如基准测试中使用模拟服务端的实例"""
+        object.__setattr__(self, "_instance", instance)
+
+    @property
+    def created(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
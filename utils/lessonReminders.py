@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from loguru import logger
+
+from utils.course import CompiledSubscription, CourseDiff
+from utils.timingWheel import TimingWheel
+from utils.tracing import span
+
+Digest = Tuple[str, str]  # (标题, 内容)
+Recipients = Dict[Digest, List[str]]  # (标题, 内容) -> 接收人userId列表
+ReminderKey = Tuple[str, int]  # (日期, 第几节课)
+# 参数为 (日期, 节次列表, 用户列表)，返回各节次的消息与接收人；用户需有 userId 与 subscription 属性
+Render = Callable[[str, Sequence[int], List], Dict[int, Recipients]]
+
+
+class LessonReminders:
+    """
+    每节课前的提醒：每次刷新后，用时间轮排好未来 horizon 内各节课的提醒（提醒时间 -> 接收人与渲染好的消息），
+    只包含该时段确实有课的用户。课程或订阅变化时，只重建受影响的时段：
+    课程变化时重新渲染它所在的时段；用户的订阅变化时，只为这些用户重新渲染并替换他们在各时段中的记录。
+    """
+
+    def __init__(self, render: Render, dispatch: Callable[[Recipients, str], None], fireTimeOf: Callable[[str, int], datetime.datetime],
+                 horizon: datetime.timedelta = datetime.timedelta(hours=24), lessonNums: Sequence[int] = range(1, 6),
+                 tick: float = 60.0, graceTime: float = 600.0):
+        self.render = render
+        self.dispatch = dispatch  # 参数为 (消息与接收人, 幂等键前缀)
+        self.fireTimeOf = fireTimeOf  # 某天某节课的提醒时间
+        self.horizon = horizon
+        self.lessonNums = list(lessonNums)
+        self.graceTime = graceTime  # 错过提醒时间不超过该时长（秒）时仍然发送，与定时任务的 misfire_grace_time 一致
+        self.wheel: TimingWheel[ReminderKey, Recipients] = TimingWheel(tick, int((horizon.total_seconds() + graceTime) // tick) + 1)
+        self.subscriptionOfUser: Dict[str, CompiledSubscription] = {}  # 上次排期时各用户的订阅
+        self.fired: Set[ReminderKey] = set()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def keysInHorizon(self, now: datetime.datetime) -> Dict[ReminderKey, float]:
+        """提醒时间在 [now - graceTime, now + horizon] 内且尚未发送的时段 -> 提醒时间戳"""
+        earliest, latest = now - datetime.timedelta(seconds=self.graceTime), now + self.horizon
+        keys: Dict[ReminderKey, float] = {}
+        date = earliest.date()
+        while date <= latest.date():
+            dateStr = date.strftime("%Y-%m-%d")
+            for lessonNum in self.lessonNums:
+                fireTime = self.fireTimeOf(dateStr, lessonNum)
+                if earliest <= fireTime <= latest and (dateStr, lessonNum) not in self.fired:
+                    keys[(dateStr, lessonNum)] = fireTime.timestamp()
+            date += datetime.timedelta(days=1)
+        return keys
+
+    def build(self, keys: Iterable[ReminderKey], users: List) -> Dict[ReminderKey, Recipients]:
+        """为 users 渲染 keys 中各时段的提醒；同一天的时段只计算一次课程匹配"""
+        lessonNumsOfDate: Dict[str, List[int]] = {}
+        for date, lessonNum in keys:
+            lessonNumsOfDate.setdefault(date, []).append(lessonNum)
+        built: Dict[ReminderKey, Recipients] = {}
+        for date, lessonNums in lessonNumsOfDate.items():
+            for lessonNum, recipients in self.render(date, lessonNums, users).items():
+                built[(date, lessonNum)] = recipients
+        return built
+
+    def reschedule(self, users: List, courseDiff: Optional[CourseDiff] = None, now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+        """
+        刷新课程与用户后调用，返回重建、局部更新的时段数。\n
+        :param courseDiff: 本次刷新的课程变化；为 None 时视为全部时段都受影响
+        """
+        now = now or datetime.datetime.now()
+        keys = self.keysInHorizon(now)
+        for key in self.wheel.keys():
+            if key not in keys:
+                self.wheel.cancel(key)
+        self.fired = {key for key in self.fired if key[0] >= (now - datetime.timedelta(seconds=self.graceTime)).strftime("%Y-%m-%d")}
+
+        subscriptionOfUser = {user.userId: user.subscription for user in users}
+        changedUserIds = {userId for userId, subscription in subscriptionOfUser.items() if self.subscriptionOfUser.get(userId) != subscription}
+        changedUserIds.update(userId for userId in self.subscriptionOfUser if userId not in subscriptionOfUser)
+        self.subscriptionOfUser = subscriptionOfUser
+
+        if courseDiff is None:
+            affectedKeys = set(keys)
+        else:
+            affectedKeys = {(date, course.lessonNum) for course in courseDiff.courses() for date in course.dates} & keys.keys()
+        rebuildKeys = [key for key in keys if key not in self.wheel or key in affectedKeys]
+        patchKeys = [key for key in keys if key not in rebuildKeys] if changedUserIds else []
+
+        for key, recipients in self.build(rebuildKeys, users).items():
+            self.wheel.schedule(key, keys[key], recipients)
+        if patchKeys:
+            changedUsers = [user for user in users if user.userId in changedUserIds]
+            built = self.build(patchKeys, changedUsers)
+            for key in patchKeys:
+                self.wheel.schedule(key, keys[key], self.patch(self.wheel.get(key), changedUserIds, built.get(key, {})))
+        self.notify()
+        return {"rebuilt": len(rebuildKeys), "patched": len(patchKeys)}
+
+    @staticmethod
+    def patch(recipients: Recipients, userIds: Set[str], changed: Recipients) -> Recipients:
+        """从 recipients 中移除 userIds，再合并为他们重新渲染的 changed"""
+        patched: Recipients = {}
+        for digest, userIdList in recipients.items():
+            userIdList = [userId for userId in userIdList if userId not in userIds]
+            if userIdList:
+                patched[digest] = userIdList
+        for digest, userIdList in changed.items():
+            patched.setdefault(digest, []).extend(userIdList)
+        return patched
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def fire(self, now: float) -> int:
+        """发送所有已到提醒时间的时段，返回发送的时段数"""
+        due = self.wheel.advance(now)
+        for (date, lessonNum), recipients in due:
+            self.fired.add((date, lessonNum))
+            if recipients:
+                try:
+                    with span("LessonReminders.fire", date=date, lessonNum=lessonNum):
+                        self.dispatch(recipients, f"lesson:{date}:{lessonNum}")
+                except Exception:  # 已从时间轮中取出，不影响同时到期的其他时段
+                    logger.exception(f"发送{date}第{lessonNum}节课的提醒出错")
+                    continue
+            logger.info(f"发送{date}第{lessonNum}节课的提醒，共{sum(map(len, recipients.values()))}位用户")
+        return len(due)
+
+    def start(self) -> asyncio.Task:
+        """在当前事件循环中启动"""
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def run(self):
+        while True:
+            try:
+                self.fire(time.time())
+                self.wakeup.clear()
+                nextFireAt = self.wheel.nextFireAt()
+                timeout = None if nextFireAt is None else max(nextFireAt - time.time(), 0)
+            except Exception:  # 一次提醒出错不影响之后的提醒，一个刻度后重试
+                logger.exception("发送课前提醒出错")
+                self.wakeup.clear()
+                timeout = self.wheel.tick
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,353 @@
+import asyncio
+import bisect
+import functools
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+LabelValues = Tuple[str, ...]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def escapeLabelValue(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def formatLabels(labelNames: Sequence[str], labelValues: Sequence[str]) -> str:
+    if not labelNames:
+        return ""
+    return "{" + ",".join(f'{name}="{escapeLabelValue(value)}"' for name, value in zip(labelNames, labelValues)) + "}"
+
+
+def formatValue(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """指标的公共部分：按标签值划分为多个子指标，子指标在第一次使用时创建"""
+
+    kind = ""
+    metadataSuffix = ""  # HELP / TYPE 行的名称后缀，与样本名称一致
+
+    def __init__(self, name: str, help: str, labelNames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.children: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def newChild(self):
+        raise NotImplementedError
+
+    def labels(self, *labelValues) -> "Metric":
+        """取出标签值对应的子指标；热点路径上应预先取出并保存子指标，避免每次查找"""
+        if len(labelValues) != len(self.labelNames):
+            raise ValueError(f"指标{self.name}需要{len(self.labelNames)}个标签值，实际为{len(labelValues)}个")
+        labelValues = tuple(str(value) for value in labelValues)
+        child = self.children.get(labelValues)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(labelValues, self.newChild())
+        return child
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, LabelValues, Tuple[str, ...], float]]:
+        """(名称后缀, 标签值, 额外的标签名与值, 数值)"""
+        raise NotImplementedError
+
+    def toPrometheus(self) -> List[str]:
+        metadataName = self.name + self.metadataSuffix
+        lines = [f"# HELP {metadataName} {self.help}", f"# TYPE {metadataName} {self.kind}"]
+        for suffix, labelValues, extraLabel, value in self.samples():
+            labelNames, values = self.labelNames + extraLabel[:1], labelValues + extraLabel[1:]
+            lines.append(f"{self.name}{suffix}{formatLabels(labelNames, values)} {formatValue(value)}")
+        return lines
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+
+    kind = "counter"
+    metadataSuffix = "_total"
+
+    def newChild(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for labelValues, child in list(self.children.items()):
+            yield "_total", labelValues, (), child.value
+
+    def toDict(self) -> Dict:
+        return {",".join(labelValues): child.value for labelValues, child in list(self.children.items())}
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def setFunction(self, function: Callable[[], float]):
+        """读取指标时才调用 function 计算当前值，如课程数、用户数"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is None:
+            return self.value
+        try:
+            return float(self.function())
+        except Exception as e:
+            logger.debug(f"计算指标时出错: {e}")  # 每次抓取都会调用，不记为警告以免刷屏；结果为 NaN
+            return float("nan")
+
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+
+    kind = "gauge"
+
+    def newChild(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def setFunction(self, function: Callable[[], float]):
+        self.labels().setFunction(function)
+
+    def samples(self):
+        for labelValues, child in list(self.children.items()):
+            yield "", labelValues, (), child.get()
+
+    def toDict(self) -> Dict:
+        return {",".join(labelValues): child.get() for labelValues, child in list(self.children.items())}
+
+
+class HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - startTime)
+
+    def quantile(self, q: float) -> float:
+        """由分桶估计分位数（桶内线性插值），用于 JSON 输出"""
+        if not self.count:
+            return 0.0
+        rank, cumulative = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class Histogram(Metric):
+    """耗时等数值的分布：按 buckets 分桶计数，并记录总和与次数"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelNames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def newChild(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        for labelValues, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", labelValues, ("le", formatValue(bound)), cumulative
+            yield "_sum", labelValues, (), child.sum
+            yield "_count", labelValues, (), child.count
+
+    def toDict(self) -> Dict:
+        return {",".join(labelValues): {"count": child.count, "sum": child.sum, "p50": child.quantile(0.5),
+                                        "p90": child.quantile(0.9), "p99": child.quantile(0.99)}
+                for labelValues, child in list(self.children.items())}
+
+
+class MetricsRegistry:
+    """全部指标；同名的指标只创建一次，各模块在导入时注册自己的指标"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """同名的指标已注册时返回已有的指标；类型、标签名或分桶与已有的不一致时抛出 ValueError"""
+        with self._lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if existing is not metric:
+            if type(existing) is not type(metric) or existing.labelNames != metric.labelNames or \
+                    (isinstance(existing, Histogram) and existing.buckets != metric.buckets):
+                raise ValueError(f"指标{metric.name}已注册为{existing.kind}{list(existing.labelNames)}，与本次注册的{metric.kind}{list(metric.labelNames)}不一致")
+        return existing
+
+    def counter(self, name: str, help: str, labelNames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelNames))
+
+    def gauge(self, name: str, help: str, labelNames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelNames))
+
+    def histogram(self, name: str, help: str, labelNames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def toPrometheus(self) -> str:
+        """Prometheus 的文本格式（text/plain; version=0.0.4）"""
+        lines: List[str] = []
+        for metric in list(self.metrics.values()):
+            lines += metric.toPrometheus()
+        return "\n".join(lines) + "\n"
+
+    def toDict(self) -> Dict:
+        return {name: {"type": metric.kind, "labels": list(metric.labelNames), "values": metric.toDict()}
+                for name, metric in list(self.metrics.items())}
+
+
+registry = MetricsRegistry()
+
+
+def instrument(seconds: Histogram, runs: Counter, *labelValues: str):
+    """装饰器：记录函数（同步或异步）每次运行的耗时，以及按 status（ok / error）划分的运行次数"""
+    secondsChild = seconds.labels(*labelValues)
+    okRuns, errorRuns = runs.labels(*labelValues, "ok"), runs.labels(*labelValues, "error")
+
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def asyncWrapper(*args, **kwargs):
+                startTime = time.perf_counter()
+                try:
+                    result = await function(*args, **kwargs)
+                except BaseException:
+                    errorRuns.inc()
+                    raise
+                else:
+                    okRuns.inc()
+                    return result
+                finally:
+                    secondsChild.observe(time.perf_counter() - startTime)
+
+            return asyncWrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            startTime = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                errorRuns.inc()
+                raise
+            else:
+                okRuns.inc()
+                return result
+            finally:
+                secondsChild.observe(time.perf_counter() - startTime)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer:
+    """
+    在本机提供指标的极简 HTTP 服务（无需额外依赖）：
+    GET /metrics 返回 Prometheus 文本格式，GET /metrics.json 返回 JSON
+    """
+
+    def __init__(self, metricsRegistry: MetricsRegistry = registry, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = metricsRegistry
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            logger.warning(f"无法在{self.host}:{self.port}启动指标服务: {e}")
+            return
+        logger.info(f"指标服务已启动: http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def respond(self, path: str) -> Tuple[str, str, bytes]:
+        """返回 (状态, Content-Type, 内容)"""
+        if path == "/metrics":
+            return "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.registry.toPrometheus().encode("utf-8")
+        if path == "/metrics.json":
+            return "200 OK", "application/json; charset=utf-8", json.dumps(self.registry.toDict(), ensure_ascii=False).encode("utf-8")
+        return "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass  # 忽略请求头
+            parts = requestLine.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) >= 2 else "/"
+            status, contentType, body = self.respond(path) if parts and parts[0] == "GET" else \
+                ("405 Method Not Allowed", "text/plain; charset=utf-8", b"method not allowed\n")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,165 @@
+import hashlib
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect
+from typing import Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (worker_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS publications (name TEXT PRIMARY KEY, version TEXT NOT NULL, published_at REAL NOT NULL);
+"""
+
+
+def hashOf(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环：每个节点占 replicas 个虚拟节点；节点增减时只有约 1/N 的键改变归属"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 100):
+        points = sorted((hashOf(f"{node}#{i}"), node) for node in set(nodes) for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def ownerOf(self, key: str) -> Optional[str]:
+        if not self.nodes:
+            return None
+        return self.nodes[bisect(self.hashes, hashOf(key)) % len(self.nodes)]
+
+
+class LeaseStore(ABC):
+    """
+    分片协调所需的共享状态：成员心跳、租约与发布的版本号。
+    默认实现为本地的 SQLite 文件（同一主机的多个进程，或放在共享存储上）；跨主机时可替换为 etcd、Redis 等实现。
+    所有时间均为 time.time()。除 close 外的方法都需由子类实现。
+    """
+
+    @abstractmethod
+    def heartbeat(self, workerId: str, now: float):
+        raise NotImplementedError
+
+    @abstractmethod
+    def leave(self, workerId: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def members(self, aliveSince: float) -> List[str]:
+        """心跳时间不早于 aliveSince 的成员"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def acquire(self, name: str, owner: str, ttl: float, now: float) -> bool:
+        """获取或续期租约；租约由别人持有且未过期时返回 False"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, name: str, owner: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def publish(self, name: str, version: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def published(self, name: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteLeaseStore(LeaseStore):
+    def __init__(self, fileName: str = "shards.db"):
+        self.fileName = fileName
+        self.connection = sqlite3.connect(fileName, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def heartbeat(self, workerId: str, now: float):
+        with self.connection:
+            self.connection.execute("INSERT INTO members (worker_id, heartbeat_at) VALUES (?, ?) "
+                                    "ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at", (workerId, now))
+
+    def leave(self, workerId: str):
+        with self.connection:
+            self.connection.execute("DELETE FROM members WHERE worker_id = ?", (workerId,))
+
+    def members(self, aliveSince: float) -> List[str]:
+        rows = self.connection.execute("SELECT worker_id FROM members WHERE heartbeat_at >= ? ORDER BY worker_id", (aliveSince,))
+        return [workerId for workerId, in rows]
+
+    def acquire(self, name: str, owner: str, ttl: float, now: float) -> bool:
+        # 单条语句完成“比较并设置”，多个进程同时获取时只有一个成功
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                                             "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                                             "WHERE leases.owner = excluded.owner OR leases.expires_at < ?", (name, owner, now + ttl, now))
+        return cursor.rowcount == 1
+
+    def release(self, name: str, owner: str):
+        with self.connection:
+            self.connection.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def publish(self, name: str, version: str):
+        with self.connection:
+            self.connection.execute("INSERT INTO publications (name, version, published_at) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (name) DO UPDATE SET version = excluded.version, published_at = excluded.published_at",
+                                    (name, version, time.time()))
+
+    def published(self, name: str) -> Optional[str]:
+        row = self.connection.execute("SELECT version FROM publications WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+
+class ShardCoordinator:
+    """
+    多个工作进程（可在不同主机上）按一致性哈希划分订阅用户：每个进程定期发送心跳，
+    心跳超过 ttl 未更新的进程视为已退出，它的用户由环上的下一个进程接管。
+    持有 leaderLease 的进程为主进程，负责获取课程与订阅并发布给其他进程。
+    """
+
+    leaderLease = "leader"
+
+    def __init__(self, store: LeaseStore, workerId: str, ttl: float = 30.0, replicas: int = 100):
+        self.store = store
+        self.workerId = workerId
+        self.ttl = ttl
+        self.replicas = replicas
+        self.workers: List[str] = []
+        self.ring = HashRing([], replicas)
+        self.isLeader = False
+
+    def heartbeat(self) -> Tuple[Set[str], Set[str]]:
+        """发送心跳并更新成员与主进程，返回 (新加入的进程, 已退出的进程)"""
+        now = time.time()
+        self.store.heartbeat(self.workerId, now)
+        workers = self.store.members(now - self.ttl)
+        isLeader = self.store.acquire(self.leaderLease, self.workerId, self.ttl, now)
+        if isLeader and not self.isLeader:
+            logger.info(f"{self.workerId}成为主进程")
+        self.isLeader = isLeader
+
+        joined, departed = set(workers) - set(self.workers), set(self.workers) - set(workers)
+        if joined or departed:
+            logger.info(f"分片成员变化：加入{sorted(joined)}，退出{sorted(departed)}，当前{len(workers)}个进程")
+            self.workers = workers
+            self.ring = HashRing(workers, self.replicas)
+        return joined, departed
+
+    def owns(self, key: str) -> bool:
+        return self.ring.ownerOf(key) == self.workerId
+
+    def leave(self):
+        """正常退出时立即让出主进程与分片，其他进程在下一次心跳时接管"""
+        if self.isLeader:
+            self.store.release(self.leaderLease, self.workerId)
+            self.isLeader = False
+        self.store.leave(self.workerId)
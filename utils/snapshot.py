@@ -0,0 +1,50 @@
+import json
+import os
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotStore:
+    """
+    本地快照：保存课程、已编译的订阅、unionId 与通讯录，使进程启动时无需等待网络请求。
+    快照带有版本号，版本不一致时视为没有快照；写入时先写临时文件再替换，避免写到一半时崩溃导致快照损坏。
+    """
+
+    def __init__(self, fileName: str = "snapshot.json"):
+        self.fileName = fileName
+        self.sections: Dict[str, Any] = {}
+        self.load()
+
+    def load(self) -> Dict[str, Any]:
+        if not os.path.exists(self.fileName):
+            return self.sections
+        try:
+            with open(self.fileName, encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取快照“{self.fileName}”失败，将重新获取数据: {e}")
+            return self.sections
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.info(f"快照“{self.fileName}”的版本({snapshot.get('version')})与当前版本({SNAPSHOT_VERSION})不一致，已忽略")
+            return self.sections
+        self.sections = snapshot.get("sections", {})
+        return self.sections
+
+    def get(self, section: str, default: Optional[Any] = None) -> Any:
+        return self.sections.get(section, default)
+
+    def set(self, section: str, value: Any):
+        self.sections[section] = value
+
+    def pop(self, section: str, default: Optional[Any] = None) -> Any:
+        """取出并移除某一部分，用于迁移已不再保存在快照中的数据"""
+        return self.sections.pop(section, default)
+
+    def save(self):
+        tempFileName = f"{self.fileName}.tmp"
+        with open(tempFileName, "wt", encoding="utf-8") as file:
+            json.dump({"version": SNAPSHOT_VERSION, "sections": self.sections}, file, ensure_ascii=False)
+        os.replace(tempFileName, self.fileName)
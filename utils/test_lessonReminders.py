@@ -0,0 +1,55 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+from utils.lessonReminders import LessonReminders
+
+
+class LessonRemindersTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dispatched = []
+        self.lessonReminders = LessonReminders(lambda date, lessonNums, users: {}, self.dispatch,
+                                               lambda date, lessonNum: datetime.datetime.now(), horizon=datetime.timedelta(minutes=1),
+                                               tick=0.05, graceTime=1)
+
+    def dispatch(self, recipients, keyPrefix: str):
+        if keyPrefix.endswith(":1"):
+            raise Exception("dispatch failed")
+        self.dispatched.append(keyPrefix)
+
+    async def waitForDispatched(self, count: int):
+        for _ in range(200):
+            if len(self.dispatched) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_failedSlotDoesNotBlockOthers(self):
+        for lessonNum in (1, 2):
+            self.lessonReminders.wheel.schedule(("2024-03-04", lessonNum), time.time(), {("标题", "内容"): ["user"]})
+        self.lessonReminders.start()
+        await self.waitForDispatched(1)
+        await self.lessonReminders.close()
+        self.assertEqual(self.dispatched, ["lesson:2024-03-04:2"])
+
+    async def test_runContinuesAfterError(self):
+        wheel = self.lessonReminders.wheel
+        advance = wheel.advance
+        calls = []
+
+        def flakyAdvance(now):
+            calls.append(now)
+            if len(calls) == 1:
+                raise RuntimeError("advance failed")
+            return advance(now)
+
+        wheel.advance = flakyAdvance
+        wheel.schedule(("2024-03-04", 2), time.time(), {("标题", "内容"): ["user"]})
+        self.lessonReminders.start()
+        await self.waitForDispatched(1)
+        await self.lessonReminders.close()
+        self.assertEqual(self.dispatched, ["lesson:2024-03-04:2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
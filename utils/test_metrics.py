@@ -0,0 +1,59 @@
+import unittest
+
+from utils.metrics import Counter, Metric, MetricsRegistry
+
+
+class MetricsTester(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counterMetadataMatchesSamples(self):
+        runs = self.registry.counter("sillage_runs", "运行次数", ["job"])
+        runs.labels("goodNight").inc()
+        runs.labels("goodNight").inc(2)
+        self.assertEqual(self.registry.toPrometheus().splitlines(),
+                         ["# HELP sillage_runs_total 运行次数", "# TYPE sillage_runs_total counter", 'sillage_runs_total{job="goodNight"} 3'])
+
+    def test_gaugeAndHistogram(self):
+        self.registry.gauge("sillage_users", "用户数").labels().setFunction(lambda: 5)
+        self.registry.histogram("sillage_seconds", "耗时", buckets=(1.0,)).observe(0.5)
+        lines = self.registry.toPrometheus().splitlines()
+        self.assertIn("# TYPE sillage_users gauge", lines)
+        self.assertIn("sillage_users 5", lines)
+        self.assertIn("# TYPE sillage_seconds histogram", lines)
+        self.assertIn('sillage_seconds_bucket{le="1"} 1', lines)
+        self.assertIn("sillage_seconds_count 1", lines)
+
+
+    def test_registerReturnsExisting(self):
+        runs = self.registry.counter("sillage_runs", "运行次数", ["job"])
+        self.assertIs(self.registry.counter("sillage_runs", "运行次数", ["job"]), runs)
+        seconds = self.registry.histogram("sillage_seconds", "耗时", buckets=(1.0, 2.0))
+        self.assertIs(self.registry.histogram("sillage_seconds", "耗时", buckets=(2.0, 1.0)), seconds)
+
+    def test_registerRejectsMismatch(self):
+        self.registry.counter("sillage_runs", "运行次数", ["job"])
+        with self.assertRaises(ValueError):
+            self.registry.gauge("sillage_runs", "运行次数", ["job"])
+        with self.assertRaises(ValueError):
+            self.registry.counter("sillage_runs", "运行次数", ["job", "status"])
+        self.registry.histogram("sillage_seconds", "耗时", buckets=(1.0,))
+        with self.assertRaises(ValueError):
+            self.registry.histogram("sillage_seconds", "耗时", buckets=(1.0, 2.0))
+
+    def test_metricIsAbstract(self):
+        with self.assertRaises(TypeError):
+            Metric("sillage_runs", "运行次数")
+        self.assertEqual(Counter("sillage_runs", "运行次数").kind, "counter")
+
+    def test_sharedNamesAreConsistent(self):
+        # 多个模块注册同名的指标（如 sillage_cache_requests），导入时不应报错
+        import main
+        import utils.course.courseRenderer
+        import utils.dingtalk.unionIdCache
+        from utils.metrics import registry
+        self.assertEqual(registry.metrics["sillage_cache_requests"].labelNames, ("cache", "result"))
+
+
+if __name__ == '__main__':
+    unittest.main()
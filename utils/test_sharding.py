@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.sharding import HashRing, LeaseStore, ShardCoordinator, SqliteLeaseStore
+
+
+class HashRingTester(unittest.TestCase):
+    def setUp(self):
+        self.keys = [f"user{i}" for i in range(3000)]
+
+    def test_balanced(self):
+        ring = HashRing(["a", "b", "c"])
+        counts = {node: 0 for node in "abc"}
+        for key in self.keys:
+            counts[ring.ownerOf(key)] += 1
+        self.assertTrue(all(600 < count < 1400 for count in counts.values()), counts)
+
+    def test_onlyMovedKeysChangeOwner(self):
+        before, after = HashRing(["a", "b", "c"]), HashRing(["a", "b", "c", "d"])
+        moved = [key for key in self.keys if before.ownerOf(key) != after.ownerOf(key)]
+        self.assertTrue(all(after.ownerOf(key) == "d" for key in moved))  # 只有被新节点接管的键改变归属
+        self.assertLess(len(moved), len(self.keys) / 2)
+        removed = HashRing(["a", "c"])
+        self.assertTrue(all(removed.ownerOf(key) == before.ownerOf(key) for key in self.keys if before.ownerOf(key) != "b"))
+
+    def test_empty(self):
+        self.assertIsNone(HashRing([]).ownerOf("user"))
+
+
+class ShardCoordinatorTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SqliteLeaseStore(os.path.join(self.directory.name, "shards.db"))
+        self.now = 1000.0
+        patcher = mock.patch("utils.sharding.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_leaseStoreIsAbstract(self):
+        class PartialLeaseStore(LeaseStore):
+            def heartbeat(self, workerId, now):
+                pass
+
+        with self.assertRaises(TypeError):
+            PartialLeaseStore()
+        self.assertIsInstance(self.store, LeaseStore)
+
+    def test_lease(self):
+        self.assertTrue(self.store.acquire("leader", "a", 30, self.now))
+        self.assertTrue(self.store.acquire("leader", "a", 30, self.now + 20))  # 续期
+        self.assertFalse(self.store.acquire("leader", "b", 30, self.now + 40))
+        self.assertTrue(self.store.acquire("leader", "b", 30, self.now + 51))  # 已过期，被接管
+        self.store.release("leader", "a")  # 不是持有者，不影响
+        self.assertFalse(self.store.acquire("leader", "a", 30, self.now + 52))
+
+    def test_takeoverAfterHeartbeatStops(self):
+        a, b = ShardCoordinator(self.store, "a", ttl=30), ShardCoordinator(self.store, "b", ttl=30)
+        a.heartbeat()
+        b.heartbeat()
+        a.heartbeat()
+        self.assertEqual((a.isLeader, b.isLeader, a.workers), (True, False, ["a", "b"]))
+        keys = [f"user{i}" for i in range(100)]
+        self.assertEqual(sum(a.owns(key) for key in keys) + sum(b.owns(key) for key in keys), 100)
+
+        self.now += 31  # a 停止发送心跳
+        joined, departed = b.heartbeat()
+        self.assertEqual((joined, departed, b.isLeader), (set(), {"a"}, True))
+        self.assertTrue(all(b.owns(key) for key in keys))
+
+    def test_leave(self):
+        a, b = ShardCoordinator(self.store, "a"), ShardCoordinator(self.store, "b")
+        a.heartbeat()
+        b.heartbeat()
+        a.leave()
+        self.assertFalse(a.isLeader)
+        _, departed = b.heartbeat()  # 不必等到租约过期
+        self.assertEqual((departed, b.isLeader), ({"a"}, True))
+
+    def test_publish(self):
+        self.assertIsNone(self.store.published("snapshot"))
+        self.store.publish("snapshot", "1")
+        self.store.publish("snapshot", "2")
+        self.assertEqual(self.store.published("snapshot"), "2")
+
+
+if __name__ == '__main__':
+    unittest.main()
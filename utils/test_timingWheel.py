@@ -0,0 +1,55 @@
+import unittest
+
+from utils.timingWheel import TimingWheel
+
+
+class TimingWheelTester(unittest.TestCase):
+    def setUp(self):
+        self.wheel: TimingWheel[str, int] = TimingWheel(tick=10, slotCount=6)  # 一圈 60 秒
+
+    def test_advanceInOrder(self):
+        self.wheel.schedule("b", 125, 2)
+        self.wheel.schedule("a", 112, 1)
+        self.wheel.schedule("c", 135, 3)
+        self.assertEqual(self.wheel.nextFireAt(), 112)
+        self.assertEqual(self.wheel.advance(100), [])
+        self.assertEqual(self.wheel.advance(130), [("a", 1), ("b", 2)])
+        self.assertEqual((len(self.wheel), self.wheel.keys()), (1, ["c"]))
+
+    def test_sameTickNotYetDue(self):
+        self.wheel.schedule("a", 105, 1)
+        self.assertEqual(self.wheel.advance(102), [])  # 同一刻度但尚未到时间
+        self.assertEqual(self.wheel.advance(106), [("a", 1)])
+
+    def test_scheduleReplacesAndCancel(self):
+        self.wheel.schedule("a", 110, 1)
+        self.wheel.schedule("a", 150, 2)
+        self.assertEqual((self.wheel.get("a"), self.wheel.fireAtOf("a")), (2, 150))
+        self.assertEqual(self.wheel.advance(120), [])
+        self.assertEqual(self.wheel.cancel("a"), 2)
+        self.assertIsNone(self.wheel.cancel("a"))
+        self.assertNotIn("a", self.wheel)
+        self.assertEqual(self.wheel.advance(200), [])
+
+    def test_beyondOneLap(self):
+        self.wheel.schedule("near", 110, 1)
+        self.wheel.schedule("far", 175, 2)  # 与 near 在同一个槽，但在下一圈
+        self.assertEqual(self.wheel.advance(115), [("near", 1)])
+        self.assertEqual(self.wheel.advance(170), [])
+        self.assertEqual(self.wheel.advance(180), [("far", 2)])
+
+    def test_pastFireTime(self):
+        self.wheel.advance(100)
+        self.wheel.schedule("late", 50, 1)  # 已经过去的时间，下一次推进时到期
+        self.assertEqual(self.wheel.advance(101), [("late", 1)])
+
+    def test_pauseLongerThanOneLap(self):
+        self.wheel.advance(100)
+        for i in range(10):
+            self.wheel.schedule(str(i), 100 + i * 25, i)
+        self.assertEqual(self.wheel.advance(1000), [(str(i), i) for i in range(10)])
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
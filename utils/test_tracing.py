@@ -0,0 +1,77 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from utils.tracing import Tracer
+
+
+class TracerTester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tracer = Tracer(sampleRate=1.0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def traced(self, name: str):
+        with self.tracer.span(name):
+            with self.tracer.span(f"{name}.child"):
+                await asyncio.sleep(0)
+
+    async def test_concurrentTasksOnSeparateLanes(self):
+        await asyncio.gather(self.traced("a"), self.traced("b"))
+        lanes = {span.name: span.lane for span in self.tracer.spans}
+        self.assertEqual(lanes["a"], lanes["a.child"])
+        self.assertNotEqual(lanes["a"], lanes["b"])
+
+    async def test_exportClearsSpansAndLanes(self):
+        await asyncio.gather(*[self.traced(str(i)) for i in range(5)])
+        fileName = os.path.join(self.directory.name, "trace.json")
+        self.assertEqual(self.tracer.export(fileName, clear=True), 10)
+        with open(fileName, encoding="utf-8") as file:
+            events = json.load(file)["traceEvents"]
+        self.assertEqual(len([event for event in events if event["ph"] == "X"]), 10)
+        self.assertEqual((len(self.tracer.spans), self.tracer.lanes), (0, {}))
+
+    async def test_resetWhileSpanIsOpen(self):
+        release = asyncio.Event()
+
+        async def longRunning():
+            with self.tracer.span("long"):
+                await release.wait()
+
+        task = asyncio.create_task(longRunning())
+        await asyncio.sleep(0)
+        self.tracer.reset()  # 如晚间推送中退出时导出并清空
+        await self.traced("short")
+        release.set()
+        await task
+        lanes = {span.name: span.lane for span in self.tracer.spans}
+        self.assertNotEqual(lanes["long"], lanes["short"])
+
+    async def test_overlappingRunsProfiledOneAtATime(self):
+        self.tracer.configure(profileNames=["a", "b"], profileDirectory=self.directory.name)
+
+        async def job():
+            await asyncio.sleep(0.01)
+
+        a, b = self.tracer.traced("a")(job), self.tracer.traced("b")(job)
+        await asyncio.gather(a(), b())
+        self.assertEqual([span.name for span in self.tracer.spans if span.attributes.get("profiled")], ["a"])
+        self.assertEqual((self.tracer.profileNames, self.tracer.profiling), ({"b"}, False))  # 留待下一次运行
+        await b()
+        self.assertEqual([span.name for span in self.tracer.spans if span.attributes.get("profiled")], ["a", "b"])
+        self.assertEqual(self.tracer.profileNames, set())
+        self.assertEqual(len([fileName for fileName in os.listdir(self.directory.name) if fileName.startswith("profile.")]), 2)
+
+    def test_unsampled(self):
+        tracer = Tracer(sampleRate=0.0)
+        with tracer.span("root") as span:
+            span.set(key="value")
+        self.assertEqual((len(tracer.spans), tracer.lanes), (0, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
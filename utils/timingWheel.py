@@ -0,0 +1,78 @@
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TimingWheel(Generic[K, V]):
+    """
+    时间轮：按到期时间把定时任务分到 slotCount 个槽中，每个槽对应 tick 秒。
+    添加、取消、替换任务均为 O(1)；推进时只检查从上次推进到现在经过的槽。
+    超过一圈的任务记录所在的绝对刻度，转到它所在的圈时才会到期。
+    """
+
+    def __init__(self, tick: float = 60.0, slotCount: int = 1440):
+        self.tick = tick
+        self.slotCount = slotCount
+        self.slots: List[Dict[K, Tuple[int, float, V]]] = [{} for _ in range(slotCount)]  # key -> (绝对刻度, 到期时间, 值)
+        self.slotOfKey: Dict[K, int] = {}
+        self.cursor: Optional[int] = None  # 上一次推进到的绝对刻度，下一次推进从这里开始检查
+
+    def __len__(self):
+        return len(self.slotOfKey)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.slotOfKey
+
+    def keys(self) -> List[K]:
+        return list(self.slotOfKey)
+
+    def tickOf(self, timestamp: float) -> int:
+        return int(timestamp // self.tick)
+
+    def schedule(self, key: K, fireAt: float, value: V):
+        """在 fireAt（时间戳）到期；key 已存在时替换"""
+        self.cancel(key)
+        tick = self.tickOf(fireAt)
+        if self.cursor is not None and tick < self.cursor:
+            tick = self.cursor  # 已经过去的刻度，在下一次推进时到期（到期时间早于现在）
+        slot = tick % self.slotCount
+        self.slots[slot][key] = (tick, fireAt, value)
+        self.slotOfKey[key] = slot
+
+    def cancel(self, key: K) -> Optional[V]:
+        slot = self.slotOfKey.pop(key, None)
+        if slot is None:
+            return None
+        return self.slots[slot].pop(key)[2]
+
+    def get(self, key: K) -> Optional[V]:
+        slot = self.slotOfKey.get(key)
+        return None if slot is None else self.slots[slot][key][2]
+
+    def fireAtOf(self, key: K) -> Optional[float]:
+        slot = self.slotOfKey.get(key)
+        return None if slot is None else self.slots[slot][key][1]
+
+    def nextFireAt(self) -> Optional[float]:
+        return min((self.slots[slot][key][1] for key, slot in self.slotOfKey.items()), default=None)
+
+    def advance(self, now: float) -> List[Tuple[K, V]]:
+        """推进到 now，取出所有已到期的任务（按到期时间排序）"""
+        nowTick = self.tickOf(now)
+        if self.cursor is None:
+            self.cursor = min((self.slots[slot][key][0] for key, slot in self.slotOfKey.items()), default=nowTick)
+        ticks: Iterable[int] = range(self.cursor, nowTick + 1)
+        if nowTick + 1 - self.cursor > self.slotCount:
+            ticks = range(nowTick + 1 - self.slotCount, nowTick + 1)  # 停顿超过一圈时，每个槽只需检查一次
+        expired: List[Tuple[float, K, V]] = []
+        for tick in ticks:
+            slot = self.slots[tick % self.slotCount]
+            # 与 now 同一刻度但尚未到时间的任务留在槽中，下一次推进时会再次检查这一刻度
+            for key in [key for key, (keyTick, fireAt, _) in slot.items() if keyTick <= nowTick and fireAt <= now]:
+                _, fireAt, value = slot.pop(key)
+                del self.slotOfKey[key]
+                expired.append((fireAt, key, value))
+        self.cursor = nowTick
+        expired.sort(key=lambda item: item[0])
+        return [(key, value) for _, key, value in expired]
@@ -0,0 +1,229 @@
+import asyncio
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set
+
+from loguru import logger
+
+
+class Span:
+    __slots__ = ("name", "attributes", "startNs", "endNs", "sampled", "lane")
+
+    def __init__(self, name: str, attributes: Dict[str, Any], sampled: bool, lane: int = 0):
+        self.name = name
+        self.attributes = attributes
+        self.startNs = time.perf_counter_ns()
+        self.endNs = 0
+        self.sampled = sampled
+        self.lane = lane  # 所在的协程（或线程），导出时作为 tid，使并发的 span 各占一行；在 span 结束时确定
+
+    def set(self, **attributes):
+        if self.sampled:
+            self.attributes.update(attributes)
+
+
+UNSAMPLED = Span("unsampled", {}, False)  # 未被采样的根 span，其下的 span 也不记录
+currentSpan: ContextVar[Optional[Span]] = ContextVar("currentSpan", default=None)
+
+
+class SpanContext:
+    """进入时把 span 设为当前 span，退出时恢复并记录（未被采样的不记录）"""
+
+    __slots__ = ("tracer", "span", "token")
+
+    def __init__(self, tracer: "Tracer", span: Span):
+        self.tracer = tracer
+        self.span = span
+        self.token = None
+
+    def __enter__(self) -> Span:
+        self.token = currentSpan.set(self.span)
+        return self.span
+
+    def __exit__(self, excType, exc, tb):
+        currentSpan.reset(self.token)
+        if self.span.sampled:
+            if exc is not None:
+                self.span.attributes["error"] = repr(exc)
+            self.tracer.record(self.span)
+        return False
+
+
+class NullSpanContext:
+    __slots__ = ()
+
+    def __enter__(self) -> Span:
+        return UNSAMPLED
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+
+NULL_CONTEXT = NullSpanContext()
+
+
+class Tracer:
+    """
+    轻量的 span 追踪：根 span 按 sampleRate 采样，其下嵌套的 span 跟随根 span 的采样结果。
+    span 随 contextvars 在协程间传递；已结束的 span 保存在最多 maxSpans 条的环形缓冲中，
+    可导出为 Chrome / Perfetto 的 trace event 格式（chrome://tracing 或 ui.perfetto.dev 打开）。
+    sampleRate 为 0 时几乎没有开销。
+    """
+
+    def __init__(self, sampleRate: float = 0.0, maxSpans: int = 200000):
+        self.sampleRate = sampleRate
+        self.spans: Deque[Span] = deque(maxlen=maxSpans)
+        self.profileNames: Set[str] = set()  # 下一次运行时用 cProfile 分析的 span 名称，分析一次后移除
+        self.profiling = False  # cProfile 同一时间只能分析一次运行
+        self.profileDirectory = "."
+        self.epochNs = time.perf_counter_ns()
+        self.epochTime = time.time()
+        # id(协程) -> 导出时的 tid；id 在协程结束后会被复用，导出并清空 span 时一并清空。
+        # span 结束时才取 tid，清空时尚未结束的 span 使用清空后的编号，不会与之后的 span 重复
+        self.lanes: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, sampleRate: Optional[float] = None, profileNames: Iterable[str] = (), profileDirectory: Optional[str] = None):
+        if sampleRate is not None:
+            self.sampleRate = sampleRate
+        self.profileNames.update(profileNames)
+        if profileDirectory is not None:
+            self.profileDirectory = profileDirectory
+
+    def laneOf(self) -> int:
+        try:
+            key = id(asyncio.current_task())
+        except RuntimeError:  # 不在事件循环中
+            key = threading.get_ident()
+        lane = self.lanes.get(key)
+        if lane is None:
+            with self._lock:
+                lane = self.lanes.setdefault(key, len(self.lanes) + 1)
+        return lane
+
+    def span(self, name: str, forceSample: bool = False, **attributes) -> "SpanContext":
+        """
+        记录一个 span：with tracer.span("名称", user=...) as span，可用 span.set(...) 补充属性。
+        未启用追踪或未被采样时返回的上下文几乎没有开销。\n
+        :param forceSample: 作为根 span 时不论 sampleRate 都记录，如被 cProfile 分析的运行
+        """
+        parent = currentSpan.get()
+        if parent is None:
+            if not forceSample:
+                if self.sampleRate <= 0:
+                    return NULL_CONTEXT  # 未启用追踪，其下的 span 同样直接返回
+                if random.random() >= self.sampleRate:
+                    return SpanContext(self, UNSAMPLED)  # 记下未被采样，其下的 span 不再各自采样
+        elif not parent.sampled:
+            return NULL_CONTEXT
+        return SpanContext(self, Span(name, attributes, True))
+
+    def reset(self):
+        """丢弃已记录的 span 与协程编号"""
+        with self._lock:
+            self.spans.clear()
+            self.lanes.clear()
+
+    def record(self, span: Span):
+        span.endNs = time.perf_counter_ns()
+        span.lane = self.laneOf()
+        self.spans.append(span)
+
+    def claimProfile(self, name: str) -> bool:
+        """name 在 profileNames 中且没有正在分析的运行时，将其移除并返回 True；否则留在 profileNames 中，由之后的运行分析"""
+        with self._lock:
+            if self.profiling or name not in self.profileNames:
+                return False
+            self.profileNames.discard(name)
+            self.profiling = True
+            return True
+
+    def traced(self, name: Optional[str] = None, **attributes):
+        """装饰器：把函数（同步或异步）的每次运行记录为一个 span；名称在 profileNames 中时，下一次运行用 cProfile 分析"""
+        def decorator(function):
+            spanName = name or function.__qualname__
+
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def asyncWrapper(*args, **kwargs):
+                    if self.claimProfile(spanName):
+                        with self.profiled(spanName), self.span(spanName, forceSample=True, profiled=True, **attributes):
+                            return await function(*args, **kwargs)
+                    with self.span(spanName, **attributes):
+                        return await function(*args, **kwargs)
+
+                return asyncWrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if self.claimProfile(spanName):
+                    with self.profiled(spanName), self.span(spanName, forceSample=True, profiled=True, **attributes):
+                        return function(*args, **kwargs)
+                with self.span(spanName, **attributes):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def profiled(self, name: str):
+        """
+        用 cProfile 分析一次运行，结果保存为 profile.{name}.{时间}.prof（可用 snakeviz 等查看），并在日志中输出累计耗时最多的函数。
+        cProfile 记录的是整个线程，期间同一事件循环上其他协程的耗时也会计入；同一时间只能分析一次运行，
+        traced 通过 claimProfile 保证这一点
+        """
+        self.profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield profile
+        finally:
+            profile.disable()
+            self.profiling = False
+            fileName = os.path.join(self.profileDirectory, f"profile.{name}.{time.strftime('%Y%m%d-%H%M%S')}.prof")
+            profile.dump_stats(fileName)
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(20)
+            logger.info(f"{name}的性能分析已保存至{fileName}\n{stream.getvalue()}")
+
+    def toChromeTrace(self) -> Dict:
+        """Chrome / Perfetto 的 trace event 格式：每个 span 为一个完整事件（ph 为 X），时间单位为微秒"""
+        pid = os.getpid()
+        events: List[Dict] = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"sillage-{pid}"}}]
+        spans = list(self.spans)
+        events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": lane, "args": {"name": f"task-{lane}"}}
+                   for lane in sorted({span.lane for span in spans})]
+        for span in spans:
+            events.append({"name": span.name, "cat": span.name.split(".")[0], "ph": "X", "pid": pid, "tid": span.lane,
+                           "ts": (span.startNs - self.epochNs) / 1000, "dur": (span.endNs - span.startNs) / 1000,
+                           "args": {key: value if isinstance(value, (int, float, bool, str)) or value is None else str(value)
+                                    for key, value in span.attributes.items()}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"startTime": self.epochTime}}
+
+    def export(self, fileName: str, clear: bool = False) -> int:
+        """导出为 Chrome trace JSON，返回导出的 span 数"""
+        count = len(self.spans)
+        if not count:
+            return 0
+        with open(fileName, "w", encoding="utf-8") as file:
+            json.dump(self.toChromeTrace(), file, ensure_ascii=False)
+        if clear:
+            self.reset()
+        logger.info(f"已导出{count}个span至{fileName}")
+        return count
+
+
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced